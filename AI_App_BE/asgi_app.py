@@ -0,0 +1,358 @@
+# -------------------------------------------------
+#  Server ASGI (asyncio) cho các route chờ I/O lâu
+# -------------------------------------------------
+# Chạy: uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+#
+# Các route gọi Gemini được viết lại bằng Firestore async client và
+# GeminiClient.generate_async (cùng token bucket/circuit breaker với main), nên 1 process giữ được hàng trăm request đang chờ
+# Gemini. Đọc request, prompt, parse, cache key, payload và lọc stream dùng chung
+# helper của main; ở đây chỉ còn phần I/O (await thay cho lời gọi blocking). Các route còn lại chuyển sang Flask app trong main.py qua a2wsgi: mỗi
+# request Flask chạy trên 1 thread trong pool FLASK_BRIDGE_WORKERS (không dồn
+# vào 1 thread chung). SSE /notifications/stream chạy thẳng trên event loop,
+# kết nối mở lâu không giữ thread nào.
+import asyncio
+import os
+import queue
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from firebase_admin import firestore_async
+from quart import Quart, request, jsonify, Response
+from quart_cors import cors
+
+import main
+from main import (
+    gemini,
+    prediction_cache,
+    prediction_store_stats,
+    seconds_until,
+    RequestError,
+    unavailable_payload,
+    prediction_request,
+    parse_prediction,
+    prediction_response,
+    personalize_prediction,
+    stale_prediction_source,
+    stale_prediction_payload,
+    natal_request,
+    natal_lookup,
+    natal_payload,
+    natal_analysis_doc,
+    natal_pointer_doc,
+    clean_analysis_text,
+    compatibility_request,
+    check_compatibility_profiles,
+    compatibility_payload,
+    compatibility_doc,
+    build_compatibility_prompt,
+    compatibility_pair_key,
+    parse_compatibility_analysis,
+    stream_requested,
+    StreamScrubber,
+    sse_event,
+    notification_bus,
+    NOTIFICATION_STREAM_HEARTBEAT,
+)
+from cache import AsyncSingleFlight
+from gemini_client import GeminiUnavailable
+from synastry import synastry_scores
+
+adb = firestore_async.client()
+
+quart_app = cors(Quart(__name__), allow_origin="*")
+gemini_flight = AsyncSingleFlight()
+
+
+@quart_app.before_serving
+async def start_background_jobs():
+    main.start_background_jobs()
+
+
+# -------------------------------------------------
+#  Helpers async (chỉ phần I/O; logic dùng chung nằm trong main)
+# -------------------------------------------------
+def gemini_unavailable(e):
+    body, headers = unavailable_payload(e)
+    return jsonify(body), 503, headers
+
+
+def request_error(e):
+    return jsonify({"error": e.message}), e.status
+
+
+async def read_cached_doc(collection, key):
+    cached = prediction_cache.get(key)
+    if cached is not None:
+        return cached
+
+    doc = await adb.collection(collection).document(key).get()
+    data = doc.to_dict() if doc.exists else None
+
+    expires_at = data.get("expires_at") if data else None
+    if data is None or (expires_at and seconds_until(expires_at) <= 0):
+        prediction_store_stats["misses"] += 1
+        return None
+
+    prediction_store_stats["hits"] += 1
+    prediction_cache.set(key, data, ttl=main._memory_ttl(expires_at))
+    return data
+
+
+async def write_cached_doc(collection, key, doc, data, expires_at=None):
+    doc = dict(doc, created_at=datetime.now().isoformat())
+    if expires_at:
+        doc["expires_at"] = expires_at
+
+    if isinstance(data, dict):
+        doc.update(data)
+    else:
+        doc["prediction"] = data
+
+    await adb.collection(collection).document(key).set(doc)
+    prediction_store_stats["writes"] += 1
+    prediction_cache.set(key, doc, ttl=main._memory_ttl(expires_at))
+    return doc
+
+
+async def serve_stale_prediction(e, req):
+    """Bản async của main.serve_stale_prediction"""
+    payload = stale_prediction_payload(await read_cached_doc(*stale_prediction_source(req)), req)
+    return gemini_unavailable(e) if payload is None else jsonify(payload)
+
+
+async def get_user_profile(uid):
+    """Index trong bộ nhớ nếu sẵn sàng, ngược lại đọc Firestore async"""
+    if main.use_profile_index():
+        return main.profile_index.get(uid)
+    doc = await adb.collection("users").document(uid).get()
+    return doc.to_dict() if doc.exists else None
+
+
+def wants_stream(data):
+    return stream_requested(data, request.accept_mimetypes.best)
+
+
+def sse_response(events):
+    return Response(
+        events,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def replay_sse(text, done_payload):
+    for event in main.replay_sse(text, done_payload):
+        yield event
+
+
+async def stream_analysis(prompt, finalize, stop_marker=None, name=None):
+    """Bản async của main.stream_analysis; finalize là coroutine function"""
+    try:
+        scrubber = StreamScrubber(stop_marker, name)
+        async for piece in gemini.stream_async(prompt):
+            text = scrubber.feed(piece)
+            if text:
+                yield sse_event("chunk", {"text": text})
+
+        text = scrubber.flush()
+        if text:
+            yield sse_event("chunk", {"text": text})
+
+        yield sse_event("done", {**(await finalize(scrubber.text)), "cached": False})
+
+    except Exception as e:
+        print(f"❌ Stream error: {str(e)}")
+        yield sse_event("error", {"error": str(e)})
+
+
+# -------------------------------------------------
+#  Route test server
+# -------------------------------------------------
+@quart_app.route("/", methods=["GET"])
+async def home():
+    return "ASGI server đang hoạt động bình thường!"
+
+
+# -------------------------------------------------
+#  Route: /generate (async)
+# -------------------------------------------------
+@quart_app.route("/generate", methods=["POST"])
+async def generate_prediction():
+    try:
+        req = prediction_request(await request.get_json())
+    except RequestError as e:
+        return request_error(e)
+    category, name = req["category"], req["name"]
+
+    cached_doc = await read_cached_doc(req["collection"], req["key"])
+    if cached_doc:
+        return jsonify(prediction_response(category, personalize_prediction(cached_doc, name), True))
+
+    async def run():
+        result = parse_prediction(category, await gemini.generate_async(req["prompt"]))
+        return await write_cached_doc(req["collection"], req["key"], req["base_doc"], result, req["expires_at"])
+
+    try:
+        doc, shared = await gemini_flight.do(req["key"], run)
+        return jsonify(prediction_response(category, personalize_prediction(doc, name), shared))
+    except GeminiUnavailable as e:
+        return await serve_stale_prediction(e, req)
+    except Exception as e:
+        print("Gemini Error:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route: phân tích bản đồ sao (async)
+# -------------------------------------------------
+@quart_app.route("/natal-analysis", methods=["POST"])
+async def natal_chart_analysis():
+    try:
+        data = await request.get_json()
+        req = natal_request(data)
+        uid, name, chart_hash = req["uid"], req["name"], req["chart_hash"]
+
+        # Point read theo hash bản đồ + con trỏ uid → hash trong 1 lượt get_all
+        analysis_ref = adb.collection("natal_analysis").document(chart_hash)
+        pointer_ref = adb.collection("natal_analysis_users").document(uid) if uid else None
+        snapshots = [doc async for doc in adb.get_all([analysis_ref] + ([pointer_ref] if pointer_ref else []))]
+        cached_data, pointer_hash = natal_lookup(snapshots, analysis_ref.path)
+
+        if cached_data:
+            if pointer_ref and pointer_hash != chart_hash:
+                await pointer_ref.set(natal_pointer_doc(chart_hash, name))
+            payload = natal_payload(cached_data.get("analysis", ""), name, True)
+            if wants_stream(data):
+                return sse_response(replay_sse(payload["analysis"], payload))
+            return jsonify(payload)
+
+        async def save_analysis(analysis_text):
+            analysis_text = clean_analysis_text(analysis_text)
+            batch = adb.batch()
+            batch.set(analysis_ref, natal_analysis_doc(chart_hash, data, analysis_text))
+            if pointer_ref:
+                batch.set(pointer_ref, natal_pointer_doc(chart_hash, name))
+            await batch.commit()
+            return analysis_text
+
+        if wants_stream(data):
+            async def finalize(text):
+                return natal_payload(await save_analysis(text), name, False)
+            return sse_response(stream_analysis(req["prompt"], finalize, name=name))
+
+        async def run():
+            return await save_analysis(await gemini.generate_async(req["prompt"]))
+
+        analysis_text, shared = await gemini_flight.do(req["flight_key"], run)
+        return jsonify(natal_payload(analysis_text, name, shared)), 200
+
+    except RequestError as e:
+        return request_error(e)
+    except GeminiUnavailable as e:
+        return gemini_unavailable(e)
+    except Exception as e:
+        print(f"❌ Error in natal analysis: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route: phân tích tương hợp (async)
+# -------------------------------------------------
+@quart_app.route("/compatibility-analysis", methods=["POST"])
+async def compatibility_analysis():
+    try:
+        data = await request.get_json()
+        my_uid, partner_uid = compatibility_request(data)
+
+        me_raw, partner_raw = await asyncio.gather(get_user_profile(my_uid), get_user_profile(partner_uid))
+        check_compatibility_profiles(me_raw, partner_raw)
+
+        # Chỉ lấy điểm: tính cục bộ, không cần cache hay Gemini
+        if data.get("scoresOnly"):
+            return jsonify({**synastry_scores(me_raw, partner_raw), "cached": False}), 200
+
+        # 1 doc cho cả 2 chiều, ID theo cặp uid + phiên bản bản đồ → 1 lệnh get
+        pair_key, chart_hashes = compatibility_pair_key(my_uid, me_raw, partner_uid, partner_raw)
+        cache_ref = adb.collection("compatibility_analysis").document(pair_key)
+        cached_doc = await cache_ref.get()
+
+        if cached_doc.exists:
+            payload = compatibility_payload(cached_doc.to_dict(), True)
+            if wants_stream(data):
+                return sse_response(replay_sse(payload["analysis"], payload))
+            return jsonify(payload)
+
+        scores = synastry_scores(me_raw, partner_raw)
+        prompt = build_compatibility_prompt(me_raw, partner_raw, scores)
+
+        async def save_analysis(analysis_text):
+            analysis_text, _ = parse_compatibility_analysis(analysis_text)
+            await cache_ref.set(compatibility_doc(
+                my_uid, me_raw, partner_uid, partner_raw, chart_hashes, analysis_text, scores
+            ))
+            return {"analysis": analysis_text, **scores}
+
+        if wants_stream(data):
+            async def events():
+                yield sse_event("scores", scores)
+                async for event in stream_analysis(prompt, save_analysis, stop_marker="SCORES:"):
+                    yield event
+            return sse_response(events())
+
+        async def run():
+            return await save_analysis(await gemini.generate_async(prompt))
+
+        result, shared = await gemini_flight.do(pair_key, run)
+        return jsonify(compatibility_payload(result, shared)), 200
+
+    except RequestError as e:
+        return request_error(e)
+    except GeminiUnavailable as e:
+        return gemini_unavailable(e)
+    except Exception as e:
+        print(f"❌ Error in compatibility analysis: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route: SSE thông báo realtime (async, không chiếm thread)
+# -------------------------------------------------
+@quart_app.route("/notifications/stream", methods=["GET"])
+async def notification_stream():
+    user_id = request.args.get("userId")
+    if not user_id:
+        return jsonify({"error": "Thiếu userId"}), 400
+
+    subscription = notification_bus.subscribe_async(user_id)
+
+    async def events():
+        try:
+            yield sse_event("ready", {"userId": user_id})
+            while True:
+                try:
+                    event = await subscription.get(timeout=NOTIFICATION_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield sse_event("notification", event)
+        finally:
+            notification_bus.unsubscribe(user_id, subscription)
+
+    response = sse_response(events())
+    response.timeout = None
+    return response
+
+
+# -------------------------------------------------
+#  ASGI entry: route async → Quart, còn lại → Flask app
+# -------------------------------------------------
+ASYNC_PATHS = {rule.rule for rule in quart_app.url_map.iter_rules() if "<" not in rule.rule}
+FLASK_BRIDGE_WORKERS = int(os.getenv("FLASK_BRIDGE_WORKERS", "32"))
+flask_app = WSGIMiddleware(main.app, workers=FLASK_BRIDGE_WORKERS)
+
+
+async def app(scope, receive, send):
+    if scope["type"] != "http" or scope["path"] in ASYNC_PATHS:
+        await quart_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,98 @@
+# -------------------------------------------------
+#  Benchmark độ đồng thời: Flask (main.py) vs ASGI (asgi_app.py)
+# -------------------------------------------------
+# Ví dụ (chạy 2 server trước):
+#   python main.py                                  # Flask, cổng 5000
+#   uvicorn asgi_app:app --port 8000                # ASGI, cổng 8000
+#   python bench_concurrency.py --targets http://localhost:5000 http://localhost:8000 \
+#       --path /generate --body body.json --concurrency 200 --requests 1000
+#
+# Chỉ dùng thư viện chuẩn để kết quả không phụ thuộc client async nào.
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def one_request(url, body, timeout):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(
+        url, data=data, method="POST" if data is not None else "GET",
+        headers={"Content-Type": "application/json"},
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            ok = 200 <= resp.status < 300
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def run(target, path, body, concurrency, total, timeout):
+    url = target.rstrip("/") + path
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: one_request(url, body, timeout), range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [lat for ok, lat in results if ok]
+    return {
+        "target": target,
+        "ok": len(latencies),
+        "failed": total - len(latencies),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh độ đồng thời giữa các server")
+    parser.add_argument("--targets", nargs="+", default=["http://localhost:5000", "http://localhost:8000"])
+    parser.add_argument("--path", default="/generate")
+    parser.add_argument("--body", help="File JSON làm body (bỏ trống → GET)")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    body = None
+    if args.body:
+        with open(args.body, encoding="utf-8") as f:
+            body = json.load(f)
+
+    results = [
+        run(target, args.path, body, args.concurrency, args.requests, args.timeout)
+        for target in args.targets
+    ]
+
+    print(f"{args.requests} request, {args.concurrency} đồng thời → {args.path}")
+    for r in results:
+        print(
+            f"- {r['target']}: {r['throughput_rps']} req/s | p50 {r['p50_ms']}ms "
+            f"p95 {r['p95_ms']}ms p99 {r['p99_ms']}ms | ok {r['ok']} lỗi {r['failed']}"
+        )
+
+    if len(results) >= 2 and results[0]["throughput_rps"]:
+        gain = results[1]["throughput_rps"] / results[0]["throughput_rps"]
+        print(f"⚡ {results[1]['target']} đạt {gain:.1f}x throughput so với {results[0]['target']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# -------------------------------------------------
+#  Cache trong bộ nhớ (LRU + TTL)
+# -------------------------------------------------
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(*parts):
+    """Khoá xác định (deterministic) từ các field → hex SHA-256, dùng làm document ID"""
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    Cache LRU có thời hạn, an toàn đa luồng.
+    Đếm hits / misses / evictions / expirations để theo dõi.
+    """
+
+    def __init__(self, maxsize=2048, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# -------------------------------------------------
+#  Single-flight: gộp các lời gọi trùng khoá đang chạy
+# -------------------------------------------------
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Request đầu tiên của một khoá thực thi `fn`; các request trùng khoá đến
+    trong lúc đó chờ và dùng chung kết quả (hoặc lỗi) của lần gọi đó.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        """Trả về (kết quả, shared) — shared=True nếu dùng lại kết quả của request khác"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "shared": self.shared,
+            }
+
+
+class AsyncSingleFlight:
+    """Bản asyncio của SingleFlight, dùng trong server ASGI (một event loop)"""
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        """fn là coroutine function; trả về (kết quả, shared)"""
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            # Đánh dấu đã lấy lỗi để không cảnh báo khi không có ai chờ
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._calls.pop(key, None)
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "shared": self.shared,
+        }
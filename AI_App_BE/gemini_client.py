@@ -0,0 +1,269 @@
+# -------------------------------------------------
+#  Lớp gọi Gemini dùng chung: token bucket, retry + jitter, circuit breaker
+# -------------------------------------------------
+# Mọi lời gọi Gemini trong process đi qua 1 GeminiClient:
+#   - token bucket giới hạn số request/phút theo quota
+#   - lỗi 429/5xx/timeout được thử lại với backoff lũy thừa + full jitter
+#   - lỗi liên tiếp vượt ngưỡng → mở mạch, fail nhanh bằng GeminiUnavailable
+#     (route tự quyết định trả cache cũ hay 503)
+import asyncio
+import random
+import threading
+import time
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class GeminiUnavailable(Exception):
+    """Gemini đang quá tải / mạch đang mở / hết lượt chờ token"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """rate token/giây, tối đa capacity token; reserve() trả về số giây phải chờ"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Giữ chỗ 1 token; None nếu phải chờ lâu hơn max_wait (không giữ chỗ)"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def available(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return min(self.capacity, self._tokens + elapsed * self.rate)
+
+
+class CircuitBreaker:
+    """closed → open sau threshold lỗi liên tiếp → half_open sau reset_timeout (cho 1 lời gọi thử)"""
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+            # Lời gọi thử bị bỏ dở (client ngắt stream...) thì cho thử lại sau reset_timeout
+            probe_stuck = time.monotonic() - self._probe_started >= self.reset_timeout
+            if self.state == "half_open" and (not self._probing or probe_stuck):
+                self._probing = True
+                self._probe_started = time.monotonic()
+                return True
+            return False
+
+    def retry_after(self):
+        with self._lock:
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.opens += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+def is_retryable(error):
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code in RETRYABLE_STATUS
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def response_text(response):
+    return response.text if hasattr(response, "text") else str(response)
+
+
+class GeminiClient:
+    def __init__(self, model_name, requests_per_minute=60, burst=10, max_retries=3,
+                 backoff_base=1.0, backoff_max=20.0, queue_timeout=30.0,
+                 breaker_threshold=5, breaker_reset=30.0):
+        self.model_name = model_name
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self.counts = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0,
+            "rate_limited": 0, "short_circuited": 0, "throttled": 0,
+            "throttle_wait_s": 0.0, "stale_served": 0,
+        }
+
+    # --- tiện ích nội bộ ---
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def _model(self):
+        return genai.GenerativeModel(self.model_name)
+
+    def _admit(self):
+        """Kiểm tra mạch rồi giữ chỗ token; trả về số giây cần chờ trước khi gọi"""
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise GeminiUnavailable("Gemini đang gián đoạn, thử lại sau", self.breaker.retry_after())
+        wait = self.bucket.reserve(self.queue_timeout)
+        if wait is None:
+            self._count("throttled")
+            raise GeminiUnavailable("Quá nhiều yêu cầu tới Gemini, thử lại sau", self.queue_timeout)
+        if wait > 0:
+            self._count("throttle_wait_s", wait)
+        return wait
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _on_error(self, error, attempt):
+        """True nếu nên thử lại; ngược lại ghi nhận lỗi và ném ra ngoài"""
+        retryable = is_retryable(error)
+        if getattr(error, "code", None) == 429:
+            self._count("rate_limited")
+        # Lời gọi thử (half_open) lỗi thì mở lại mạch ngay: lần thử lại sẽ bị
+        # allow() chặn vì lượt thử vẫn đang giữ, mạch kẹt ở half_open
+        if retryable and attempt < self.max_retries and self.breaker.state == "closed":
+            self._count("retries")
+            return True
+
+        self._count("failures")
+        if retryable:
+            self.breaker.record_failure()
+            raise GeminiUnavailable(f"Gemini lỗi sau {attempt + 1} lần thử: {error}") from error
+        # Lỗi do request (400, safety...) nghĩa là Gemini vẫn phản hồi bình thường
+        self.breaker.record_success()
+        raise error
+
+    def _on_stream_error(self, error):
+        """Lỗi giữa chừng stream: không thử lại được vì client đã nhận một phần"""
+        self._count("failures")
+        if is_retryable(error):
+            self.breaker.record_failure()
+        raise error
+
+    def _on_success(self):
+        self._count("successes")
+        self.breaker.record_success()
+
+    def note_stale(self):
+        """Route đã trả cache cũ thay cho lời gọi thất bại"""
+        self._count("stale_served")
+
+    # --- API ---
+    def generate(self, prompt, **kwargs):
+        """Gọi Gemini (đồng bộ), trả về text"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._admit())
+            try:
+                text = response_text(self._model().generate_content(prompt, **kwargs))
+                self._on_success()
+                return text
+            except Exception as e:
+                self._on_error(e, attempt)
+                time.sleep(self._backoff(attempt))
+
+    def stream(self, prompt, **kwargs):
+        """Yield từng đoạn text; chỉ thử lại khi lỗi xảy ra trước đoạn đầu tiên"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._admit())
+            started = False
+            try:
+                for chunk in self._model().generate_content(prompt, stream=True, **kwargs):
+                    started = True
+                    yield response_text(chunk)
+                self._on_success()
+                return
+            except Exception as e:
+                if started:
+                    self._on_stream_error(e)
+                self._on_error(e, attempt)
+                time.sleep(self._backoff(attempt))
+
+    async def generate_async(self, prompt, **kwargs):
+        """Bản async cho server ASGI"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._admit())
+            try:
+                text = response_text(await self._model().generate_content_async(prompt, **kwargs))
+                self._on_success()
+                return text
+            except Exception as e:
+                self._on_error(e, attempt)
+                await asyncio.sleep(self._backoff(attempt))
+
+    async def stream_async(self, prompt, **kwargs):
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._admit())
+            started = False
+            try:
+                response = await self._model().generate_content_async(prompt, stream=True, **kwargs)
+                async for chunk in response:
+                    started = True
+                    yield response_text(chunk)
+                self._on_success()
+                return
+            except Exception as e:
+                if started:
+                    self._on_stream_error(e)
+                self._on_error(e, attempt)
+                await asyncio.sleep(self._backoff(attempt))
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts["throttle_wait_s"] = round(counts["throttle_wait_s"], 2)
+        return {
+            **counts,
+            "breaker": {
+                "state": self.breaker.state,
+                "consecutive_failures": self.breaker.failures,
+                "opens": self.breaker.opens,
+            },
+            "tokens_available": round(self.bucket.available(), 2),
+        }
@@ -0,0 +1,107 @@
+# -------------------------------------------------
+#  Pipeline xử lý ảnh chạy nền (avatar / ảnh bìa)
+# -------------------------------------------------
+# decode → xoay theo EXIF rồi bỏ EXIF → thu nhỏ nhiều kích thước → WebP,
+# sau đó gọi hàm store(uid, image_type, variants) để upload + cập nhật hồ sơ.
+# Request chỉ xếp job vào hàng đợi rồi trả về ngay; client hỏi trạng thái theo job_id.
+import io
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from cache import TTLCache
+
+# Cạnh dài tối đa (px) cho từng biến thể; biến thể đầu tiên là ảnh chính
+IMAGE_VARIANTS = {
+    "avatar": {"lg": 512, "md": 256, "sm": 96},
+    "coverImage": {"lg": 1600, "md": 800},
+}
+WEBP_QUALITY = 82
+
+
+def process_image(source, image_type):
+    """
+    source: đường dẫn file hoặc bytes ảnh gốc.
+    Trả về {nhãn: bytes WebP} theo IMAGE_VARIANTS[image_type].
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        img = img.convert("RGBA" if has_alpha else "RGB")
+
+        variants = {}
+        for label, max_side in IMAGE_VARIANTS[image_type].items():
+            resized = img.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            out = io.BytesIO()
+            # Ảnh mới không mang info/EXIF của ảnh gốc (GPS, thiết bị...)
+            resized.save(out, format="WEBP", quality=WEBP_QUALITY, method=4)
+            variants[label] = out.getvalue()
+        return variants
+
+
+class ImagePipeline:
+    """Thread pool xử lý ảnh; trạng thái job giữ trong TTLCache (mặc định 1 giờ)"""
+
+    def __init__(self, store, max_workers=2, job_ttl=3600):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image")
+        self._jobs = TTLCache(maxsize=10000, ttl=job_ttl)
+        self._lock = threading.Lock()
+        self.counts = {"queued": 0, "done": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def submit(self, uid, image_type, source, cleanup_path=None):
+        """Xếp job và trả về (job_id, future); cleanup_path được xoá sau khi xử lý xong"""
+        job_id = uuid.uuid4().hex
+        self._set(job_id, {"status": "queued", "uid": uid, "imageType": image_type})
+        with self._lock:
+            self.counts["queued"] += 1
+        future = self._pool.submit(self._run, job_id, uid, image_type, source, cleanup_path)
+        return job_id, future
+
+    def status(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _set(self, job_id, state):
+        self._jobs.set(job_id, state)
+
+    def _run(self, job_id, uid, image_type, source, cleanup_path):
+        self._set(job_id, {"status": "processing", "uid": uid, "imageType": image_type})
+        try:
+            size_in = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+            variants = process_image(source, image_type)
+            urls = self.store(uid, image_type, variants)
+
+            with self._lock:
+                self.counts["done"] += 1
+                self.counts["bytes_in"] += size_in
+                self.counts["bytes_out"] += sum(len(v) for v in variants.values())
+            state = {"status": "done", "uid": uid, "imageType": image_type, "urls": urls}
+            self._set(job_id, state)
+            return state
+
+        except Exception as e:
+            print(f"❌ Image job {job_id} lỗi: {str(e)}")
+            with self._lock:
+                self.counts["failed"] += 1
+            state = {"status": "failed", "uid": uid, "imageType": image_type, "error": str(e)}
+            self._set(job_id, state)
+            return state
+
+        finally:
+            if cleanup_path:
+                try:
+                    os.remove(cleanup_path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return {**counts, "jobs": len(self._jobs)}
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
@@ -9,10 +9,26 @@ from firebase_admin import credentials, firestore, auth
 import json
 import re
 import base64
+import io
+import tempfile
 import cloudinary
 import cloudinary.uploader
-from datetime import datetime, timedelta
+import cloudinary.utils
+from datetime import datetime, timedelta, timezone, date
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import uuid
+import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from matching_engine import ProfileMatrix, MATCH_TYPES, PLANETS
+from profile_index import UserProfileIndex
+from match_materializer import LoveMatchMaterializer
+from cache import TTLCache, SingleFlight, make_cache_key
+from notification_bus import NotificationBus
+from image_pipeline import ImagePipeline, IMAGE_VARIANTS
+from gemini_client import GeminiClient, GeminiUnavailable
+from synastry import SCORE_KEYS, synastry_scores
 
 # Load biến môi trường
 base_dir = os.path.abspath(os.path.dirname(__file__))
@@ -45,31 +61,151 @@ CORS(app)
 
 MODEL_NAME ="gemini-2.5-flash"
 
+# Mọi lời gọi Gemini đi qua client này (quota, retry, circuit breaker)
+gemini = GeminiClient(
+    MODEL_NAME,
+    requests_per_minute=int(os.getenv("GEMINI_RPM", "60")),
+    burst=int(os.getenv("GEMINI_BURST", "10")),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+    queue_timeout=float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30")),
+    breaker_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+)
+
+
+def unavailable_payload(e):
+    """(body, headers) của response 503 khi Gemini quá tải (dùng chung cho Flask và ASGI)"""
+    retry_after = int(e.retry_after or 30) + 1
+    return {"error": str(e), "retryAfter": retry_after}, {"Retry-After": str(retry_after)}
+
+
+def gemini_unavailable(e):
+    """503 + Retry-After khi Gemini quá tải và không có cache cũ để trả"""
+    body, headers = unavailable_payload(e)
+    return jsonify(body), 503, headers
+
+
+class RequestError(Exception):
+    """Request không hợp lệ phát hiện trong helper dùng chung → route trả về với status tương ứng"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+# Số ứng viên tối đa gửi cho Gemini sau khi chấm điểm cục bộ
+LOVE_MATCH_SHORTLIST = int(os.getenv("LOVE_MATCH_SHORTLIST", "20"))
+
+
+# -------------------------------------------------
+#  Cache dự đoán 2 tầng: bộ nhớ (LRU+TTL) → Firestore
+# -------------------------------------------------
+prediction_cache = TTLCache(
+    maxsize=int(os.getenv("PREDICTION_CACHE_SIZE", "4096")),
+    ttl=int(os.getenv("PREDICTION_CACHE_TTL", "3600")),
+)
+prediction_store_stats = {"hits": 0, "misses": 0, "writes": 0}
+
+# Gộp các lời gọi Gemini trùng khoá đang chạy đồng thời
+gemini_flight = SingleFlight()
+
+
+def prediction_cache_key(uid, name, sun, moon, category, day):
+    return make_cache_key("prediction", uid, name, sun, moon, category, day)
+
+
+# -------------------------------------------------
+#  Quy đổi day tương đối → ngày cụ thể theo múi giờ user
+# -------------------------------------------------
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Ho_Chi_Minh")
+DAY_OFFSETS = {"yesterday": -1, "today": 0, "tomorrow": 1}
+# Ngày cụ thể chỉ nhận trong khoảng [hôm qua, hôm nay + 7]: ngày cũ hơn thì bản ghi
+# hết hạn ngay khi ghi (mỗi request lại gọi Gemini), ngày quá xa thì không cần sinh trước
+PREDICTION_MAX_DAYS_AHEAD = 7
+
+
+def resolve_prediction_day(day, tz_name=None):
+    """
+    "today"/"tomorrow"/"yesterday" (hoặc "YYYY-MM-DD") → (ngày, thời điểm hết hạn).
+    Dự đoán của ngày D còn được dùng khi D là "hôm qua", nên hết hạn vào đầu ngày D+2.
+    Ngày ngoài khoảng cho phép → ValueError.
+    """
+    try:
+        tz = ZoneInfo(tz_name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        tz = ZoneInfo(DEFAULT_TIMEZONE)
+
+    today = datetime.now(tz).date()
+    if isinstance(day, str) and day in DAY_OFFSETS:
+        target = today + timedelta(days=DAY_OFFSETS[day])
+    else:
+        target = date.fromisoformat(str(day))
+        if not today - timedelta(days=1) <= target <= today + timedelta(days=PREDICTION_MAX_DAYS_AHEAD):
+            raise ValueError(f"Ngày {target.isoformat()} nằm ngoài khoảng cho phép")
+
+    expires_at = datetime.combine(target + timedelta(days=2), datetime.min.time(), tzinfo=tz)
+    return target, expires_at
+
+
+def seconds_until(expires_at):
+    return (expires_at - datetime.now(timezone.utc)).total_seconds()
+
 
 # -------------------------------------------------
-#  Lấy dữ liệu cache Firestore
+#  Đọc/ghi cache 2 tầng (bộ nhớ → Firestore point get)
+# -------------------------------------------------
+def _memory_ttl(expires_at):
+    return min(prediction_cache.ttl, seconds_until(expires_at)) if expires_at else None
+
+
+def read_cached_doc(collection, key):
+    cached = prediction_cache.get(key)
+    if cached is not None:
+        return cached
+
+    doc = db.collection(collection).document(key).get()
+    data = doc.to_dict() if doc.exists else None
+
+    # Document đã hết hạn nhưng job dọn dẹp chưa xoá → coi như miss
+    expires_at = data.get("expires_at") if data else None
+    if data is None or (expires_at and seconds_until(expires_at) <= 0):
+        prediction_store_stats["misses"] += 1
+        return None
+
+    prediction_store_stats["hits"] += 1
+    prediction_cache.set(key, data, ttl=_memory_ttl(expires_at))
+    return data
+
+
+def write_cached_doc(collection, key, doc, data, expires_at=None):
+    doc = dict(doc, created_at=datetime.now().isoformat())
+    if expires_at:
+        doc["expires_at"] = expires_at
+
+    if isinstance(data, dict):
+        doc.update(data)
+    else:
+        doc["prediction"] = data
+
+    db.collection(collection).document(key).set(doc)
+    prediction_store_stats["writes"] += 1
+    prediction_cache.set(key, doc, ttl=_memory_ttl(expires_at))
+    return doc
+
+
+# -------------------------------------------------
+#  Lấy dữ liệu cache
 # -------------------------------------------------
 def get_cached_prediction(uid, name, sun, moon, category, day):
-    query = (
-        db.collection("user_prediction")
-        .where("uid", "==", uid)
-        .where("name", "==", name)
-        .where("sun", "==", sun)
-        .where("moon", "==", moon)
-        .where("category", "==", category)
-        .where("day", "==", day)
-        .limit(1)
-        .stream()
-    )
-    for doc in query:
-        return doc.to_dict()
-    return None
+    key = prediction_cache_key(uid, name, sun, moon, category, day)
+    return read_cached_doc("user_prediction", key)
 
 
 # -------------------------------------------------
-#  Lưu dữ liệu vào Firestore
+#  Lưu dữ liệu vào Firestore (document ID = cache key)
 # -------------------------------------------------
-def save_prediction(uid, name, sun, moon, category, day, data):
+def save_prediction(uid, name, sun, moon, category, day, data, expires_at=None):
+    key = prediction_cache_key(uid, name, sun, moon, category, day)
     doc = {
         "uid": uid,
         "name": name,
@@ -77,15 +213,122 @@ def save_prediction(uid, name, sun, moon, category, day, data):
         "moon": moon,
         "category": category,
         "day": day,
-        "created_at": datetime.now().isoformat(),
     }
+    return write_cached_doc("user_prediction", key, doc, data, expires_at)
+
+
+# -------------------------------------------------
+#  Nội dung dùng chung theo tổ hợp cung (sun, moon, category, ngày)
+# -------------------------------------------------
+# Nội dung được sinh 1 lần với placeholder thay cho tên, rồi cá nhân hoá khi trả về
+PREDICTION_SHARED_CONTENT = os.getenv("PREDICTION_SHARED_CONTENT", "0") == "1"
+NAME_PLACEHOLDER = "{NAME}"
+
+
+def use_shared_content(data):
+    return bool(data.get("shared", PREDICTION_SHARED_CONTENT))
+
+
+def prediction_template_key(sun, moon, category, day):
+    return make_cache_key("prediction_template", sun, moon, category, day)
 
-    if isinstance(data, dict):
-        doc.update(data)
-    else:
-        doc["prediction"] = data
 
-    db.collection("user_prediction").add(doc)
+def get_cached_template(sun, moon, category, day):
+    return read_cached_doc("prediction_templates", prediction_template_key(sun, moon, category, day))
+
+
+def save_template(sun, moon, category, day, data, expires_at=None):
+    key = prediction_template_key(sun, moon, category, day)
+    doc = {"sun": sun, "moon": moon, "category": category, "day": day}
+    return write_cached_doc("prediction_templates", key, doc, data, expires_at)
+
+
+def personalize_prediction(doc, name):
+    """Thay placeholder bằng tên thật của user"""
+    doc = dict(doc)
+    for field in ("prediction", "quote"):
+        if isinstance(doc.get(field), str):
+            doc[field] = doc[field].replace(NAME_PLACEHOLDER, name)
+    return doc
+
+
+# -------------------------------------------------
+#  Job nền: xoá dự đoán hết hạn theo lô
+# -------------------------------------------------
+PREDICTION_COMPACTION_INTERVAL = int(os.getenv("PREDICTION_COMPACTION_INTERVAL", "3600"))
+PREDICTION_COMPACTION_BATCH = 400
+compaction_stats = {"runs": 0, "deleted": 0, "stale_pairs_deleted": 0, "last_run": None, "last_error": None}
+
+
+def _delete_in_batches(query, batch_size):
+    deleted = 0
+    while True:
+        docs = list(query.limit(batch_size).stream())
+        if not docs:
+            break
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+        if len(docs) < batch_size:
+            break
+    return deleted
+
+
+def compact_expired_predictions(batch_size=PREDICTION_COMPACTION_BATCH):
+    """Xoá các dự đoán/nội dung dùng chung đã hết hạn (và bản ghi cũ còn lưu day tương đối)"""
+    collection = db.collection("user_prediction")
+    deleted = _delete_in_batches(
+        collection.where("expires_at", "<", datetime.now(timezone.utc)).select(["expires_at"]),
+        batch_size,
+    )
+    deleted += _delete_in_batches(
+        collection.where("day", "in", list(DAY_OFFSETS)).select(["day"]),
+        batch_size,
+    )
+    deleted += _delete_in_batches(
+        db.collection("prediction_templates")
+        .where("expires_at", "<", datetime.now(timezone.utc)).select(["expires_at"]),
+        batch_size,
+    )
+    compaction_stats["runs"] += 1
+    compaction_stats["deleted"] += deleted
+    compaction_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+    return deleted
+
+
+def _prediction_compaction_loop():
+    while True:
+        try:
+            deleted = compact_expired_predictions()
+            if deleted:
+                print(f"🧹 Đã xoá {deleted} dự đoán hết hạn")
+            stale_pairs = compact_stale_compatibility()
+            if stale_pairs:
+                print(f"🧹 Đã xoá {stale_pairs} phân tích tương hợp mồ côi")
+        except Exception as e:
+            compaction_stats["last_error"] = str(e)
+            print(f"⚠️ Lỗi dọn dẹp dự đoán: {str(e)}")
+        time.sleep(PREDICTION_COMPACTION_INTERVAL)
+
+
+_background_jobs_started = False
+_background_jobs_lock = threading.Lock()
+
+
+def start_background_jobs():
+    global _background_jobs_started
+    with _background_jobs_lock:
+        if _background_jobs_started:
+            return
+        _background_jobs_started = True
+    if PREDICTION_COMPACTION_INTERVAL > 0:
+        threading.Thread(target=_prediction_compaction_loop, name="prediction-compaction", daemon=True).start()
+    if PROFILE_INDEX_ENABLED:
+        threading.Thread(target=_profile_index_loop, name="profile-index", daemon=True).start()
+    if PROFILE_INDEX_ENABLED and LOVE_MATCH_MATERIALIZE:
+        love_materializer.start()
     
     
 # ===============================
@@ -117,6 +360,69 @@ def is_valid_user(u):
         return False
 
 
+# -------------------------------------------------
+#  Index hồ sơ user trong bộ nhớ
+# -------------------------------------------------
+PROFILE_INDEX_ENABLED = os.getenv("PROFILE_INDEX_ENABLED", "1") == "1"
+profile_index = UserProfileIndex(db)
+
+
+PROFILE_INDEX_RETRY = 30
+
+
+def use_profile_index():
+    """True khi index đã nạp xong; không chờ — chưa sẵn sàng thì route đọc Firestore ngay"""
+    return PROFILE_INDEX_ENABLED and profile_index.ready
+
+
+def _profile_index_loop():
+    # Listener khởi động 1 lần ở nền; lỗi thì thử lại sau PROFILE_INDEX_RETRY giây
+    while not profile_index.start():
+        time.sleep(PROFILE_INDEX_RETRY)
+
+
+def get_user_profile(uid):
+    """Đọc hồ sơ user: index trong bộ nhớ, fallback đọc Firestore"""
+    if use_profile_index():
+        return profile_index.get(uid)
+    doc = db.collection("users").document(uid).get()
+    return doc.to_dict() if doc.exists else None
+
+
+def get_user_profiles(*uids):
+    """
+    Đọc nhiều hồ sơ cùng lúc, trả về list dict | None theo thứ tự uids:
+    index trong bộ nhớ trước, các uid còn thiếu đọc bằng 1 lần db.get_all
+    """
+    found = {}
+    if use_profile_index():
+        found = {uid: profile_index.get(uid) for uid in uids}
+    missing = list(dict.fromkeys(uid for uid in uids if found.get(uid) is None))
+    if missing:
+        refs = [db.collection("users").document(uid) for uid in missing]
+        for doc in db.get_all(refs):
+            if doc.exists:
+                found[doc.id] = doc.to_dict()
+    return [found.get(uid) for uid in uids]
+
+
+# Thread pool cho các lời đọc Firestore độc lập trong cùng 1 request
+READ_POOL_WORKERS = int(os.getenv("READ_POOL_WORKERS", "16"))
+read_pool = ThreadPoolExecutor(max_workers=READ_POOL_WORKERS, thread_name_prefix="firestore-read")
+
+
+def run_concurrently(*calls):
+    """Chạy song song các hàm đọc không phụ thuộc nhau, trả về kết quả theo thứ tự"""
+    futures = [read_pool.submit(call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def update_user_profile(uid, fields):
+    """Cập nhật user trên Firestore và ghi xuyên vào index"""
+    db.collection("users").document(uid).update(fields)
+    profile_index.patch(uid, fields)
+
+
 # -------------------------------------------------
 #  Route Verify Password
 # -------------------------------------------------
@@ -209,9 +515,8 @@ def update_profile():
 
         # Cập nhật Firestore (không bao gồm password)
         if fields:
-            user_ref = db.collection("users").document(uid)
             fields["updatedAt"] = firestore.SERVER_TIMESTAMP
-            user_ref.update(fields)
+            update_user_profile(uid, fields)
             print(f"✅ Đã cập nhật Firestore cho user {uid}")
 
         return jsonify({
@@ -226,58 +531,31 @@ def update_profile():
 
 
 # -------------------------------------------------
-# Route chính: /generate
+#  Prompt & xử lý kết quả dự đoán
 # -------------------------------------------------
-@app.route("/generate", methods=["POST"])
-def generate_prediction():
-    data = request.get_json()
-    user_data = data.get("userData", {})
-    category = data.get("category", "daily")
-    day = data.get("day", "today")
-
-    uid = user_data.get("uid", "")
-    name = user_data.get("name", "")
-    sun = user_data.get("sun", "")
-    moon = user_data.get("moon", "")
-
-    if not name or not sun or not moon:
-        return jsonify({"error": "Thiếu thông tin người dùng"}), 400
-
-    # Kiểm tra cache Firestore
-    cached_doc = get_cached_prediction(uid, name, sun, moon, category, day)
-    if cached_doc:
-        print(f"✅ Cache Firestore có sẵn cho {name} ({uid}) - {category} ({day})")
-
-        if category == "love_metrics":
-            return jsonify({
-                "love_luck": cached_doc.get("love_luck"),
-                "best_match": cached_doc.get("best_match"),
-                "compatibility": cached_doc.get("compatibility"),
-                "quote": cached_doc.get("quote"),
-                "cached": True
-            })
+# Map tiếng Việt
+PREDICTION_CATEGORY_MAP = {
+    "daily": "Dự đoán hằng ngày",
+    "love": "Dự đoán tình duyên",
+    "work": "Dự đoán công việc",
+    "love_metrics": "Chỉ số tình duyên và cung hợp",
+}
 
-        return jsonify({"prediction": cached_doc.get("prediction", ""), "cached": True})
+LOVE_METRICS_FALLBACK = {
+    "love_luck": 80,
+    "best_match": "Kim Ngưu",
+    "compatibility": 85,
+    "quote": "Tình yêu là hành trình tự khám phá bản thân qua ánh mắt người khác."
+}
 
-    print(f"⚙️ Không có cache → Gọi Gemini ({category}, {day})")
 
-    # Map tiếng Việt
-    category_map = {
-        "daily": "Dự đoán hằng ngày",
-        "love": "Dự đoán tình duyên",
-        "work": "Dự đoán công việc",
-        "love_metrics": "Chỉ số tình duyên và cung hợp",
-    }
-    day_map = {
-        "yesterday": "hôm qua",
-        "today": "hôm nay",
-        "tomorrow": "ngày mai",
-    }
+def build_prediction_prompt(category, name, sun, moon, day_label):
+    category_map = PREDICTION_CATEGORY_MAP
 
     # Prompt riêng từng loại
     prompt_templates = {
         "daily": f"""
-        {category_map['daily']} cho {day_map.get(day)}:
+        {category_map['daily']} cho {day_label}:
         - Tên: {name}
         - Mặt Trời: {sun}, Mặt Trăng: {moon}
 
@@ -285,7 +563,7 @@ def generate_prediction():
         Không dùng emoji, không dùng các ký tự, không chào hỏi, không mở đầu hay kết thúc dư thừa.
         """,
         "love": f"""
-        {category_map['love']} cho {day_map.get(day)}:
+        {category_map['love']} cho {day_label}:
         - Tên: {name}
         - Mặt Trời: {sun}, Mặt Trăng: {moon}
 
@@ -293,7 +571,7 @@ def generate_prediction():
         Không dùng emoji, không dùng các ký tự, không chào hỏi, không văn phong hoa mỹ.
         """,
         "work": f"""
-        {category_map['work']} cho {day_map.get(day)}:
+        {category_map['work']} cho {day_label}:
         - Tên: {name}
         - Mặt Trời: {sun}, Mặt Trăng: {moon}
 
@@ -301,7 +579,7 @@ def generate_prediction():
         Kết thúc bằng lời khuyên ngắn, không dùng emoji, không dùng các ký tự, hay lời chào.
         """,
         "love_metrics": f"""
-        Phân tích chỉ số may mắn trong chuyện tình duyên {day_map.get(day)} cho người có:
+        Phân tích chỉ số may mắn trong chuyện tình duyên {day_label} cho người có:
         - Tên: {name}
         - Mặt Trời: {sun}, Mặt Trăng: {moon}
 
@@ -319,42 +597,381 @@ def generate_prediction():
     }
 
     prompt = prompt_templates.get(category, prompt_templates["daily"])
+    if name == NAME_PLACEHOLDER:
+        prompt += f"""
+        Lưu ý: {NAME_PLACEHOLDER} là chỗ đặt tên người dùng, giữ nguyên chuỗi {NAME_PLACEHOLDER} mỗi khi nhắc đến tên.
+        """
+    return prompt
+
+
+def parse_prediction(category, text):
+    """Làm sạch kết quả Gemini: love_metrics → dict, các loại khác → text"""
+    text = re.sub(r"(```json|```|'''|\"\"\")", "", text).strip()
+    if category != "love_metrics":
+        return text
+
+    try:
+        cleaned = re.sub(r"^.*?(\{.*\}).*$", r"\1", text, flags=re.DOTALL)
+        return json.loads(cleaned)
+    except Exception as e:
+        print("JSON Parse Error:", e)
+        print("Gemini trả về không hợp lệ → dùng fallback.")
+        return dict(LOVE_METRICS_FALLBACK)
+
+
+def prediction_response(category, doc, cached):
+    """Payload trả về client từ document cache hoặc kết quả vừa sinh"""
+    if category == "love_metrics":
+        return {
+            "love_luck": doc.get("love_luck"),
+            "best_match": doc.get("best_match"),
+            "compatibility": doc.get("compatibility"),
+            "quote": doc.get("quote"),
+            "cached": cached
+        }
+    return {"prediction": doc.get("prediction", ""), "cached": cached}
+
+
+def generate_and_save_prediction(uid, name, sun, moon, category, target_date, expires_at):
+    """Gọi Gemini, lưu cache và trả về document dự đoán"""
+    day_key = target_date.isoformat()
+    day_label = f"ngày {target_date.strftime('%d/%m/%Y')}"
+    prompt = build_prediction_prompt(category, name, sun, moon, day_label)
+
+    text = gemini.generate(prompt)
+
+    result = parse_prediction(category, text)
+    save_prediction(uid, name, sun, moon, category, day_key, result, expires_at=expires_at)
+    print(f"Đã lưu Firestore: {name} ({uid}) - {category} ({day_key})")
+
+    return result if isinstance(result, dict) else {"prediction": result}
+
+
+def generate_and_save_template(sun, moon, category, target_date, expires_at):
+    """Sinh nội dung dùng chung cho tổ hợp cung (tên để placeholder) và lưu cache"""
+    day_key = target_date.isoformat()
+    day_label = f"ngày {target_date.strftime('%d/%m/%Y')}"
+    prompt = build_prediction_prompt(category, NAME_PLACEHOLDER, sun, moon, day_label)
+
+    text = gemini.generate(prompt)
+
+    result = parse_prediction(category, text)
+    print(f"Đã lưu nội dung dùng chung: {sun}/{moon} - {category} ({day_key})")
+    return save_template(sun, moon, category, day_key, result, expires_at=expires_at)
+
+
+def stale_prediction_source(req):
+    """(collection, key) của dự đoán ngày trước đó (bản ghi còn hạn tới hết hôm nay)"""
+    previous = (req["target_date"] - timedelta(days=1)).isoformat()
+    sun, moon, category = req["sun"], req["moon"], req["category"]
+    if req["shared"]:
+        return "prediction_templates", prediction_template_key(sun, moon, category, previous)
+    return "user_prediction", prediction_cache_key(req["uid"], req["name"], sun, moon, category, previous)
+
+
+def stale_prediction_payload(doc, req):
+    """Payload trả cache cũ thay cho lời gọi Gemini thất bại; None nếu không có bản cũ"""
+    if doc is None:
+        return None
+    gemini.note_stale()
+    print(f"⚠️ Gemini gián đoạn → trả dự đoán cũ {req['category']} cho {req['name']}")
+    if req["shared"]:
+        doc = personalize_prediction(doc, req["name"])
+    return {**prediction_response(req["category"], doc, True), "stale": True}
+
+
+def serve_stale_prediction(e, req):
+    """Gemini gián đoạn → trả dự đoán của ngày trước đó, không có thì 503"""
+    payload = stale_prediction_payload(read_cached_doc(*stale_prediction_source(req)), req)
+    return gemini_unavailable(e) if payload is None else jsonify(payload)
+
+
+def prediction_request(data):
+    """
+    Đọc body của /generate (dùng chung cho Flask và ASGI): ngày cụ thể theo múi giờ user,
+    nơi lưu cache (theo user hoặc dùng chung theo tổ hợp cung) và tên dùng trong prompt
+    """
+    user_data = data.get("userData", {})
+    category = data.get("category", "daily")
+    day = data.get("day", "today")
+
+    uid = user_data.get("uid", "")
+    name = user_data.get("name", "")
+    sun = user_data.get("sun", "")
+    moon = user_data.get("moon", "")
+
+    if not name or not sun or not moon:
+        raise RequestError("Thiếu thông tin người dùng")
 
+    # Quy đổi day → ngày cụ thể theo múi giờ của user
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        text = response.text if hasattr(response, "text") else str(response)
+        target_date, expires_at = resolve_prediction_day(
+            day, data.get("timezone") or user_data.get("timezone")
+        )
+    except ValueError:
+        raise RequestError("Giá trị day không hợp lệ")
+    day_key = target_date.isoformat()
+
+    shared = use_shared_content(data)
+    if shared:
+        # Nội dung dùng chung theo tổ hợp cung, tên để placeholder
+        collection = "prediction_templates"
+        key = prediction_template_key(sun, moon, category, day_key)
+        base_doc = {"sun": sun, "moon": moon, "category": category, "day": day_key}
+    else:
+        collection = "user_prediction"
+        key = prediction_cache_key(uid, name, sun, moon, category, day_key)
+        base_doc = {"uid": uid, "name": name, "sun": sun, "moon": moon, "category": category, "day": day_key}
 
-        text = re.sub(r"(```json|```|'''|\"\"\")", "", text).strip()
-        if category == "love_metrics":
-            try:
-                cleaned = re.sub(r"^.*?(\{.*\}).*$", r"\1", text, flags=re.DOTALL)
-                data = json.loads(cleaned)
-            except Exception as e:
-                print("JSON Parse Error:", e)
-                print("Gemini trả về không hợp lệ → dùng fallback.")
-                data = {
-                    "love_luck": 80,
-                    "best_match": "Kim Ngưu",
-                    "compatibility": 85,
-                    "quote": "Tình yêu là hành trình tự khám phá bản thân qua ánh mắt người khác."
-                }
+    prompt = build_prediction_prompt(
+        category, NAME_PLACEHOLDER if shared else name, sun, moon,
+        f"ngày {target_date.strftime('%d/%m/%Y')}",
+    )
+    return {
+        "uid": uid, "name": name, "sun": sun, "moon": moon, "category": category,
+        "target_date": target_date, "expires_at": expires_at, "shared": shared,
+        "collection": collection, "key": key, "base_doc": base_doc, "prompt": prompt,
+    }
+
+
+# -------------------------------------------------
+# Route chính: /generate
+# -------------------------------------------------
+@app.route("/generate", methods=["POST"])
+def generate_prediction():
+    try:
+        req = prediction_request(request.get_json())
+    except RequestError as e:
+        return jsonify({"error": e.message}), e.status
+    category, name = req["category"], req["name"]
+
+    # Kiểm tra cache (bộ nhớ → Firestore)
+    cached_doc = read_cached_doc(req["collection"], req["key"])
+    if cached_doc:
+        print(f"✅ Cache có sẵn cho {name} - {category} ({req['target_date']})")
+        return jsonify(prediction_response(category, personalize_prediction(cached_doc, name), True))
 
-            save_prediction(uid, name, sun, moon, category, day, data)
-            print(f"Đã lưu Firestore: {name} ({uid}) - love_metrics ({day})")
-            return jsonify({**data, "cached": False})
+    print(f"⚙️ Không có cache → Gọi Gemini ({category}, {req['target_date']})")
 
-        # Các loại khác (daily/love/work)
-        save_prediction(uid, name, sun, moon, category, day, text)
-        print(f"Đã lưu Firestore: {name} ({uid}) - {category} ({day})")
+    def run():
+        result = parse_prediction(category, gemini.generate(req["prompt"]))
+        return write_cached_doc(req["collection"], req["key"], req["base_doc"], result, req["expires_at"])
 
-        return jsonify({"prediction": text, "cached": False})
+    try:
+        # Các request trùng nhau cùng lúc chỉ gọi Gemini 1 lần và dùng chung kết quả
+        doc, shared = gemini_flight.do(req["key"], run)
+        return jsonify(prediction_response(category, personalize_prediction(doc, name), shared))
 
+    except GeminiUnavailable as e:
+        return serve_stale_prediction(e, req)
     except Exception as e:
         print("Gemini Error:", e)
         return jsonify({"error": str(e)}), 500
 
 
+# -------------------------------------------------
+#  Sinh nhiều category/ngày trong 1 lời gọi Gemini
+# -------------------------------------------------
+BATCH_CATEGORY_INSTRUCTIONS = {
+    "daily": "\"<đoạn văn mô tả năng lượng, cảm xúc và xu hướng chính trong ngày, kèm một lời khuyên ngắn>\"",
+    "love": "\"<đoạn văn mô tả cảm xúc, mối quan hệ hoặc cơ hội trong tình yêu, cùng lời khuyên thực tế>\"",
+    "work": "\"<đoạn văn về năng lượng làm việc, cơ hội và thách thức nghề nghiệp, kết thúc bằng lời khuyên ngắn>\"",
+    "love_metrics": """{
+            "love_luck": <một số nguyên từ 0 đến 100>,
+            "best_match": "<tên một trong 12 cung hoàng đạo tiếng Việt>",
+            "compatibility": <một số nguyên 50..100>,
+            "quote": "<một câu quote ngắn gọn, sâu sắc, không emoji>"
+          }""",
+}
+
+
+def build_batch_prediction_prompt(name, sun, moon, wanted):
+    """wanted: {ngày ISO: [category, ...]}"""
+    schema = ",\n".join(
+        f'''      "{day_key}": {{
+''' + ",\n".join(
+            f'''        "{category}": {BATCH_CATEGORY_INSTRUCTIONS[category]}'''
+            for category in categories
+        ) + '''
+      }'''
+        for day_key, categories in wanted.items()
+    )
+
+    prompt = f"""
+        Dự đoán chiêm tinh cho người có:
+        - Tên: {name}
+        - Mặt Trời: {sun}, Mặt Trăng: {moon}
+
+        Trả về một JSON đúng định dạng, khoá ngoài là ngày (YYYY-MM-DD), khoá trong là loại dự đoán:
+        {{
+{schema}
+        }}
+
+        Yêu cầu:
+        - Viết bằng tiếng Việt, mỗi đoạn văn ngắn gọn, tập trung.
+        - Không dùng emoji, không dùng các ký tự, không chào hỏi, không mở đầu hay kết thúc dư thừa.
+        - Không in gì khác ngoài JSON.
+        """
+    if name == NAME_PLACEHOLDER:
+        prompt += f"""
+        Lưu ý: {NAME_PLACEHOLDER} là chỗ đặt tên người dùng, giữ nguyên chuỗi {NAME_PLACEHOLDER} mỗi khi nhắc đến tên.
+        """
+    return prompt
+
+
+def parse_batch_part(category, part):
+    """Kiểm tra từng phần của kết quả batch; None nếu thiếu/không hợp lệ"""
+    if category == "love_metrics":
+        if isinstance(part, dict) and all(k in part for k in LOVE_METRICS_FALLBACK):
+            return {k: part[k] for k in LOVE_METRICS_FALLBACK}
+        print("Gemini trả về love_metrics không hợp lệ → dùng fallback.")
+        return dict(LOVE_METRICS_FALLBACK)
+    if isinstance(part, str) and part.strip():
+        return part.strip()
+    return None
+
+
+@app.route("/generate-batch", methods=["POST"])
+def generate_prediction_batch():
+    """
+    Lấy nhiều category cho nhiều ngày: phần đã cache trả ngay,
+    phần còn thiếu sinh bằng đúng 1 lời gọi Gemini trả về JSON có cấu trúc
+    """
+    data = request.get_json()
+    user_data = data.get("userData", {})
+    categories = data.get("categories") or list(PREDICTION_CATEGORY_MAP)
+    days = data.get("days") or ["today"]
+
+    uid = user_data.get("uid", "")
+    name = user_data.get("name", "")
+    sun = user_data.get("sun", "")
+    moon = user_data.get("moon", "")
+
+    if not name or not sun or not moon:
+        return jsonify({"error": "Thiếu thông tin người dùng"}), 400
+
+    if not isinstance(days, list) or not all(isinstance(day, str) for day in days):
+        return jsonify({"error": "days phải là danh sách chuỗi"}), 400
+    if not isinstance(categories, list) or not all(isinstance(c, str) for c in categories):
+        return jsonify({"error": "categories phải là danh sách chuỗi"}), 400
+
+    unknown = [c for c in categories if c not in PREDICTION_CATEGORY_MAP]
+    if unknown:
+        return jsonify({"error": f"Category không hợp lệ: {', '.join(unknown)}"}), 400
+
+    tz_name = data.get("timezone") or user_data.get("timezone")
+    try:
+        resolved = {day: resolve_prediction_day(day, tz_name) for day in days}
+    except ValueError:
+        return jsonify({"error": "Giá trị day không hợp lệ"}), 400
+
+    # Chế độ nội dung dùng chung dùng cache theo tổ hợp cung
+    shared_mode = use_shared_content(data)
+    if shared_mode:
+        lookup = lambda category, day_key: get_cached_template(sun, moon, category, day_key)
+        save = lambda category, day_key, part, expires_at: save_template(
+            sun, moon, category, day_key, part, expires_at=expires_at)
+        prompt_name = NAME_PLACEHOLDER
+    else:
+        lookup = lambda category, day_key: get_cached_prediction(uid, name, sun, moon, category, day_key)
+        save = lambda category, day_key, part, expires_at: save_prediction(
+            uid, name, sun, moon, category, day_key, part, expires_at=expires_at)
+        prompt_name = name
+
+    results = {day: {} for day in days}
+    wanted = {}
+    for day, (target_date, _) in resolved.items():
+        day_key = target_date.isoformat()
+        for category in categories:
+            cached_doc = lookup(category, day_key)
+            if cached_doc:
+                results[day][category] = prediction_response(category, personalize_prediction(cached_doc, name), True)
+            elif category not in wanted.setdefault(day_key, []):
+                wanted[day_key].append(category)
+    wanted = {day_key: cats for day_key, cats in wanted.items() if cats}
+
+    if wanted:
+        print(f"⚙️ Batch: {sum(len(c) for c in wanted.values())} phần thiếu cache → 1 lời gọi Gemini")
+        expires_by_day = {target_date.isoformat(): expires_at for target_date, expires_at in resolved.values()}
+
+        def run_batch():
+            prompt = build_batch_prediction_prompt(prompt_name, sun, moon, wanted)
+            text = gemini.generate(prompt, generation_config={"response_mime_type": "application/json"})
+            text = re.sub(r"(```json|```)", "", text).strip()
+            # JSON hỏng/bị cắt hoặc sai cấu trúc (không phải object theo ngày → category)
+            # coi như Gemini bỏ sót: từng phần tự báo lỗi thay vì cả request trả 500
+            try:
+                parsed = json.loads(text)
+            except ValueError as e:
+                print(f"⚠️ Batch JSON không hợp lệ: {str(e)}")
+                parsed = {}
+            if not isinstance(parsed, dict):
+                parsed = {}
+
+            saved = {}
+            for day_key, cats in wanted.items():
+                day_parts = parsed.get(day_key)
+                if not isinstance(day_parts, dict):
+                    day_parts = {}
+                for category in cats:
+                    part = parse_batch_part(category, day_parts.get(category))
+                    if part is None:
+                        continue
+                    saved[(day_key, category)] = save(category, day_key, part, expires_by_day[day_key])
+            return saved
+
+        try:
+            batch_key = make_cache_key(
+                "prediction_batch", shared_mode, uid, name, sun, moon,
+                sorted((d, sorted(c)) for d, c in wanted.items()),
+            )
+            saved, shared = gemini_flight.do(batch_key, run_batch)
+        except GeminiUnavailable as e:
+            return gemini_unavailable(e)
+        except Exception as e:
+            print("Gemini Error:", e)
+            return jsonify({"error": str(e)}), 500
+
+        for day, (target_date, _) in resolved.items():
+            day_key = target_date.isoformat()
+            for category in wanted.get(day_key, []):
+                doc = saved.get((day_key, category))
+                if doc is None:
+                    results[day][category] = {"error": "Gemini không trả về phần này", "cached": False}
+                else:
+                    results[day][category] = prediction_response(category, personalize_prediction(doc, name), shared)
+
+    return jsonify({
+        "results": results,
+        "dates": {day: target_date.isoformat() for day, (target_date, _) in resolved.items()},
+    })
+
+
+# -------------------------------------------------
+#  Route: Thống kê cache
+# -------------------------------------------------
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "prediction_cache": {
+            "memory": prediction_cache.stats(),
+            "firestore": dict(prediction_store_stats),
+            "compaction": dict(compaction_stats),
+        },
+        "profile_index": profile_index.stats(),
+        "single_flight": gemini_flight.stats(),
+        "notification_bus": notification_bus.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "gemini": gemini.stats(),
+        "love_materializer": love_materializer.stats(),
+    })
+
+
+@app.before_request
+def ensure_background_jobs():
+    start_background_jobs()
+
+
 # -------------------------------------------------
 #  Route test server
 # -------------------------------------------------
@@ -363,15 +980,79 @@ def home():
     return "Flask server đang hoạt động bình thường!"
 
 
+# -------------------------------------------------
+#  Xử lý ảnh nền: WebP nhiều kích thước → Cloudinary → hồ sơ
+# -------------------------------------------------
+IMAGE_PIPELINE_WORKERS = int(os.getenv("IMAGE_PIPELINE_WORKERS", "2"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_SYNC_TIMEOUT = 60
+
+
+def store_processed_image(uid, image_type, variants):
+    """Upload các biến thể WebP; biến thể đầu giữ public_id cũ để /delete-image vẫn dùng được"""
+    urls = {}
+    for i, (label, data) in enumerate(variants.items()):
+        public_id = f"{uid}_{image_type}" if i == 0 else f"{uid}_{image_type}_{label}"
+        upload_result = cloudinary.uploader.upload(
+            io.BytesIO(data),
+            folder=f"astrolove/{image_type}",
+            public_id=public_id,
+            overwrite=True,
+            resource_type="image",
+            format="webp",
+        )
+        urls[label] = upload_result.get("secure_url")
+
+    image_url = next(iter(urls.values()))
+    update_user_profile(uid, {
+        image_type: image_url,
+        f"{image_type}Variants": urls,
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    })
+    print(f"✅ Đã upload {image_type} ({', '.join(urls)}) cho user {uid}: {image_url}")
+    return urls
+
+
+image_pipeline = ImagePipeline(store_processed_image, max_workers=IMAGE_PIPELINE_WORKERS)
+
+
 # -------------------------------------------------
 #  Route Upload Image (CLOUDINARY)
 # -------------------------------------------------
 @app.route("/upload-image", methods=["POST"])
 def upload_image():
     """
-    Upload ảnh lên Cloudinary (MIỄN PHÍ)
+    Upload ảnh qua server (MIỄN PHÍ)
+    - multipart/form-data (uid, imageType, file "image"): ghi ra file tạm, xếp job, trả 202 + jobId
+    - JSON base64 (client cũ): đi qua cùng pipeline, chờ xong rồi trả imageUrl như trước
     """
     try:
+        if request.content_length and request.content_length > UPLOAD_MAX_BYTES:
+            return jsonify({"error": "Ảnh quá lớn"}), 413
+
+        if request.files:
+            uid = request.form.get("uid")
+            image_type = request.form.get("imageType", "avatar")
+            image_file = request.files.get("image")
+
+            if not uid or not image_file:
+                return jsonify({"error": "Thiếu uid hoặc image"}), 400
+            if image_type not in IMAGE_VARIANTS:
+                return jsonify({"error": "imageType không hợp lệ"}), 400
+
+            # Werkzeug đọc body theo từng khối → ghi thẳng ra đĩa, không giữ cả ảnh trong RAM
+            fd, path = tempfile.mkstemp(prefix="upload_", suffix=os.path.splitext(image_file.filename or "")[1])
+            with os.fdopen(fd, "wb") as tmp:
+                image_file.save(tmp)
+
+            job_id, _ = image_pipeline.submit(uid, image_type, path, cleanup_path=path)
+            return jsonify({
+                "success": True,
+                "jobId": job_id,
+                "status": "queued",
+                "imageType": image_type
+            }), 202
+
         data = request.get_json()
         uid = data.get("uid")
         image_type = data.get("imageType", "avatar")
@@ -379,39 +1060,36 @@ def upload_image():
 
         if not uid or not image_data:
             return jsonify({"error": "Thiếu uid hoặc imageData"}), 400
+        if image_type not in IMAGE_VARIANTS:
+            return jsonify({"error": "imageType không hợp lệ"}), 400
 
         # Decode base64
         try:
             if "," in image_data:
                 header, image_data = image_data.split(",", 1)
-
-            # Upload lên Cloudinary
-            upload_result = cloudinary.uploader.upload(
-                f"data:image/jpeg;base64,{image_data}",
-                folder=f"astrolove/{image_type}",
-                public_id=f"{uid}_{image_type}",
-                overwrite=True,
-                resource_type="image"
-            )
-
-            image_url = upload_result.get("secure_url")
-
+            raw = base64.b64decode(image_data)
         except Exception as e:
             return jsonify({"error": f"Lỗi upload: {str(e)}"}), 400
 
-        # Cập nhật Firestore
-        user_ref = db.collection("users").document(uid)
-        user_ref.update({
-            image_type: image_url,
-            "updatedAt": firestore.SERVER_TIMESTAMP
-        })
-
-        print(f"✅ Đã upload {image_type} cho user {uid}: {image_url}")
+        job_id, future = image_pipeline.submit(uid, image_type, raw)
+        try:
+            result = future.result(timeout=UPLOAD_SYNC_TIMEOUT)
+        except FutureTimeoutError:
+            # Job vẫn chạy tiếp và sẽ ghi ảnh → trả jobId như luồng multipart để client theo dõi
+            return jsonify({
+                "success": True,
+                "jobId": job_id,
+                "status": (image_pipeline.status(job_id) or {}).get("status", "queued"),
+                "imageType": image_type
+            }), 202
+        if result["status"] != "done":
+            return jsonify({"error": f"Lỗi upload: {result.get('error', '')}"}), 400
 
         return jsonify({
             "success": True,
-            "imageUrl": image_url,
-            "imageType": image_type
+            "imageUrl": next(iter(result["urls"].values())),
+            "imageType": image_type,
+            "variants": result["urls"]
         }), 200
 
     except Exception as e:
@@ -420,12 +1098,120 @@ def upload_image():
 
 
 # -------------------------------------------------
-#  Route Delete Image (CLOUDINARY)
+#  Route: Trạng thái job upload ảnh
 # -------------------------------------------------
-@app.route("/delete-image", methods=["POST"])
-def delete_image():
-    """
-    Xóa ảnh từ Cloudinary
+@app.route("/upload-status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    state = image_pipeline.status(job_id)
+    if state is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+
+    payload = {"success": True, "jobId": job_id, **state}
+    if state.get("urls"):
+        payload["imageUrl"] = next(iter(state["urls"].values()))
+    return jsonify(payload), 200
+
+
+# -------------------------------------------------
+#  Upload trực tiếp lên Cloudinary bằng chữ ký (server không chạm bytes ảnh)
+# -------------------------------------------------
+IMAGE_TYPES = ("avatar", "coverImage")
+
+
+def image_public_id(uid, image_type):
+    return f"astrolove/{image_type}/{uid}_{image_type}"
+
+
+@app.route("/upload-signature", methods=["POST"])
+def upload_signature():
+    """
+    Trả về tham số upload đã ký để client POST file thẳng lên Cloudinary
+    (Cloudinary chỉ chấp nhận chữ ký trong 1 giờ kể từ timestamp)
+    """
+    try:
+        data = request.get_json()
+        uid = data.get("uid")
+        image_type = data.get("imageType", "avatar")
+
+        if not uid:
+            return jsonify({"error": "Thiếu uid"}), 400
+        if image_type not in IMAGE_TYPES:
+            return jsonify({"error": "imageType không hợp lệ"}), 400
+
+        config = cloudinary.config()
+        params = {
+            "timestamp": int(time.time()),
+            "public_id": f"{uid}_{image_type}",
+            "folder": f"astrolove/{image_type}",
+            "overwrite": "true",
+        }
+        signature = cloudinary.utils.api_sign_request(params, config.api_secret)
+
+        return jsonify({
+            "success": True,
+            "uploadUrl": f"https://api.cloudinary.com/v1_1/{config.cloud_name}/image/upload",
+            "params": {**params, "api_key": config.api_key, "signature": signature},
+        }), 200
+
+    except Exception as e:
+        print(f"❌ Upload signature error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/upload-complete", methods=["POST"])
+def upload_complete():
+    """
+    Client gửi lại public_id/version/signature mà Cloudinary trả về sau khi upload;
+    server xác thực chữ ký rồi mới cập nhật ảnh trong Firestore
+    """
+    try:
+        data = request.get_json()
+        uid = data.get("uid")
+        image_type = data.get("imageType", "avatar")
+        public_id = data.get("publicId")
+        version = data.get("version")
+        signature = data.get("signature")
+
+        if not uid or not public_id or not version or not signature:
+            return jsonify({"error": "Thiếu uid, publicId, version hoặc signature"}), 400
+        if image_type not in IMAGE_TYPES:
+            return jsonify({"error": "imageType không hợp lệ"}), 400
+
+        # Chỉ nhận đúng ảnh đã ký cho user này
+        if public_id != image_public_id(uid, image_type):
+            return jsonify({"error": "publicId không khớp"}), 403
+        if not cloudinary.utils.verify_api_response_signature(public_id, version, signature):
+            return jsonify({"error": "Chữ ký không hợp lệ"}), 403
+
+        image_url, _ = cloudinary.utils.cloudinary_url(
+            public_id, version=version, secure=True, resource_type="image"
+        )
+
+        update_user_profile(uid, {
+            image_type: image_url,
+            "updatedAt": firestore.SERVER_TIMESTAMP
+        })
+
+        print(f"✅ Đã upload trực tiếp {image_type} cho user {uid}: {image_url}")
+
+        return jsonify({
+            "success": True,
+            "imageUrl": image_url,
+            "imageType": image_type
+        }), 200
+
+    except Exception as e:
+        print(f"❌ Upload complete error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route Delete Image (CLOUDINARY)
+# -------------------------------------------------
+@app.route("/delete-image", methods=["POST"])
+def delete_image():
+    """
+    Xóa ảnh từ Cloudinary
     """
     try:
         data = request.get_json()
@@ -442,14 +1228,16 @@ def delete_image():
                 # Extract public_id từ URL
                 public_id = f"astrolove/{image_type}/{uid}_{image_type}"
                 cloudinary.uploader.destroy(public_id)
+                for label in list(IMAGE_VARIANTS.get(image_type, {}))[1:]:
+                    cloudinary.uploader.destroy(f"{public_id}_{label}")
                 print(f"🗑️ Đã xóa ảnh: {public_id}")
             except Exception as e:
                 print(f"⚠️ Không thể xóa ảnh: {str(e)}")
 
         # Reset field trong Firestore
-        user_ref = db.collection("users").document(uid)
-        user_ref.update({
+        update_user_profile(uid, {
             image_type: "",
+            f"{image_type}Variants": firestore.DELETE_FIELD,
             "updatedAt": firestore.SERVER_TIMESTAMP
         })
 
@@ -464,81 +1252,50 @@ def delete_image():
 
 
 # -------------------------------------------------
-#  Route phân tích bản đồ sao
+#  Trích xuất dữ liệu chiêm tinh & prompt phân tích
 # -------------------------------------------------
-@app.route("/natal-analysis", methods=["POST"])
-def natal_chart_analysis():
-    """
-    Phân tích chi tiết bản đồ sao dựa trên thông tin chiêm tinh
-    """
-    try:
-        data = request.get_json()
-        uid = data.get("uid", "")
-
-        # Lấy thông tin từ request
-        user_info = {
-            "name": data.get("name", ""),
-            "sun": data.get("sun", ""),
-            "moon": data.get("moon", ""),
-            "mercury": data.get("mercury", ""),
-            "venus": data.get("venus", ""),
-            "mars": data.get("mars", ""),
-            "jupiter": data.get("jupiter", ""),
-            "saturn": data.get("saturn", ""),
-            "uranus": data.get("uranus", ""),
-            "neptune": data.get("neptune", ""),
-            "pluto": data.get("pluto", ""),
-            "ascendant": data.get("ascendant", ""),
-            "descendant": data.get("descendant", ""),
-            "mc": data.get("mc", ""),
-            "ic": data.get("ic", ""),
-        }
-
-        # Lấy thông tin houses
-        houses = {
-            f"house{i}": data.get(f"house{i}", "") for i in range(1, 13)
-        }
-
-        # Lấy thông tin aspects
-        aspects = {
-            "conjunction": data.get("conjunctionAspect", ""),
-            "opposition": data.get("oppositionAspect", ""),
-            "trine": data.get("trineAspect", ""),
-            "square": data.get("squareAspect", ""),
-            "sextile": data.get("sextileAspect", ""),
-        }
-
-        # Lấy tỷ lệ nguyên tố
-        elemental_ratios = {
-            "fire": data.get("fireRatio", 0),
-            "earth": data.get("earthRatio", 0),
-            "air": data.get("airRatio", 0),
-            "water": data.get("waterRatio", 0),
-        }
+def extract_user_info(user_data):
+    return {
+        "name": user_data.get("name", ""),
+        "sun": user_data.get("sun", ""),
+        "moon": user_data.get("moon", ""),
+        "mercury": user_data.get("mercury", ""),
+        "venus": user_data.get("venus", ""),
+        "mars": user_data.get("mars", ""),
+        "jupiter": user_data.get("jupiter", ""),
+        "saturn": user_data.get("saturn", ""),
+        "uranus": user_data.get("uranus", ""),
+        "neptune": user_data.get("neptune", ""),
+        "pluto": user_data.get("pluto", ""),
+        "ascendant": user_data.get("ascendant", ""),
+        "descendant": user_data.get("descendant", ""),
+        "mc": user_data.get("mc", ""),
+        "ic": user_data.get("ic", ""),
+    }
 
-        if not user_info["name"] or not user_info["sun"] or not user_info["moon"]:
-            return jsonify({"error": "Thiếu thông tin cơ bản"}), 400
+def extract_houses(user_data):
+    return {f"house{i}": user_data.get(f"house{i}", "") for i in range(1, 13)}
 
-        # Kiểm tra cache Firestore
-        cache_query = (
-            db.collection("natal_analysis")
-            .where("uid", "==", uid)
-            .limit(1)
-            .stream()
-        )
+def extract_aspects(user_data):
+    return {
+        "conjunction": user_data.get("conjunctionAspect", ""),
+        "opposition": user_data.get("oppositionAspect", ""),
+        "trine": user_data.get("trineAspect", ""),
+        "square": user_data.get("squareAspect", ""),
+        "sextile": user_data.get("sextileAspect", ""),
+    }
 
-        for doc in cache_query:
-            cached_data = doc.to_dict()
-            print(f"✅ Cache phân tích có sẵn cho {user_info['name']} ({uid})")
-            return jsonify({
-                "analysis": cached_data.get("analysis", ""),
-                "cached": True
-            })
+def extract_elements(user_data):
+    return {
+        "fire": user_data.get("fireRatio", 0),
+        "earth": user_data.get("earthRatio", 0),
+        "air": user_data.get("airRatio", 0),
+        "water": user_data.get("waterRatio", 0),
+    }
 
-        print(f"⚙️ Không có cache → Gọi Gemini để phân tích")
 
-        # Tạo prompt phân tích chi tiết
-        prompt = f"""
+def build_natal_prompt(user_info, houses, aspects, elemental_ratios):
+    prompt = f"""
         Phân tích bản đồ sao chi tiết cho người có thông tin sau:
 
         **Thông tin cơ bản:**
@@ -596,256 +1353,727 @@ def natal_chart_analysis():
         - Không chào hỏi hay văn phong dư thừa
         - Tập trung vào phân tích sâu, có căn cứ chiêm tinh học
         """
+    if user_info["name"] == NAME_PLACEHOLDER:
+        prompt += f"""
+        Lưu ý: {NAME_PLACEHOLDER} là chỗ đặt tên người dùng, giữ nguyên chuỗi {NAME_PLACEHOLDER} mỗi khi nhắc đến tên.
+        """
+    return prompt
 
-        # Gọi Gemini API
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        analysis_text = response.text if hasattr(response, "text") else str(response)
-
-        # Làm sạch text
-        analysis_text = re.sub(r"(```|'''|\"\"\")", "", analysis_text).strip()
-
-        # Lưu vào Firestore
-        analysis_doc = {
-            "uid": uid,
-            "name": user_info["name"],
-            "analysis": analysis_text,
-            "created_at": datetime.now().isoformat(),
-            "user_data": {**user_info, **houses, **aspects, **elemental_ratios}
-        }
 
-        db.collection("natal_analysis").add(analysis_doc)
-        print(f"✅ Đã lưu phân tích cho {user_info['name']} ({uid})")
+def build_compatibility_prompt(me_raw, partner_raw, scores=None):
+    me_info = extract_user_info(me_raw)
+    me_houses = extract_houses(me_raw)
+    me_aspects = extract_aspects(me_raw)
+    me_elements = extract_elements(me_raw)
 
-        return jsonify({
-            "analysis": analysis_text,
-            "cached": False
-        }), 200
+    partner_info = extract_user_info(partner_raw)
+    partner_houses = extract_houses(partner_raw)
+    partner_aspects = extract_aspects(partner_raw)
+    partner_elements = extract_elements(partner_raw)
 
-    except Exception as e:
-        print(f"❌ Error in natal analysis: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    if scores:
+        # Điểm đã tính sẵn → Gemini chỉ viết phân tích khớp với các chỉ số này
+        score_instructions = "Các chỉ số (0-100) đã được tính sẵn, phân tích cần nhất quán với chúng:\n" + "\n".join(
+            f"        - {key}: {value}" for key, value in scores.items()
+        )
+        score_format = "- Không cần ghi lại các chỉ số ở cuối bài"
+    else:
+        score_instructions = """Sau khi phân tích, hãy đánh giá các chỉ số sau (0-100):
+        - Độ tương thích tổng thể (compatibility_score)
+        - Tình yêu và hấp dẫn (love_score)
+        - Lòng tin và an toàn (trust_score)
+        - Giao tiếp và hiểu biết (communication_score)
+        - Tiềm năng hôn nhân (marriage_score)"""
+        score_format = """- Cuối cùng, ghi rõ 5 chỉ số theo format:
+        
+        SCORES:
+        compatibility_score: [số]
+        love_score: [số]
+        trust_score: [số]
+        communication_score: [số]
+        marriage_score: [số]"""
+
+    return f"""
+        Phân tích độ tương hợp chi tiết giữa 2 người dựa trên thông tin chiêm tinh sau:
+        
+        **NGƯỜI 1:**
+        - Tên: {me_info['name']}
+        - Mặt Trời: {me_info['sun']}
+        - Mặt Trăng: {me_info['moon']}
+        - Thủy tinh: {me_info['mercury']}
+        - Kim tinh: {me_info['venus']}
+        - Hỏa tinh: {me_info['mars']}
+        - Mộc tinh: {me_info['jupiter']}
+        - Thổ tinh: {me_info['saturn']}
+        - Thiên Vương tinh: {me_info['uranus']}
+        - Hải Vương tinh: {me_info['neptune']}
+        - Diêm Vương tinh: {me_info['pluto']}
+        - Ascendant: {me_info['ascendant']}
+        - Descendant: {me_info['descendant']}
+        - MC: {me_info['mc']}
+        - IC: {me_info['ic']}
+        
+        Các nhà: {json.dumps(me_houses, ensure_ascii=False)}
+        Aspects: {json.dumps(me_aspects, ensure_ascii=False)}
+        Tỷ lệ nguyên tố: {json.dumps(me_elements, ensure_ascii=False)}
+        
+        **NGƯỜI 2:**
+        - Tên: {partner_info['name']}
+        - Mặt Trời: {partner_info['sun']}
+        - Mặt Trăng: {partner_info['moon']}
+        - Thủy tinh: {partner_info['mercury']}
+        - Kim tinh: {partner_info['venus']}
+        - Hỏa tinh: {partner_info['mars']}
+        - Mộc tinh: {partner_info['jupiter']}
+        - Thổ tinh: {partner_info['saturn']}
+        - Thiên Vương tinh: {partner_info['uranus']}
+        - Hải Vương tinh: {partner_info['neptune']}
+        - Diêm Vương tinh: {partner_info['pluto']}
+        - Ascendant: {partner_info['ascendant']}
+        - Descendant: {partner_info['descendant']}
+        - MC: {partner_info['mc']}
+        - IC: {partner_info['ic']}
+        
+        Các nhà: {json.dumps(partner_houses, ensure_ascii=False)}
+        Aspects: {json.dumps(partner_aspects, ensure_ascii=False)}
+        Tỷ lệ nguyên tố: {json.dumps(partner_elements, ensure_ascii=False)}
+        
+        Hãy phân tích chi tiết và sâu sắc độ tương hợp của cặp đôi này theo các mục sau:
+        
+        1. **Tổng quan về mối quan hệ**: Đánh giá tổng thể về sự hòa hợp giữa 2 người
+        2. **Tương thích cảm xúc**: Phân tích Mặt Trăng, Kim tinh và các hành tinh cá nhân
+        3. **Giao tiếp và tư duy**: Dựa vào Thủy tinh, Không khí trong nguyên tố
+        4. **Tình yêu và lãng mạn**: Phân tích Kim tinh, Hỏa tinh và Nhà 5, 7
+        5. **Cam kết dài hạn và hôn nhân**: Dựa vào Thổ tinh, Mộc tinh, MC và các góc tương tác
+        6. **Thách thức và xung đột**: Các aspects khó khăn, điểm bất hòa cần lưu ý
+        7. **Điểm mạnh của mối quan hệ**: Những gì làm cho mối quan hệ này đặc biệt
+        8. **Lời khuyên để phát triển**: Hướng dẫn cụ thể để xây dựng mối quan hệ bền vững
+        
+        {score_instructions}
+        
+        Yêu cầu:
+        - Viết bằng tiếng Việt, văn phong chuyên nghiệp nhưng ấm áp
+        - Mỗi mục khoảng 2-3 đoạn văn
+        - Không dùng emoji, không dùng ký tự đặc biệt
+        - Không chào hỏi hay văn phong dư thừa
+        - Tập trung vào phân tích sâu, có căn cứ chiêm tinh học
+        {score_format}
+        """
+
+
+def clean_analysis_text(text):
+    """Bỏ các ký hiệu code block Gemini hay chèn vào bài phân tích"""
+    return re.sub(r"(```|'''|\"\"\")", "", text).strip()
+
+
+def parse_compatibility_analysis(analysis_text):
+    """Tách phần SCORES cuối bài → (analysis_text, scores)"""
+    analysis_text = clean_analysis_text(analysis_text)
+
+    # Trích xuất scores từ text
+    scores = {
+        "compatibility_score": 75,  # default
+        "love_score": 75,
+        "trust_score": 75,
+        "communication_score": 75,
+        "marriage_score": 75,
+    }
+
+    # Parse scores từ phần cuối của analysis
+    score_pattern = r"(compatibility_score|love_score|trust_score|communication_score|marriage_score):\s*(\d+)"
+    matches = re.findall(score_pattern, analysis_text, re.IGNORECASE)
+
+    for key, value in matches:
+        scores[key.lower()] = int(value)
+
+    # Loại bỏ phần SCORES khỏi analysis text
+    analysis_text = re.sub(r"SCORES:[\s\S]*$", "", analysis_text).strip()
+    return analysis_text, scores
 
 
 # -------------------------------------------------
-#  Route: Gửi lời mời ghép đôi
+#  Server-Sent Events cho các phân tích dài
 # -------------------------------------------------
-@app.route("/send-match-request", methods=["POST"])
-def send_match_request():
-    """
-    Gửi lời mời ghép đôi từ user A đến user B
-    """
-    try:
-        data = request.get_json()
-        sender_id = data.get("senderId")
-        receiver_id = data.get("receiverId")
-        message = data.get("message", "")
+SSE_REPLAY_CHUNK = 400
 
-        if not sender_id or not receiver_id:
-            return jsonify({"error": "Thiếu thông tin sender hoặc receiver"}), 400
 
-        # Lấy thông tin sender và receiver
-        sender_doc = db.collection("users").document(sender_id).get()
-        receiver_doc = db.collection("users").document(receiver_id).get()
-        if not sender_doc.exists or not receiver_doc.exists:
-            return jsonify({"error": "Không tìm thấy người gửi hoặc người nhận"}), 404
+def stream_requested(data, accept_best):
+    """Client yêu cầu stream bằng "stream": true hoặc Accept: text/event-stream"""
+    return bool(data.get("stream")) or accept_best == "text/event-stream"
 
-        sender_data = sender_doc.to_dict()
-        receiver_data = receiver_doc.to_dict()
 
-        # Kiểm tra nếu sender hoặc receiver đang trong mối quan hệ
-        if sender_data.get("partnerId"):
-            return jsonify({"error": "Bạn đang trong mối quan hệ, không thể gửi lời mời"}), 400
-        if receiver_data.get("partnerId"):
-            return jsonify({"error": "Người nhận đã trong mối quan hệ"}), 400
+def wants_stream(data):
+    return stream_requested(data, request.accept_mimetypes.best)
 
-        # Kiểm tra xem đã gửi lời mời chưa
-        existing_request = (
-            db.collection("match_requests")
-            .where("senderId", "==", sender_id)
-            .where("receiverId", "==", receiver_id)
-            .where("status", "==", "pending")
-            .limit(1)
-            .stream()
-        )
-        for doc in existing_request:
-            return jsonify({"error": "Bạn đã gửi lời mời cho người này rồi"}), 400
 
-        # Tạo request ID và lưu request
-        request_id = str(uuid.uuid4())
-        match_request = {
-            "requestId": request_id,
-            "senderId": sender_id,
-            "receiverId": receiver_id,
-            "message": message,
-            "status": "pending",
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
-        db.collection("match_requests").document(request_id).set(match_request)
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
-        # Tạo thông báo với cả top-level fields VÀ navigationData
-        notification = {
-            "id": str(uuid.uuid4()),
-            "userId": receiver_id,
-            "type": "match_request",
-            "title": f"Lời mời ghép đôi từ {sender_data.get('name', 'Người dùng')}",
-            "message": message or "Xin chào! Tôi thấy chúng ta có nhiều điểm chung...",
-            "read": False,
-            
-            # THÊM TOP-LEVEL FIELDS để dễ access
-            "requestId": request_id,
-            "senderId": sender_id,
-            "senderName": sender_data.get("name", ""),
-            "senderAvatar": sender_data.get("avatar", ""),
-            "senderAge": sender_data.get("age", 0),
-            "senderJob": sender_data.get("job", ""),
-            
-            # Giữ nguyên navigationData cho tương thích
-            "navigable": True,
-            "navigationData": {
-                "screen": "MatchRequestDetail",
-                "params": {
-                    "requestId": request_id,
-                    "senderId": sender_id,
-                    "senderName": sender_data.get("name", ""),
-                    "senderAvatar": sender_data.get("avatar", ""),
-                    "message": message,
-                    "senderAge": sender_data.get("age", 0),
-                    "senderJob": sender_data.get("job", ""),
-                }
-            },
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
-        db.collection("notifications").add(notification)
 
-        return jsonify({
-            "success": True,
-            "requestId": request_id,
-            "message": "Đã gửi lời mời ghép đôi"
-        }), 200
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    except Exception as e:
-        print(f"❌ Send match request error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
 
+def replay_sse(text, done_payload):
+    """Phát lại kết quả đã cache theo đúng định dạng stream"""
+    for i in range(0, len(text), SSE_REPLAY_CHUNK):
+        yield sse_event("chunk", {"text": text[i:i + SSE_REPLAY_CHUNK]})
+    yield sse_event("done", done_payload)
 
-# -------------------------------------------------
-#  Route: Chấp nhận lời mời ghép đôi
-# -------------------------------------------------
-@app.route("/accept-match-request", methods=["POST"])
-def accept_match_request():
+
+class StreamScrubber:
     """
-    Chấp nhận lời mời ghép đôi và tạo match
+    Lọc các đoạn Gemini trước khi gửi cho client (dùng chung cho stream sync và async):
+    - stop_marker: phần từ marker trở đi không được gửi (vẫn được gom vào text);
+      giữ lại cuối buffer đủ dài để không cắt đôi marker
+    - name: placeholder được thay bằng tên; đuôi có thể là placeholder bị cắt
+      giữa 2 đoạn được giữ lại tới đoạn sau
+    """
+
+    def __init__(self, stop_marker=None, name=None):
+        self.stop_marker = stop_marker
+        self.name = name
+        self._parts = []
+        self._pending = ""
+        self._held = ""
+        self._stopped = False
+
+    @property
+    def text(self):
+        """Toàn bộ text Gemini trả về (kể cả phần sau marker)"""
+        return "".join(self._parts)
+
+    def feed(self, piece):
+        """Nhận 1 đoạn, trả về phần gửi được ngay (có thể rỗng)"""
+        self._parts.append(piece)
+        if self._stopped:
+            return ""
+        self._pending += piece
+
+        pos = self._pending.find(self.stop_marker) if self.stop_marker else -1
+        if pos >= 0:
+            text, self._pending, self._stopped = self._pending[:pos], "", True
+            return self._personalize(text)
+
+        keep = len(self.stop_marker) - 1 if self.stop_marker else 0
+        if len(self._pending) <= keep:
+            return ""
+        cut = len(self._pending) - keep
+        text, self._pending = self._pending[:cut], self._pending[cut:]
+        return self._personalize(text)
+
+    def flush(self):
+        """Phần còn giữ lại khi stream kết thúc"""
+        text = self._personalize(self._pending) if self._pending else ""
+        text, self._pending, self._held = text + self._held, "", ""
+        return text
+
+    def _personalize(self, text):
+        if self.name is None:
+            return text
+        text, self._held = split_personalized(self._held + text, self.name)
+        return text
+
+
+def stream_analysis(prompt, finalize, stop_marker=None, name=None):
+    """
+    Chuyển tiếp các đoạn Gemini thành sự kiện SSE "chunk"; khi xong gọi
+    finalize(toàn bộ text) để lưu cache và gửi sự kiện "done" với kết quả của nó.
+    Có name thì placeholder trong các đoạn được thay bằng tên trước khi gửi.
     """
     try:
-        data = request.get_json()
-        request_id = data.get("requestId")
-        receiver_id = data.get("receiverId")
-        response_message = data.get("responseMessage", "")
+        scrubber = StreamScrubber(stop_marker, name)
+        for piece in gemini.stream(prompt):
+            text = scrubber.feed(piece)
+            if text:
+                yield sse_event("chunk", {"text": text})
 
-        if not request_id or not receiver_id:
-            return jsonify({"error": "Thiếu requestId hoặc receiverId"}), 400
+        text = scrubber.flush()
+        if text:
+            yield sse_event("chunk", {"text": text})
 
-        # Lấy thông tin match request
-        request_doc = db.collection("match_requests").document(request_id).get()
-        if not request_doc.exists:
-            return jsonify({"error": "Không tìm thấy lời mời"}), 404
+        yield sse_event("done", {**finalize(scrubber.text), "cached": False})
 
-        request_data = request_doc.to_dict()
+    except Exception as e:
+        print(f"❌ Stream error: {str(e)}")
+        yield sse_event("error", {"error": str(e)})
 
-        if request_data.get("status") != "pending":
-            return jsonify({"error": "Lời mời đã được xử lý"}), 400
 
-        sender_id = request_data.get("senderId")
+# -------------------------------------------------
+#  Cache phân tích bản đồ sao theo nội dung (hash bản đồ)
+# -------------------------------------------------
+# natal_analysis/{chart_hash}: bài phân tích dùng chung, tên thay bằng {NAME}
+# natal_analysis_users/{uid}: con trỏ uid → chart_hash hiện tại
+# Sửa hồ sơ làm đổi hash → tự dùng doc mới; 2 bản đồ giống nhau dùng chung 1 bài.
+def normalize_aspects(value):
+    """'A - B, C - D' → danh sách cặp đã sắp xếp, không phụ thuộc thứ tự liệt kê"""
+    pairs = []
+    for item in str(value or "").split(","):
+        sides = sorted(s.strip() for s in item.split(" - ") if s.strip())
+        if sides:
+            pairs.append(" - ".join(sides))
+    return sorted(pairs)
+
+
+def _normalize_ratio(value):
+    try:
+        return round(float(value or 0), 2)
+    except (TypeError, ValueError):
+        return str(value).strip()
 
-        # Cập nhật trạng thái request
-        db.collection("match_requests").document(request_id).update({
-            "status": "accepted",
-            "responseMessage": response_message,
-            "acceptedAt": firestore.SERVER_TIMESTAMP,
-        })
 
-        # Tạo match ID
-        match_id = str(uuid.uuid4())
+def natal_chart_fields(data):
+    """Các trường bản đồ sao (không gồm tên) ở dạng chuẩn hoá để băm"""
+    info = {k: str(v or "").strip() for k, v in extract_user_info(data).items() if k != "name"}
+    houses = {k: str(v or "").strip() for k, v in extract_houses(data).items()}
+    aspects = {k: normalize_aspects(v) for k, v in extract_aspects(data).items()}
+    elements = {k: _normalize_ratio(v) for k, v in extract_elements(data).items()}
+    return {**info, **houses, **aspects, **elements}
 
-        # Tạo match record
-        match_record = {
-            "matchId": match_id,
-            "user1": sender_id,
-            "user2": receiver_id,
-            "requestId": request_id,
-            "createdAt": firestore.SERVER_TIMESTAMP,
-            "status": "active"
-        }
 
-        db.collection("matches").document(match_id).set(match_record)
+def natal_chart_hash(data):
+    return make_cache_key("natal_chart", natal_chart_fields(data))
 
-        # Cập nhật relationshipStatus thành "Đã có đôi"
-        db.collection("users").document(sender_id).update({
-            "relationshipStatus": "Đã có đôi",
-            "partnerId": receiver_id,
-            "matchId": match_id,
-            "updatedAt": firestore.SERVER_TIMESTAMP,
-        })
 
-        db.collection("users").document(receiver_id).update({
-            "relationshipStatus": "Đã có đôi",
-            "partnerId": sender_id,
-            "matchId": match_id,
-            "updatedAt": firestore.SERVER_TIMESTAMP,
-        })
+def natal_analysis_doc(chart_hash, data, analysis_text):
+    return {
+        "chart_hash": chart_hash,
+        "analysis": analysis_text,
+        "created_at": datetime.now().isoformat(),
+        "user_data": {
+            **{k: v for k, v in extract_user_info(data).items() if k != "name"},
+            **extract_houses(data), **extract_aspects(data), **extract_elements(data),
+        },
+    }
 
-        # Lấy thông tin cả 2 người
-        sender_doc = db.collection("users").document(sender_id).get()
-        receiver_doc = db.collection("users").document(receiver_id).get()
-        
-        sender_data = sender_doc.to_dict()
-        receiver_data = receiver_doc.to_dict()
-
-        # Tạo thông báo chúc mừng cho NGƯỜI GỬI 
-        notification_for_sender = {
-            "id": str(uuid.uuid4()),
-            "userId": sender_id,
-            "type": "match_accepted",
-            "title": "🎉 Chúc mừng! Bạn đã có đôi!",
-            "message": f"{receiver_data.get('name', 'Người dùng')} đã chấp nhận lời mời của bạn. {response_message}",
-            "read": False,
-            "navigable": True,
-            "navigationData": {
-                "screen": "Chat",
-                "params": {
-                    "matchId": match_id,
-                    "partnerId": receiver_id,
-                    "partnerName": receiver_data.get("name", ""),
-                }
-            },
+
+def natal_pointer_doc(chart_hash, name):
+    return {"chart_hash": chart_hash, "name": name, "updated_at": datetime.now().isoformat()}
+
+
+def split_personalized(text, name):
+    """
+    Thay placeholder bằng tên; trả về (phần gửi được, phần giữ lại) với phần
+    giữ lại là đuôi có thể là placeholder bị cắt giữa 2 đoạn stream.
+    """
+    text = text.replace(NAME_PLACEHOLDER, name)
+    cut = text.rfind(NAME_PLACEHOLDER[0])
+    if cut >= 0 and NAME_PLACEHOLDER.startswith(text[cut:]):
+        return text[:cut], text[cut:]
+    return text, ""
+
+
+def natal_request(data):
+    """Đọc body của /natal-analysis (dùng chung cho Flask và ASGI): hash bản đồ + prompt dùng placeholder"""
+    user_info = extract_user_info(data)
+    if not user_info["name"] or not user_info["sun"] or not user_info["moon"]:
+        raise RequestError("Thiếu thông tin cơ bản")
+
+    chart_hash = natal_chart_hash(data)
+    # Prompt dùng placeholder thay cho tên để bài phân tích dùng chung được
+    prompt = build_natal_prompt(
+        {**user_info, "name": NAME_PLACEHOLDER},
+        extract_houses(data), extract_aspects(data), extract_elements(data),
+    )
+    return {
+        "uid": data.get("uid", ""),
+        "name": user_info["name"],
+        "chart_hash": chart_hash,
+        "flight_key": make_cache_key("natal", chart_hash),
+        "prompt": prompt,
+    }
+
+
+def natal_lookup(snapshots, analysis_path):
+    """Kết quả get_all(bài phân tích, con trỏ uid) → (dữ liệu hoặc None, hash cũ hoặc None)"""
+    analysis, pointer_hash = None, None
+    for doc in snapshots:
+        if not doc.exists:
+            continue
+        if doc.reference.path == analysis_path:
+            analysis = doc.to_dict()
+        else:
+            pointer_hash = doc.to_dict().get("chart_hash")
+    return analysis, pointer_hash
+
+
+def natal_payload(analysis_text, name, cached):
+    return {"analysis": analysis_text.replace(NAME_PLACEHOLDER, name), "cached": cached}
+
+
+def get_natal_analysis(uid, chart_hash):
+    """Doc phân tích + con trỏ của uid trong 1 lượt get_all"""
+    analysis_ref = db.collection("natal_analysis").document(chart_hash)
+    refs = [analysis_ref]
+    if uid:
+        refs.append(db.collection("natal_analysis_users").document(uid))
+    return natal_lookup(db.get_all(refs), analysis_ref.path)
+
+
+def set_natal_pointer(uid, chart_hash, name):
+    db.collection("natal_analysis_users").document(uid).set(natal_pointer_doc(chart_hash, name))
+
+
+def save_natal_analysis(uid, chart_hash, data, analysis_text):
+    batch = db.batch()
+    batch.set(
+        db.collection("natal_analysis").document(chart_hash),
+        natal_analysis_doc(chart_hash, data, analysis_text),
+    )
+    if uid:
+        batch.set(
+            db.collection("natal_analysis_users").document(uid),
+            natal_pointer_doc(chart_hash, data.get("name", "")),
+        )
+    batch.commit()
+
+
+# -------------------------------------------------
+#  Route phân tích bản đồ sao
+# -------------------------------------------------
+@app.route("/natal-analysis", methods=["POST"])
+def natal_chart_analysis():
+    """
+    Phân tích chi tiết bản đồ sao dựa trên thông tin chiêm tinh
+    """
+    try:
+        data = request.get_json()
+        req = natal_request(data)
+        uid, name, chart_hash = req["uid"], req["name"], req["chart_hash"]
+
+        # Point read theo hash bản đồ (+ con trỏ của uid) thay cho query theo uid
+        cached_data, pointer_hash = get_natal_analysis(uid, chart_hash)
+
+        if cached_data:
+            print(f"✅ Cache phân tích có sẵn cho {name} ({uid})")
+            if uid and pointer_hash != chart_hash:
+                set_natal_pointer(uid, chart_hash, name)
+            payload = natal_payload(cached_data.get("analysis", ""), name, True)
+            if wants_stream(data):
+                return sse_response(replay_sse(payload["analysis"], payload))
+            return jsonify(payload)
+
+        print(f"⚙️ Không có cache → Gọi Gemini để phân tích")
+
+        def save_analysis(analysis_text):
+            # Lưu bài dùng chung theo hash + con trỏ uid → hash
+            analysis_text = clean_analysis_text(analysis_text)
+            save_natal_analysis(uid, chart_hash, data, analysis_text)
+            print(f"✅ Đã lưu phân tích cho {name} ({uid})")
+            return analysis_text
+
+        # Stream từng đoạn cho client (đã thay tên), lưu cache khi đã nhận đủ
+        if wants_stream(data):
+            finalize = lambda text: natal_payload(save_analysis(text), name, False)
+            return sse_response(stream_analysis(req["prompt"], finalize, name=name))
+
+        # Request trùng cho cùng bản đồ đang chạy → dùng chung kết quả
+        analysis_text, shared = gemini_flight.do(
+            req["flight_key"], lambda: save_analysis(gemini.generate(req["prompt"]))
+        )
+        return jsonify(natal_payload(analysis_text, name, shared)), 200
+
+    except RequestError as e:
+        return jsonify({"error": e.message}), e.status
+    except GeminiUnavailable as e:
+        return gemini_unavailable(e)
+    except Exception as e:
+        print(f"❌ Error in natal analysis: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Thông báo: users/{uid}/notifications (payload gọn + TTL)
+# -------------------------------------------------
+# Firestore TTL policy đặt trên collection group "notifications", trường expireAt
+NOTIFICATION_TTL_DAYS = int(os.getenv("NOTIFICATION_TTL_DAYS", "30"))
+notification_bus = NotificationBus()
+
+
+def notifications_of(uid):
+    return db.collection("users").document(uid).collection("notifications")
+
+
+def notification_ref(uid, notif_id=None):
+    """Ref tới 1 thông báo của user (không truyền id → id ngẫu nhiên cho doc mới)"""
+    collection = notifications_of(uid)
+    return collection.document(notif_id) if notif_id else collection.document()
+
+
+def build_notification(notif_type, title, message, screen=None, params=None):
+    """
+    Payload gọn: tham số điều hướng chỉ lưu 1 lần trong navigationData.params,
+    expireAt để Firestore tự xoá thông báo cũ
+    """
+    notification = {
+        "type": notif_type,
+        "title": title,
+        "message": message,
+        "read": False,
+        "navigable": bool(screen),
+        "createdAt": firestore.SERVER_TIMESTAMP,
+        "expireAt": datetime.now(timezone.utc) + timedelta(days=NOTIFICATION_TTL_DAYS),
+    }
+    if screen:
+        notification["navigationData"] = {"screen": screen, "params": params or {}}
+    return notification
+
+
+def add_notification(transaction, outbox, uid, notification):
+    """Ghi thông báo trong transaction, đồng thời giữ lại để đẩy realtime sau khi commit"""
+    ref = notification_ref(uid)
+    transaction.set(ref, notification)
+    outbox.append((uid, ref.id, notification))
+
+
+def publish_notifications(outbox):
+    """Đẩy các thông báo vừa ghi tới client đang mở /notifications/stream"""
+    now = datetime.now()
+    for uid, notif_id, notification in outbox:
+        event = {k: v for k, v in notification.items() if k != "createdAt"}
+        event = decorate_notification(notif_id, event, now)
+        event["createdAt"] = now.isoformat()
+        notification_bus.publish(uid, event)
+
+
+def hoist_notification_params(notif_data):
+    """Khi đọc: đưa params lên top-level để client vẫn dùng được notif.senderName, notif.requestId..."""
+    params = (notif_data.get("navigationData") or {}).get("params") or {}
+    for key, value in params.items():
+        notif_data.setdefault(key, value)
+    return notif_data
+
+
+# -------------------------------------------------
+#  Route: Gửi lời mời ghép đôi
+# -------------------------------------------------
+@app.route("/send-match-request", methods=["POST"])
+def send_match_request():
+    """
+    Gửi lời mời ghép đôi từ user A đến user B
+    """
+    try:
+        data = request.get_json()
+        sender_id = data.get("senderId")
+        receiver_id = data.get("receiverId")
+        message = data.get("message", "")
+
+        if not sender_id or not receiver_id:
+            return jsonify({"error": "Thiếu thông tin sender hoặc receiver"}), 400
+
+        def has_pending_request():
+            existing_request = (
+                db.collection("match_requests")
+                .where("senderId", "==", sender_id)
+                .where("receiverId", "==", receiver_id)
+                .where("status", "==", "pending")
+                .limit(1)
+                .stream()
+            )
+            return any(True for _ in existing_request)
+
+        # Lấy sender + receiver và kiểm tra lời mời đang chờ song song
+        (sender_data, receiver_data), already_sent = run_concurrently(
+            lambda: get_user_profiles(sender_id, receiver_id), has_pending_request
+        )
+        if sender_data is None or receiver_data is None:
+            return jsonify({"error": "Không tìm thấy người gửi hoặc người nhận"}), 404
+
+        # Kiểm tra nếu sender hoặc receiver đang trong mối quan hệ
+        if sender_data.get("partnerId"):
+            return jsonify({"error": "Bạn đang trong mối quan hệ, không thể gửi lời mời"}), 400
+        if receiver_data.get("partnerId"):
+            return jsonify({"error": "Người nhận đã trong mối quan hệ"}), 400
+
+        # Kiểm tra xem đã gửi lời mời chưa
+        if already_sent:
+            return jsonify({"error": "Bạn đã gửi lời mời cho người này rồi"}), 400
+
+        # Tạo request ID và lưu request
+        request_id = str(uuid.uuid4())
+        match_request = {
+            "requestId": request_id,
+            "senderId": sender_id,
+            "receiverId": receiver_id,
+            "message": message,
+            "status": "pending",
             "createdAt": firestore.SERVER_TIMESTAMP,
         }
+        db.collection("match_requests").document(request_id).set(match_request)
+
+        # Thông báo cho người nhận: thông tin sender chỉ lưu 1 lần trong params
+        notification = build_notification(
+            "match_request",
+            f"Lời mời ghép đôi từ {sender_data.get('name', 'Người dùng')}",
+            message or "Xin chào! Tôi thấy chúng ta có nhiều điểm chung...",
+            screen="MatchRequestDetail",
+            params={
+                "requestId": request_id,
+                "senderId": sender_id,
+                "senderName": sender_data.get("name", ""),
+                "senderAvatar": sender_data.get("avatar", ""),
+                "message": message,
+                "senderAge": sender_data.get("age", 0),
+                "senderJob": sender_data.get("job", ""),
+            },
+        )
+        ref = notification_ref(receiver_id)
+        ref.set(notification)
+        publish_notifications([(receiver_id, ref.id, notification)])
+
+        return jsonify({
+            "success": True,
+            "requestId": request_id,
+            "message": "Đã gửi lời mời ghép đôi"
+        }), 200
+
+    except Exception as e:
+        print(f"❌ Send match request error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Ghi nguyên tử cho các luồng ghép đôi (1 transaction)
+# -------------------------------------------------
+class MatchFlowError(Exception):
+    """Lỗi nghiệp vụ phát hiện trong transaction → trả về client với status tương ứng"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def get_docs_in_transaction(transaction, refs):
+    """Đọc nhiều doc trong 1 RPC (get_all), trả về list dict | None theo đúng thứ tự refs"""
+    snaps = {snap.reference.path: snap for snap in transaction.get_all(refs)}
+    return [
+        snaps[ref.path].to_dict() if ref.path in snaps and snaps[ref.path].exists else None
+        for ref in refs
+    ]
+
+
+def patch_profiles(patches):
+    """Sau khi transaction commit thành công mới ghi xuyên vào index"""
+    for uid, fields in patches.items():
+        profile_index.patch(uid, fields)
+
+
+# -------------------------------------------------
+#  Route: Chấp nhận lời mời ghép đôi
+# -------------------------------------------------
+@app.route("/accept-match-request", methods=["POST"])
+def accept_match_request():
+    """
+    Chấp nhận lời mời ghép đôi và tạo match
+    (đọc request + 2 user và ghi mọi thay đổi trong 1 transaction)
+    """
+    try:
+        data = request.get_json()
+        request_id = data.get("requestId")
+        receiver_id = data.get("receiverId")
+        response_message = data.get("responseMessage", "")
+
+        if not request_id or not receiver_id:
+            return jsonify({"error": "Thiếu requestId hoặc receiverId"}), 400
+
+        request_ref = db.collection("match_requests").document(request_id)
+        receiver_ref = db.collection("users").document(receiver_id)
+
+        outbox = []
+
+        @firestore.transactional
+        def accept(transaction):
+            outbox.clear()
+            # Lấy match request và người nhận trong cùng 1 lần đọc
+            request_data, receiver_data = get_docs_in_transaction(transaction, [request_ref, receiver_ref])
+            if request_data is None:
+                raise MatchFlowError("Không tìm thấy lời mời", 404)
+            if request_data.get("status") != "pending":
+                raise MatchFlowError("Lời mời đã được xử lý")
+
+            sender_id = request_data.get("senderId")
+            sender_data, = get_docs_in_transaction(transaction, [db.collection("users").document(sender_id)])
+            if sender_data is None or receiver_data is None:
+                raise MatchFlowError("Không tìm thấy người gửi hoặc người nhận", 404)
+            if sender_data.get("partnerId") or receiver_data.get("partnerId"):
+                raise MatchFlowError("Một trong hai người đã có đôi")
+
+            # Cập nhật trạng thái request
+            transaction.update(request_ref, {
+                "status": "accepted",
+                "responseMessage": response_message,
+                "acceptedAt": firestore.SERVER_TIMESTAMP,
+            })
+
+            # Tạo match record
+            match_id = str(uuid.uuid4())
+            transaction.set(db.collection("matches").document(match_id), {
+                "matchId": match_id,
+                "user1": sender_id,
+                "user2": receiver_id,
+                "requestId": request_id,
+                "createdAt": firestore.SERVER_TIMESTAMP,
+                "status": "active"
+            })
 
-        # Tạo thông báo chúc mừng cho NGƯỜI NHẬN 
-        notification_for_receiver = {
-            "id": str(uuid.uuid4()),
-            "userId": receiver_id,
-            "type": "match_accepted",
-            "title": "🎉 Chúc mừng! Bạn đã có đôi!",
-            "message": f"Bạn và {sender_data.get('name', 'Người dùng')} đã chính thức trở thành một cặp. Hãy bắt đầu hành trình tình yêu nhé!",
-            "read": False,
-            "navigable": True,
-            "navigationData": {
-                "screen": "Chat",
-                "params": {
+            # Cập nhật relationshipStatus thành "Đã có đôi"
+            patches = {
+                sender_id: {
+                    "relationshipStatus": "Đã có đôi",
+                    "partnerId": receiver_id,
+                    "matchId": match_id,
+                    "updatedAt": firestore.SERVER_TIMESTAMP,
+                },
+                receiver_id: {
+                    "relationshipStatus": "Đã có đôi",
+                    "partnerId": sender_id,
+                    "matchId": match_id,
+                    "updatedAt": firestore.SERVER_TIMESTAMP,
+                },
+            }
+            for uid, fields in patches.items():
+                transaction.update(db.collection("users").document(uid), fields)
+
+            # Thông báo chúc mừng cho NGƯỜI GỬI
+            add_notification(transaction, outbox, sender_id, build_notification(
+                "match_accepted",
+                "🎉 Chúc mừng! Bạn đã có đôi!",
+                f"{receiver_data.get('name', 'Người dùng')} đã chấp nhận lời mời của bạn. {response_message}",
+                screen="Chat",
+                params={
+                    "matchId": match_id,
+                    "partnerId": receiver_id,
+                    "partnerName": receiver_data.get("name", ""),
+                },
+            ))
+
+            # Thông báo chúc mừng cho NGƯỜI NHẬN
+            add_notification(transaction, outbox, receiver_id, build_notification(
+                "match_accepted",
+                "🎉 Chúc mừng! Bạn đã có đôi!",
+                f"Bạn và {sender_data.get('name', 'Người dùng')} đã chính thức trở thành một cặp. Hãy bắt đầu hành trình tình yêu nhé!",
+                screen="Chat",
+                params={
                     "matchId": match_id,
                     "partnerId": sender_id,
                     "partnerName": sender_data.get("name", ""),
-                }
-            },
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
+                },
+            ))
+
+            return sender_id, match_id, patches
 
-        # Gửi cả 2 thông báo
-        db.collection("notifications").add(notification_for_sender)
-        db.collection("notifications").add(notification_for_receiver)
+        try:
+            sender_id, match_id, patches = accept(db.transaction())
+        except MatchFlowError as e:
+            return jsonify({"error": e.message}), e.status
 
+        patch_profiles(patches)
+        publish_notifications(outbox)
         print(f"✅ Match thành công: {sender_id} <-> {receiver_id}")
 
         return jsonify({
@@ -861,12 +2089,13 @@ def accept_match_request():
 
 
 # -------------------------------------------------
-#  Route: Từ chối lời mời ghép đôi 
+#  Route: Từ chối lời mời ghép đôi
 # -------------------------------------------------
 @app.route("/reject-match-request", methods=["POST"])
 def reject_match_request():
     """
     Từ chối lời mời ghép đôi
+    (đọc request + người nhận và ghi trong 1 transaction)
     """
     try:
         data = request.get_json()
@@ -877,42 +2106,43 @@ def reject_match_request():
         if not request_id or not receiver_id:
             return jsonify({"error": "Thiếu requestId hoặc receiverId"}), 400
 
-        # Lấy thông tin match request
-        request_doc = db.collection("match_requests").document(request_id).get()
-        if not request_doc.exists:
-            return jsonify({"error": "Không tìm thấy lời mời"}), 404
+        request_ref = db.collection("match_requests").document(request_id)
+        receiver_ref = db.collection("users").document(receiver_id)
 
-        request_data = request_doc.to_dict()
+        outbox = []
 
-        if request_data.get("status") != "pending":
-            return jsonify({"error": "Lời mời đã được xử lý"}), 400
+        @firestore.transactional
+        def reject(transaction):
+            outbox.clear()
+            request_data, receiver_data = get_docs_in_transaction(transaction, [request_ref, receiver_ref])
+            if request_data is None:
+                raise MatchFlowError("Không tìm thấy lời mời", 404)
+            if request_data.get("status") != "pending":
+                raise MatchFlowError("Lời mời đã được xử lý")
 
-        sender_id = request_data.get("senderId")
+            sender_id = request_data.get("senderId")
+            receiver_data = receiver_data or {}
 
-        # Cập nhật trạng thái request
-        db.collection("match_requests").document(request_id).update({
-            "status": "rejected",
-            "rejectedAt": firestore.SERVER_TIMESTAMP,
-            "rejectionMessage": rejection_message,
-        })
+            # Cập nhật trạng thái request
+            transaction.update(request_ref, {
+                "status": "rejected",
+                "rejectedAt": firestore.SERVER_TIMESTAMP,
+                "rejectionMessage": rejection_message,
+            })
 
-        # Lấy thông tin người nhận để gửi thông báo
-        receiver_doc = db.collection("users").document(receiver_id).get()
-        receiver_data = receiver_doc.to_dict()
-
-        # Tạo thông báo cho NGƯỜI GỬI (sender) về việc bị từ chối
-        notification_for_sender = {
-            "id": str(uuid.uuid4()),
-            "userId": sender_id,
-            "type": "match_rejected",
-            "title": "Lời mời bị từ chối",
-            "message": f"{receiver_data.get('name', 'Người dùng')} đã từ chối lời mời ghép đôi của bạn. {rejection_message}",
-            "read": False,
-            "navigable": False,
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
+            # Thông báo cho NGƯỜI GỬI (sender) về việc bị từ chối
+            add_notification(transaction, outbox, sender_id, build_notification(
+                "match_rejected",
+                "Lời mời bị từ chối",
+                f"{receiver_data.get('name', 'Người dùng')} đã từ chối lời mời ghép đôi của bạn. {rejection_message}",
+            ))
+
+        try:
+            reject(db.transaction())
+        except MatchFlowError as e:
+            return jsonify({"error": e.message}), e.status
 
-        db.collection("notifications").add(notification_for_sender)
+        publish_notifications(outbox)
 
         print(f"✅ Đã từ chối lời mời {request_id} và thông báo cho sender")
 
@@ -924,99 +2154,112 @@ def reject_match_request():
     except Exception as e:
         print(f"❌ Reject match error: {str(e)}")
         return jsonify({"error": str(e)}), 500
-    
+
 
 # -------------------------------------------------
-#  Route: Chia tay 
+#  Route: Chia tay
 # -------------------------------------------------
 @app.route("/breakup", methods=["POST"])
 def breakup():
     """
     Chia tay với partner (đơn phương, không cần chấp thuận)
+    (đọc 2 user và ghi match/user/thông báo trong 1 transaction)
     """
     try:
         data = request.get_json()
         user_id = data.get("userId")
         breakup_message = data.get("breakupMessage", "")  # Lý do chia tay (optional)
-        
+
         if not user_id:
             return jsonify({"error": "Thiếu userId"}), 400
-            
-        user_doc = db.collection("users").document(user_id).get()
-        if not user_doc.exists:
-            return jsonify({"error": "Không tìm thấy user"}), 404
-            
-        user_data = user_doc.to_dict()
-        user_name = user_data.get("name", "Người yêu")
-        match_id = user_data.get("matchId")
-        partner_id = user_data.get("partnerId")
-        
-        if not match_id or not partner_id:
-            return jsonify({"error": "Bạn chưa có người yêu"}), 400
-            
-        # Lấy thông tin partner để tạo notification
-        partner_doc = db.collection("users").document(partner_id).get()
-        partner_data = partner_doc.to_dict() if partner_doc.exists else {}
-        
-        # Cập nhật status match thành "ended"
-        db.collection("matches").document(match_id).update({
-            "status": "ended",
-            "endedAt": firestore.SERVER_TIMESTAMP,
-            "endedBy": user_id,
-            "breakupMessage": breakup_message,
-        })
-        
-        # Reset relationship status về "Độc thân"
-        db.collection("users").document(user_id).update({
-            "relationshipStatus": "Độc thân",
-            "partnerId": firestore.DELETE_FIELD,
-            "matchId": firestore.DELETE_FIELD,
-            "updatedAt": firestore.SERVER_TIMESTAMP,
-        })
-        
-        db.collection("users").document(partner_id).update({
-            "relationshipStatus": "Độc thân",
-            "partnerId": firestore.DELETE_FIELD,
-            "matchId": firestore.DELETE_FIELD,
-            "updatedAt": firestore.SERVER_TIMESTAMP,
-        })
-        
-        # Tạo thông báo cho PARTNER (người bị chia tay)
-        partner_notification = {
-            "id": str(uuid.uuid4()),
-            "userId": partner_id,
-            "type": "breakup",
-            "title": "💔 Mối quan hệ đã kết thúc",
-            "message": f"{user_name} đã chia tay với bạn." + (f" Lý do: {breakup_message}" if breakup_message else ""),
-            "read": False,
-            "navigable": False,
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
-        db.collection("notifications").add(partner_notification)
-        
-        
-        user_notification = {
-            "id": str(uuid.uuid4()),
-            "userId": user_id,
-            "type": "breakup_confirmation",
-            "title": "💔 Đã chia tay",
-            "message": f"Bạn đã kết thúc mối quan hệ với {partner_data.get('name', 'người yêu')}",
-            "read": False,
-            "navigable": False,
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        }
-        db.collection("notifications").add(user_notification)
-        
+
+        user_ref = db.collection("users").document(user_id)
+
+        # Đoán partner từ index để đọc cả 2 user trong cùng 1 get_all
+        indexed_user = profile_index.get(user_id) if use_profile_index() else None
+        guessed_partner_id = (indexed_user or {}).get("partnerId")
+
+        outbox = []
+
+        @firestore.transactional
+        def end_relationship(transaction):
+            outbox.clear()
+            refs = [user_ref]
+            if guessed_partner_id:
+                refs.append(db.collection("users").document(guessed_partner_id))
+            user_data, *guessed = get_docs_in_transaction(transaction, refs)
+            if user_data is None:
+                raise MatchFlowError("Không tìm thấy user", 404)
+
+            user_name = user_data.get("name", "Người yêu")
+            match_id = user_data.get("matchId")
+            partner_id = user_data.get("partnerId")
+
+            if not match_id or not partner_id:
+                raise MatchFlowError("Bạn chưa có người yêu")
+
+            # Lấy thông tin partner để tạo notification (đọc thêm nếu đoán sai)
+            if partner_id == guessed_partner_id:
+                partner_data = guessed[0]
+            else:
+                partner_data, = get_docs_in_transaction(transaction, [db.collection("users").document(partner_id)])
+            partner_data = partner_data or {}
+
+            # Cập nhật status match thành "ended"
+            transaction.update(db.collection("matches").document(match_id), {
+                "status": "ended",
+                "endedAt": firestore.SERVER_TIMESTAMP,
+                "endedBy": user_id,
+                "breakupMessage": breakup_message,
+            })
+
+            # Reset relationship status về "Độc thân"
+            single = {
+                "relationshipStatus": "Độc thân",
+                "partnerId": firestore.DELETE_FIELD,
+                "matchId": firestore.DELETE_FIELD,
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            }
+            patches = {user_id: dict(single)}
+            transaction.update(user_ref, single)
+            # Partner đã chia tay / ghép với người khác thì không động vào hồ sơ của họ
+            if partner_data.get("partnerId") == user_id:
+                patches[partner_id] = dict(single)
+                transaction.update(db.collection("users").document(partner_id), single)
+
+            # Thông báo cho PARTNER (người bị chia tay)
+            add_notification(transaction, outbox, partner_id, build_notification(
+                "breakup",
+                "💔 Mối quan hệ đã kết thúc",
+                f"{user_name} đã chia tay với bạn." + (f" Lý do: {breakup_message}" if breakup_message else ""),
+            ))
+
+            add_notification(transaction, outbox, user_id, build_notification(
+                "breakup_confirmation",
+                "💔 Đã chia tay",
+                f"Bạn đã kết thúc mối quan hệ với {partner_data.get('name', 'người yêu')}",
+            ))
+
+            return patches
+
+        try:
+            patches = end_relationship(db.transaction())
+        except MatchFlowError as e:
+            return jsonify({"error": e.message}), e.status
+
+        patch_profiles(patches)
+        publish_notifications(outbox)
+
         return jsonify({
             "success": True,
             "message": "Đã chia tay thành công"
         }), 200
-        
+
     except Exception as e:
         print(f"❌ Breakup error: {str(e)}")
         return jsonify({"error": str(e)}), 500
-    
-    
+
+
 # -------------------------------------------------
 #  Route: Kiểm tra status của match request
 # -------------------------------------------------
@@ -1083,9 +2326,8 @@ def check_match_status():
             }), 200
 
         # Kiểm tra xem đã ghép đôi thành công chưa
-        user_doc = db.collection("users").document(user_id).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data = get_user_profile(user_id)
+        if user_data is not None:
             if user_data.get("partnerId") == target_id:
                 return jsonify({
                     "success": True,
@@ -1109,85 +2351,99 @@ def check_match_status():
 # -------------------------------------------------
 #  Route: Lấy danh sách thông báo
 # ------------------------------------------------
+NOTIFICATION_PAGE_SIZE = 50
+NOTIFICATION_PAGE_MAX = 100
+
+NOTIFICATION_ICONS = {
+    "match_request": "favorite",
+    "match_accepted": "check-circle",
+    "match_rejected": "cancel",
+    "breakup": "heart-broken",
+    "prediction": "stars",
+    "love": "favorite",
+}
+
+
+def relative_time(created_at, now):
+    """createdAt → "x ngày/giờ/phút trước" so với mốc now (tính 1 lần cho cả trang)"""
+    if not created_at:
+        return "Vừa xong"
+    if hasattr(created_at, "timestamp"):
+        created_at = datetime.fromtimestamp(created_at.timestamp())
+    elif not isinstance(created_at, datetime):
+        return "Vừa xong"
+
+    time_diff = now - created_at
+    if time_diff.days > 0:
+        return f"{time_diff.days} ngày trước"
+    if time_diff.seconds // 3600 > 0:
+        return f"{time_diff.seconds // 3600} giờ trước"
+    if time_diff.seconds // 60 > 0:
+        return f"{time_diff.seconds // 60} phút trước"
+    return "Vừa xong"
+
+
+def decorate_notification(doc_id, notif_data, now):
+    hoist_notification_params(notif_data)
+    notif_data.pop("expireAt", None)
+    notif_data["id"] = doc_id
+    notif_data["time"] = relative_time(notif_data.get("createdAt"), now)
+    notif_data["icon"] = NOTIFICATION_ICONS.get(notif_data.get("type"), "notifications")
+    notif_data.setdefault("read", False)
+    return notif_data
+
+
 @app.route("/get-notifications", methods=["GET"])
 def get_notifications():
     """
-    Lấy tất cả thông báo của một user
+    Lấy thông báo của một user, mới nhất trước, phân trang bằng cursor
+    Query: userId, limit (mặc định 50, tối đa 100), startAfter (id thông báo cuối trang trước)
     """
     try:
         user_id = request.args.get("userId")
+        start_after = request.args.get("startAfter")
 
         if not user_id:
             return jsonify({"error": "Thiếu userId"}), 400
 
+        try:
+            limit = int(request.args.get("limit", NOTIFICATION_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "limit không hợp lệ"}), 400
+        limit = max(1, min(limit, NOTIFICATION_PAGE_MAX))
+
         print(f"🔍 Fetching notifications for user: {user_id}")
 
-        # Lấy notifications từ Firestore
-        notifications_ref = db.collection("notifications").where("userId", "==", user_id)
-        
+        # Sắp xếp + giới hạn ngay trên Firestore (subcollection của user → chỉ cần index đơn)
+        query = notifications_of(user_id).order_by("createdAt", direction=firestore.Query.DESCENDING)
+
+        if start_after:
+            cursor_doc = notification_ref(user_id, start_after).get()
+            if not cursor_doc.exists:
+                return jsonify({"error": "startAfter không hợp lệ"}), 400
+            query = query.start_after(cursor_doc)
+
+        docs = list(query.limit(limit).stream())
+
+        now = datetime.now()
         notifications = []
-        docs = list(notifications_ref.stream())
-        
-        # Sắp xếp sau khi lấy dữ liệu
-        sorted_docs = sorted(
-            docs, 
-            key=lambda x: x.to_dict().get("createdAt", datetime.min),
-            reverse=True
-        )[:50]
-
-        for doc in sorted_docs:
+        for doc in docs:
             try:
-                notif_data = doc.to_dict()
-                notif_data["id"] = doc.id
-
-                # Xử lý timestamp
-                if "createdAt" in notif_data and notif_data["createdAt"]:
-                    created_at = notif_data["createdAt"]
-                    
-                    if hasattr(created_at, 'timestamp'):
-                        created_at = datetime.fromtimestamp(created_at.timestamp())
-                    elif not isinstance(created_at, datetime):
-                        created_at = datetime.now()
-                    
-                    time_diff = datetime.now() - created_at
-
-                    if time_diff.days > 0:
-                        notif_data["time"] = f"{time_diff.days} ngày trước"
-                    elif time_diff.seconds // 3600 > 0:
-                        notif_data["time"] = f"{time_diff.seconds // 3600} giờ trước"
-                    elif time_diff.seconds // 60 > 0:
-                        notif_data["time"] = f"{time_diff.seconds // 60} phút trước"
-                    else:
-                        notif_data["time"] = "Vừa xong"
-                else:
-                    notif_data["time"] = "Vừa xong"
-
-                # Thêm icon cho match_rejected và breakup
-                icon_map = {
-                    "match_request": "favorite",
-                    "match_accepted": "check-circle",
-                    "match_rejected": "cancel",
-                    "breakup": "heart-broken",
-                    "prediction": "stars",
-                    "love": "favorite",
-                }
-                notif_data["icon"] = icon_map.get(notif_data.get("type"), "notifications")
-
-                if "read" not in notif_data:
-                    notif_data["read"] = False
-
-                notifications.append(notif_data)
-                
+                notifications.append(decorate_notification(doc.id, doc.to_dict(), now))
             except Exception as item_error:
                 print(f"⚠️ Error processing notification {doc.id}: {str(item_error)}")
                 continue
 
+        # Trang đầy → có thể còn trang sau
+        next_cursor = docs[-1].id if len(docs) == limit else None
+
         print(f"✅ Found {len(notifications)} notifications")
 
         return jsonify({
             "success": True,
             "notifications": notifications,
-            "count": len(notifications)
+            "count": len(notifications),
+            "nextCursor": next_cursor
         }), 200
 
     except Exception as e:
@@ -1195,11 +2451,67 @@ def get_notifications():
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
-    
+
+
+# -------------------------------------------------
+#  Route: Stream thông báo realtime (SSE)
+# -------------------------------------------------
+NOTIFICATION_STREAM_HEARTBEAT = 25
+# Trên server Flask (threaded) mỗi kết nối SSE giữ nguyên 1 thread suốt phiên
+# → giới hạn số kết nối để không chiếm hết thread của các route khác.
+# Chạy qua asgi_app (uvicorn) thì stream do Quart phục vụ, không tốn thread.
+NOTIFICATION_STREAM_MAX = int(os.getenv("NOTIFICATION_STREAM_MAX", "64"))
+
+
+@app.route("/notifications/stream", methods=["GET"])
+def notification_stream():
+    """
+    Giữ kết nối SSE theo userId; mỗi thông báo mới được đẩy thành sự kiện "notification"
+    (comment ping định kỳ để proxy không cắt kết nối rảnh)
+    """
+    user_id = request.args.get("userId")
+    if not user_id:
+        return jsonify({"error": "Thiếu userId"}), 400
+
+    subscription = notification_bus.subscribe(user_id, max_connections=NOTIFICATION_STREAM_MAX)
+    if subscription is None:
+        return jsonify({"error": "Quá nhiều kết nối realtime, thử lại sau"}), 503
+
+    def events():
+        try:
+            yield sse_event("ready", {"userId": user_id})
+            while True:
+                try:
+                    event = subscription.get(timeout=NOTIFICATION_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield sse_event("notification", event)
+        finally:
+            notification_bus.unsubscribe(user_id, subscription)
+
+    return sse_response(events())
+
 
 # -------------------------------------------------
 #  Route: Đánh dấu thông báo đã đọc
 # -------------------------------------------------
+FIRESTORE_BATCH_LIMIT = 500
+
+READ_UPDATE = {"read": True, "readAt": firestore.SERVER_TIMESTAMP}
+
+
+def _update_in_batches(refs, fields, batch_size=FIRESTORE_BATCH_LIMIT):
+    """Cập nhật nhiều doc bằng WriteBatch, mỗi lô tối đa 500 thao tác (giới hạn Firestore)"""
+    refs = list(refs)
+    for i in range(0, len(refs), batch_size):
+        batch = db.batch()
+        for ref in refs[i:i + batch_size]:
+            batch.update(ref, fields)
+        batch.commit()
+    return len(refs)
+
+
 @app.route("/mark-notification-read", methods=["POST"])
 def mark_notification_read():
     """
@@ -1207,21 +2519,23 @@ def mark_notification_read():
     """
     try:
         data = request.get_json()
+        user_id = data.get("userId")
         notification_ids = data.get("notificationIds", [])
 
-        if not notification_ids:
-            return jsonify({"error": "Thiếu notificationIds"}), 400
+        if not user_id or not notification_ids:
+            return jsonify({"error": "Thiếu userId hoặc notificationIds"}), 400
 
-        # Cập nhật từng thông báo
-        for notif_id in notification_ids:
-            db.collection("notifications").document(notif_id).update({
-                "read": True,
-                "readAt": firestore.SERVER_TIMESTAMP,
-            })
+        # Cập nhật theo lô thay vì 1 RPC cho mỗi thông báo; bỏ qua id đã bị xoá
+        # (batch.update vào doc không tồn tại sẽ làm hỏng cả lần commit)
+        refs = [notification_ref(user_id, notif_id) for notif_id in dict.fromkeys(notification_ids)]
+        existing = [doc.reference for doc in db.get_all(refs, field_paths=["read"]) if doc.exists]
+        updated = _update_in_batches(existing, READ_UPDATE)
 
         return jsonify({
             "success": True,
-            "message": f"Đã đánh dấu {len(notification_ids)} thông báo"
+            "updated": updated,
+            "missing": len(refs) - updated,
+            "message": f"Đã đánh dấu {updated} thông báo"
         }), 200
 
     except Exception as e:
@@ -1230,21 +2544,98 @@ def mark_notification_read():
 
 
 # -------------------------------------------------
-#  Route: Xóa thông báo
+#  Route: Đánh dấu tất cả thông báo đã đọc
 # -------------------------------------------------
-@app.route("/delete-notification", methods=["POST"])
-def delete_notification():
+@app.route("/mark-all-notifications-read", methods=["POST"])
+def mark_all_notifications_read():
     """
-    Xóa một thông báo
+    Đánh dấu toàn bộ thông báo chưa đọc của user là đã đọc
+    (duyệt theo trang 500 doc chưa đọc, mỗi trang 1 lần commit)
     """
     try:
         data = request.get_json()
-        notification_id = data.get("notificationId")
-
-        if not notification_id:
-            return jsonify({"error": "Thiếu notificationId"}), 400
+        user_id = data.get("userId")
 
-        db.collection("notifications").document(notification_id).delete()
+        if not user_id:
+            return jsonify({"error": "Thiếu userId"}), 400
+
+        unread = (
+            notifications_of(user_id)
+            .where("read", "==", False)
+            .select(["read"])
+            .limit(FIRESTORE_BATCH_LIMIT)
+        )
+
+        # Doc đã cập nhật không còn khớp read == False → query lại chính là trang kế tiếp
+        updated = 0
+        while True:
+            docs = list(unread.stream())
+            if not docs:
+                break
+            updated += _update_in_batches([doc.reference for doc in docs], READ_UPDATE)
+            if len(docs) < FIRESTORE_BATCH_LIMIT:
+                break
+
+        return jsonify({
+            "success": True,
+            "updated": updated,
+            "message": f"Đã đánh dấu {updated} thông báo"
+        }), 200
+
+    except Exception as e:
+        print(f"❌ Mark all read error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route: Đếm thông báo chưa đọc (badge)
+# -------------------------------------------------
+@app.route("/unread-notifications-count", methods=["GET"])
+def unread_notifications_count():
+    """
+    Số thông báo chưa đọc của user bằng aggregation count() (không tải doc)
+    """
+    try:
+        user_id = request.args.get("userId")
+
+        if not user_id:
+            return jsonify({"error": "Thiếu userId"}), 400
+
+        result = (
+            notifications_of(user_id)
+            .where("read", "==", False)
+            .count(alias="unread")
+            .get()
+        )
+        unread = int(result[0][0].value) if result and result[0] else 0
+
+        return jsonify({
+            "success": True,
+            "unread": unread
+        }), 200
+
+    except Exception as e:
+        print(f"❌ Unread count error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# -------------------------------------------------
+#  Route: Xóa thông báo
+# -------------------------------------------------
+@app.route("/delete-notification", methods=["POST"])
+def delete_notification():
+    """
+    Xóa một thông báo
+    """
+    try:
+        data = request.get_json()
+        user_id = data.get("userId")
+        notification_id = data.get("notificationId")
+
+        if not user_id or not notification_id:
+            return jsonify({"error": "Thiếu userId hoặc notificationId"}), 400
+
+        notification_ref(user_id, notification_id).delete()
 
         return jsonify({
             "success": True,
@@ -1271,35 +2662,28 @@ def get_match_requests():
         if not user_id:
             return jsonify({"error": "Thiếu userId"}), 400
 
-        requests_list = []
-
-        # Lấy requests đã nhận
-        if request_type in ["received", "all"]:
-            received_ref = (
+        def load(field, direction):
+            query = (
                 db.collection("match_requests")
-                .where("receiverId", "==", user_id)
+                .where(field, "==", user_id)
                 .order_by("createdAt", direction=firestore.Query.DESCENDING)
             )
-
-            for doc in received_ref.stream():
+            results = []
+            for doc in query.stream():
                 req_data = doc.to_dict()
                 req_data["requestId"] = doc.id
-                req_data["direction"] = "received"
-                requests_list.append(req_data)
+                req_data["direction"] = direction
+                results.append(req_data)
+            return results
 
-        # Lấy requests đã gửi
+        # Lấy requests đã nhận / đã gửi (type=all → 2 query chạy song song)
+        calls = []
+        if request_type in ["received", "all"]:
+            calls.append(lambda: load("receiverId", "received"))
         if request_type in ["sent", "all"]:
-            sent_ref = (
-                db.collection("match_requests")
-                .where("senderId", "==", user_id)
-                .order_by("createdAt", direction=firestore.Query.DESCENDING)
-            )
+            calls.append(lambda: load("senderId", "sent"))
 
-            for doc in sent_ref.stream():
-                req_data = doc.to_dict()
-                req_data["requestId"] = doc.id
-                req_data["direction"] = "sent"
-                requests_list.append(req_data)
+        requests_list = [req for part in run_concurrently(*calls) for req in part]
 
         return jsonify({
             "success": True,
@@ -1312,6 +2696,124 @@ def get_match_requests():
         return jsonify({"error": str(e)}), 500
     
 
+# -------------------------------------------------
+#  Cache phân tích tương hợp: 1 doc / cặp đôi / phiên bản bản đồ
+# -------------------------------------------------
+# Doc ID = hash(cặp uid đã sắp xếp + chart hash của từng người) → A→B và B→A
+# dùng chung 1 doc, tra cứu bằng 1 lệnh get. Ai sửa bản đồ thì doc cũ của các
+# cặp có người đó thành mồ côi: listener của profile index ghi nhận uid, job
+# nền xoá dần các doc có chart hash không còn khớp.
+stale_compatibility_uids = set()
+_stale_compatibility_lock = threading.Lock()
+
+
+def compatibility_pair_key(uid_a, profile_a, uid_b, profile_b):
+    """→ (doc ID, {uid: chart_hash}); không phụ thuộc thứ tự 2 người"""
+    chart_hashes = {uid_a: natal_chart_hash(profile_a), uid_b: natal_chart_hash(profile_b)}
+    uids = sorted(chart_hashes)
+    return make_cache_key("compatibility", *uids, *(chart_hashes[u] for u in uids)), chart_hashes
+
+
+def _track_stale_compatibility(uid, old, new):
+    if old is None:
+        return
+    if new is None or natal_chart_hash(old) != natal_chart_hash(new):
+        with _stale_compatibility_lock:
+            stale_compatibility_uids.add(uid)
+
+
+profile_index.add_listener(_track_stale_compatibility)
+
+
+def _delete_refs_in_batches(refs, batch_size=FIRESTORE_BATCH_LIMIT):
+    refs = list(refs)
+    for i in range(0, len(refs), batch_size):
+        batch = db.batch()
+        for ref in refs[i:i + batch_size]:
+            batch.delete(ref)
+        batch.commit()
+    return len(refs)
+
+
+def compact_stale_compatibility(batch_size=PREDICTION_COMPACTION_BATCH):
+    """Xoá phân tích tương hợp của các bản đồ đã đổi/user đã xoá, và doc định dạng cũ"""
+    with _stale_compatibility_lock:
+        uids = list(stale_compatibility_uids)
+        stale_compatibility_uids.clear()
+
+    collection = db.collection("compatibility_analysis")
+    deleted = 0
+    try:
+        while uids:
+            uid = uids[-1]
+            profile = profile_index.get(uid)
+            current = natal_chart_hash(profile) if profile else None
+            docs = collection.where("uids", "array_contains", uid).select(["chart_hashes"]).stream()
+            deleted += _delete_refs_in_batches(
+                doc.reference for doc in docs
+                if (doc.to_dict().get("chart_hashes") or {}).get(uid) != current
+            )
+            uids.pop()
+    except Exception:
+        # Chưa dọn xong → để lần chạy sau xử lý tiếp
+        with _stale_compatibility_lock:
+            stale_compatibility_uids.update(uids)
+        raise
+
+    # Doc cũ (ID ngẫu nhiên, tra theo cache_key) không còn được đọc nữa
+    deleted += _delete_in_batches(
+        collection.where("cache_key", ">=", "").select(["cache_key"]),
+        batch_size,
+    )
+    compaction_stats["stale_pairs_deleted"] += deleted
+    return deleted
+
+
+def compatibility_request(data):
+    """(myUid, partnerUid) của /compatibility-analysis (dùng chung cho Flask và ASGI)"""
+    my_uid = data.get("myUid", "")
+    partner_uid = data.get("partnerUid", "")
+    if not my_uid or not partner_uid:
+        raise RequestError("Thiếu thông tin UID")
+    return my_uid, partner_uid
+
+
+def check_compatibility_profiles(me_raw, partner_raw):
+    if me_raw is None:
+        raise RequestError("Không tìm thấy thông tin người dùng", 404)
+    if partner_raw is None:
+        raise RequestError("Không tìm thấy thông tin đối phương", 404)
+
+
+def compatibility_payload(data, cached):
+    """Payload trả client từ doc đã lưu hoặc kết quả vừa sinh ({"analysis", ...điểm})"""
+    return {
+        "analysis": data.get("analysis", ""),
+        **{k: data.get(k, 0) for k in SCORE_KEYS},
+        "cached": cached,
+    }
+
+
+def compatibility_doc(my_uid, me_raw, partner_uid, partner_raw, chart_hashes, analysis_text, scores):
+    me_info = extract_user_info(me_raw)
+    partner_info = extract_user_info(partner_raw)
+    return {
+        "uids": sorted(chart_hashes),
+        "chart_hashes": chart_hashes,
+        "my_uid": my_uid,
+        "partner_uid": partner_uid,
+        "my_name": me_info["name"],
+        "partner_name": partner_info["name"],
+        "analysis": analysis_text,
+        **{k: scores[k] for k in SCORE_KEYS},
+        "created_at": datetime.now().isoformat(),
+        "user_data": {
+            "person1": {**me_info, **extract_houses(me_raw), **extract_aspects(me_raw), **extract_elements(me_raw)},
+            "person2": {**partner_info, **extract_houses(partner_raw), **extract_aspects(partner_raw), **extract_elements(partner_raw)},
+        }
+    }
+
+
 # -------------------------------------------------
 #  Route phân tích tương hợp giữa 2 người
 # -------------------------------------------------
@@ -1322,245 +2824,214 @@ def compatibility_analysis():
     """
     try:
         data = request.get_json()
-        my_uid = data.get("myUid", "")
-        partner_uid = data.get("partnerUid", "")
+        my_uid, partner_uid = compatibility_request(data)
 
-        if not my_uid or not partner_uid:
-            return jsonify({"error": "Thiếu thông tin UID"}), 400
+        # Hồ sơ 2 người đọc bằng 1 get_all (index trong bộ nhớ nếu sẵn sàng)
+        me_raw, partner_raw = get_user_profiles(my_uid, partner_uid)
+        check_compatibility_profiles(me_raw, partner_raw)
 
-        # Kiểm tra cache Firestore (cặp đôi có thể được phân tích theo 2 chiều)
-        cache_key = f"{my_uid}_{partner_uid}"
-        reverse_key = f"{partner_uid}_{my_uid}"
-        
-        cache_query = (
-            db.collection("compatibility_analysis")
-            .where("cache_key", "in", [cache_key, reverse_key])
-            .limit(1)
-            .stream()
-        )
+        # Chỉ lấy điểm: tính cục bộ từ bản đồ sao, không cần cache hay Gemini
+        if data.get("scoresOnly"):
+            return jsonify({**synastry_scores(me_raw, partner_raw), "cached": False}), 200
 
-        for doc in cache_query:
-            cached_data = doc.to_dict()
+        # Kiểm tra cache Firestore: 1 doc cho cả 2 chiều, ID theo cặp + phiên bản bản đồ
+        pair_key, chart_hashes = compatibility_pair_key(my_uid, me_raw, partner_uid, partner_raw)
+        cache_ref = db.collection("compatibility_analysis").document(pair_key)
+        cached_doc = cache_ref.get()
+
+        if cached_doc.exists:
             print(f"✅ Cache phân tích có sẵn cho cặp {my_uid} - {partner_uid}")
-            return jsonify({
-                "analysis": cached_data.get("analysis", ""),
-                "compatibility_score": cached_data.get("compatibility_score", 0),
-                "love_score": cached_data.get("love_score", 0),
-                "trust_score": cached_data.get("trust_score", 0),
-                "communication_score": cached_data.get("communication_score", 0),
-                "marriage_score": cached_data.get("marriage_score", 0),
-                "cached": True
-            })
+            payload = compatibility_payload(cached_doc.to_dict(), True)
+            if wants_stream(data):
+                return sse_response(replay_sse(payload["analysis"], payload))
+            return jsonify(payload)
+
+        print(f"⚙️ Không có cache → Gọi Gemini")
+
+        # Điểm tính cục bộ (tất định); Gemini chỉ viết phần phân tích
+        scores = synastry_scores(me_raw, partner_raw)
+        prompt = build_compatibility_prompt(me_raw, partner_raw, scores)
+
+        def save_analysis(analysis_text):
+            analysis_text, _ = parse_compatibility_analysis(analysis_text)
+            cache_ref.set(compatibility_doc(
+                my_uid, me_raw, partner_uid, partner_raw, chart_hashes, analysis_text, scores
+            ))
+            print(f"✅ Đã lưu phân tích tương hợp cho cặp {my_uid} - {partner_uid}")
+            return {"analysis": analysis_text, **scores}
+
+        # Điểm số gửi ngay ở sự kiện "scores", sau đó stream phần phân tích (ẩn khối SCORES nếu có)
+        if wants_stream(data):
+            def events():
+                yield sse_event("scores", scores)
+                yield from stream_analysis(prompt, save_analysis, stop_marker="SCORES:")
+            return sse_response(events())
+
+        # Cặp đôi đang được phân tích (theo chiều nào cũng vậy) → dùng chung kết quả
+        result, shared = gemini_flight.do(pair_key, lambda: save_analysis(gemini.generate(prompt)))
+        return jsonify(compatibility_payload(result, shared)), 200
+
+    except RequestError as e:
+        return jsonify({"error": e.message}), e.status
+    except GeminiUnavailable as e:
+        return gemini_unavailable(e)
+    except Exception as e:
+        print(f"❌ Error in compatibility analysis: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        print(f"⚙️ Không có cache → Lấy dữ liệu và gọi Gemini")
-
-        # --- LẤY THÔNG TIN USER 1 ---
-        me_doc = db.collection("users").document(my_uid).get()
-        if not me_doc.exists:
-            return jsonify({"error": "Không tìm thấy thông tin người dùng"}), 404
-
-        me_raw = me_doc.to_dict()
-
-        # --- LẤY THÔNG TIN USER 2 ---
-        partner_doc = db.collection("users").document(partner_uid).get()
-        if not partner_doc.exists:
-            return jsonify({"error": "Không tìm thấy thông tin đối phương"}), 404
-
-        partner_raw = partner_doc.to_dict()
-
-        # --- HELPER FUNCTIONS ---
-        def extract_user_info(user_data):
-            return {
-                "name": user_data.get("name", ""),
-                "sun": user_data.get("sun", ""),
-                "moon": user_data.get("moon", ""),
-                "mercury": user_data.get("mercury", ""),
-                "venus": user_data.get("venus", ""),
-                "mars": user_data.get("mars", ""),
-                "jupiter": user_data.get("jupiter", ""),
-                "saturn": user_data.get("saturn", ""),
-                "uranus": user_data.get("uranus", ""),
-                "neptune": user_data.get("neptune", ""),
-                "pluto": user_data.get("pluto", ""),
-                "ascendant": user_data.get("ascendant", ""),
-                "descendant": user_data.get("descendant", ""),
-                "mc": user_data.get("mc", ""),
-                "ic": user_data.get("ic", ""),
-            }
 
-        def extract_houses(user_data):
-            return {f"house{i}": user_data.get(f"house{i}", "") for i in range(1, 13)}
+# ------------------------------------------------------
+#  Materialize kết quả ghép cặp (love_matching_results) nền
+# ------------------------------------------------------
+# Bảng xếp hạng top-K của mọi user được giữ trong bộ nhớ và cập nhật tăng dần
+# theo thay đổi hồ sơ; danh sách hiển thị đổi thì ghi lại doc
+# love_matching_results/{uid}/types/{match_type} với source="local".
+# POST /love-matching chỉ gọi Gemini khi shortlist đã khác lần phân tích trước.
+LOVE_MATCH_MATERIALIZE = os.getenv("LOVE_MATCH_MATERIALIZE", "1") == "1"
+LOVE_MATCH_RESULTS = 5
+
+
+def love_match_ref(uid, match_type):
+    return (
+        db.collection("love_matching_results")
+        .document(uid)
+        .collection("types")
+        .document(match_type)
+    )
 
-        def extract_aspects(user_data):
-            return {
-                "conjunction": user_data.get("conjunctionAspect", ""),
-                "opposition": user_data.get("oppositionAspect", ""),
-                "trine": user_data.get("trineAspect", ""),
-                "square": user_data.get("squareAspect", ""),
-                "sextile": user_data.get("sextileAspect", ""),
-            }
 
-        def extract_elements(user_data):
-            return {
-                "fire": user_data.get("fireRatio", 0),
-                "earth": user_data.get("earthRatio", 0),
-                "air": user_data.get("airRatio", 0),
-                "water": user_data.get("waterRatio", 0),
-            }
+def local_love_match_users(uid, ranking, limit=LOVE_MATCH_RESULTS):
+    """Kết quả cùng định dạng với Gemini, tính cục bộ từ điểm xếp hạng + synastry"""
+    me_raw = profile_index.get(uid) or {}
+    users = []
+    for cand_uid, local_score in ranking[:limit]:
+        u = profile_index.get(cand_uid)
+        if u is None:
+            continue
+        scores = synastry_scores(me_raw, u)
+        users.append({
+            "uid": cand_uid,
+            "name": u.get("name", ""),
+            "zodiac": u.get("sun", ""),
+            "age": u.get("age"),
+            "element": u.get("mainElement", ""),
+            "personality": u.get("personality", ""),
+            "compatibility_score": int(round(local_score)),
+            "love": scores["love_score"],
+            "trust": scores["trust_score"],
+            "communication": scores["communication_score"],
+            "marriage": scores["marriage_score"],
+        })
+    return users
 
-        me_info = extract_user_info(me_raw)
-        me_houses = extract_houses(me_raw)
-        me_aspects = extract_aspects(me_raw)
-        me_elements = extract_elements(me_raw)
 
-        partner_info = extract_user_info(partner_raw)
-        partner_houses = extract_houses(partner_raw)
-        partner_aspects = extract_aspects(partner_raw)
-        partner_elements = extract_elements(partner_raw)
+def persist_love_matches(updates):
+    """Ghi các danh sách đã đổi theo lô (tối đa 500 doc / batch)"""
+    for i in range(0, len(updates), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for uid, match_type, ranking in updates[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(love_match_ref(uid, match_type), love_match_doc(
+                uid, match_type, local_love_match_users(uid, ranking),
+                [cand_uid for cand_uid, _ in ranking], source="local",
+            ))
+        batch.commit()
 
-        #  prompt phân tích tương hợp
-        prompt = f"""
-        Phân tích độ tương hợp chi tiết giữa 2 người dựa trên thông tin chiêm tinh sau:
-        
-        **NGƯỜI 1:**
-        - Tên: {me_info['name']}
-        - Mặt Trời: {me_info['sun']}
-        - Mặt Trăng: {me_info['moon']}
-        - Thủy tinh: {me_info['mercury']}
-        - Kim tinh: {me_info['venus']}
-        - Hỏa tinh: {me_info['mars']}
-        - Mộc tinh: {me_info['jupiter']}
-        - Thổ tinh: {me_info['saturn']}
-        - Thiên Vương tinh: {me_info['uranus']}
-        - Hải Vương tinh: {me_info['neptune']}
-        - Diêm Vương tinh: {me_info['pluto']}
-        - Ascendant: {me_info['ascendant']}
-        - Descendant: {me_info['descendant']}
-        - MC: {me_info['mc']}
-        - IC: {me_info['ic']}
-        
-        Các nhà: {json.dumps(me_houses, ensure_ascii=False)}
-        Aspects: {json.dumps(me_aspects, ensure_ascii=False)}
-        Tỷ lệ nguyên tố: {json.dumps(me_elements, ensure_ascii=False)}
-        
-        **NGƯỜI 2:**
-        - Tên: {partner_info['name']}
-        - Mặt Trời: {partner_info['sun']}
-        - Mặt Trăng: {partner_info['moon']}
-        - Thủy tinh: {partner_info['mercury']}
-        - Kim tinh: {partner_info['venus']}
-        - Hỏa tinh: {partner_info['mars']}
-        - Mộc tinh: {partner_info['jupiter']}
-        - Thổ tinh: {partner_info['saturn']}
-        - Thiên Vương tinh: {partner_info['uranus']}
-        - Hải Vương tinh: {partner_info['neptune']}
-        - Diêm Vương tinh: {partner_info['pluto']}
-        - Ascendant: {partner_info['ascendant']}
-        - Descendant: {partner_info['descendant']}
-        - MC: {partner_info['mc']}
-        - IC: {partner_info['ic']}
-        
-        Các nhà: {json.dumps(partner_houses, ensure_ascii=False)}
-        Aspects: {json.dumps(partner_aspects, ensure_ascii=False)}
-        Tỷ lệ nguyên tố: {json.dumps(partner_elements, ensure_ascii=False)}
-        
-        Hãy phân tích chi tiết và sâu sắc độ tương hợp của cặp đôi này theo các mục sau:
-        
-        1. **Tổng quan về mối quan hệ**: Đánh giá tổng thể về sự hòa hợp giữa 2 người
-        2. **Tương thích cảm xúc**: Phân tích Mặt Trăng, Kim tinh và các hành tinh cá nhân
-        3. **Giao tiếp và tư duy**: Dựa vào Thủy tinh, Không khí trong nguyên tố
-        4. **Tình yêu và lãng mạn**: Phân tích Kim tinh, Hỏa tinh và Nhà 5, 7
-        5. **Cam kết dài hạn và hôn nhân**: Dựa vào Thổ tinh, Mộc tinh, MC và các góc tương tác
-        6. **Thách thức và xung đột**: Các aspects khó khăn, điểm bất hòa cần lưu ý
-        7. **Điểm mạnh của mối quan hệ**: Những gì làm cho mối quan hệ này đặc biệt
-        8. **Lời khuyên để phát triển**: Hướng dẫn cụ thể để xây dựng mối quan hệ bền vững
-        
-        Sau khi phân tích, hãy đánh giá các chỉ số sau (0-100):
-        - Độ tương thích tổng thể (compatibility_score)
-        - Tình yêu và hấp dẫn (love_score)
-        - Lòng tin và an toàn (trust_score)
-        - Giao tiếp và hiểu biết (communication_score)
-        - Tiềm năng hôn nhân (marriage_score)
-        
-        Yêu cầu:
-        - Viết bằng tiếng Việt, văn phong chuyên nghiệp nhưng ấm áp
-        - Mỗi mục khoảng 2-3 đoạn văn
-        - Không dùng emoji, không dùng ký tự đặc biệt
-        - Không chào hỏi hay văn phong dư thừa
-        - Tập trung vào phân tích sâu, có căn cứ chiêm tinh học
-        - Cuối cùng, ghi rõ 5 chỉ số theo format:
-        
-        SCORES:
-        compatibility_score: [số]
-        love_score: [số]
-        trust_score: [số]
-        communication_score: [số]
-        marriage_score: [số]
-        """
 
-        # Gọi Gemini API
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        analysis_text = response.text if hasattr(response, "text") else str(response)
-
-        # Làm sạch text
-        analysis_text = re.sub(r"(```|'''|\"\"\")", "", analysis_text).strip()
-
-        # Trích xuất scores từ text
-        scores = {
-            "compatibility_score": 75,  # default
-            "love_score": 75,
-            "trust_score": 75,
-            "communication_score": 75,
-            "marriage_score": 75,
-        }
+love_materializer = LoveMatchMaterializer(
+    profile_index, persist_love_matches, k=LOVE_MATCH_SHORTLIST, display_k=LOVE_MATCH_RESULTS
+)
 
-        # Parse scores từ phần cuối của analysis
-        score_pattern = r"(compatibility_score|love_score|trust_score|communication_score|marriage_score):\s*(\d+)"
-        matches = re.findall(score_pattern, analysis_text, re.IGNORECASE)
-        
-        for key, value in matches:
-            scores[key.lower()] = int(value)
-        
-        # Loại bỏ phần SCORES khỏi analysis text
-        analysis_text = re.sub(r"SCORES:[\s\S]*$", "", analysis_text).strip()
-
-        # Lưu vào Firestore
-        compatibility_doc = {
-            "cache_key": cache_key,
-            "my_uid": my_uid,
-            "partner_uid": partner_uid,
-            "my_name": me_info["name"],
-            "partner_name": partner_info["name"],
-            "analysis": analysis_text,
-            "compatibility_score": scores["compatibility_score"],
-            "love_score": scores["love_score"],
-            "trust_score": scores["trust_score"],
-            "communication_score": scores["communication_score"],
-            "marriage_score": scores["marriage_score"],
-            "created_at": datetime.now().isoformat(),
-            "user_data": {
-                "person1": {**me_info, **me_houses, **me_aspects, **me_elements},
-                "person2": {**partner_info, **partner_houses, **partner_aspects, **partner_elements}
-            }
-        }
 
-        db.collection("compatibility_analysis").add(compatibility_doc)
-        print(f"✅ Đã lưu phân tích tương hợp cho {me_info['name']} - {partner_info['name']}")
+# ------------------------------------------------------
+#  Dữ liệu dùng chung cho các route ghép cặp
+# ------------------------------------------------------
+LOVE_MATCH_USER_SCHEMA = """{
+    "uid": "...",
+    "name": "...",
+    "zodiac": "...",
+    "age": <number>,
+    "element": "...",
+    "personality": "<1 câu mô tả tính cách dài 1 từ>",
+    "compatibility_score": <0-100>,
+    "love": <0-100>,
+    "trust": <0-100>,
+    "communication": <0-100>,
+    "marriage": <0-100>
+  }"""
 
-        return jsonify({
-            "analysis": analysis_text,
-            "compatibility_score": scores["compatibility_score"],
-            "love_score": scores["love_score"],
-            "trust_score": scores["trust_score"],
-            "communication_score": scores["communication_score"],
-            "marriage_score": scores["marriage_score"],
-            "cached": False
-        }), 200
 
-    except Exception as e:
-        print(f"❌ Error in compatibility analysis: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+def love_match_profile(uid, u, **extra):
+    """Hồ sơ rút gọn gửi cho Gemini (người A hoặc ứng viên)"""
+    return {
+        "uid": uid,
+        "name": u.get("name", ""),
+        "zodiac": u.get("sun", ""),
+        "age": u.get("age"),
+        "element": u.get("mainElement", ""),
+        "personality": u.get("personality", ""),
+        "planets": {k: u.get(k, "") for k in PLANETS},
+        "houses": extract_houses(u),
+        "elements": extract_elements(u),
+        **extra,
+    }
+
+
+def load_love_match_candidates(uid):
+    """(matrix, số ứng viên, hàm tra hồ sơ): index trong bộ nhớ, fallback quét Firestore 1 lần"""
+    if use_profile_index():
+        matrix = profile_index.matrix()
+        return matrix, len(matrix) - (matrix.row(uid) is not None), profile_index.get
+
+    candidates = {}
+    for doc in db.collection("users").stream():
+        u = doc.to_dict()
+        if doc.id != uid and u.get("sun") and u.get("moon"):
+            candidates[doc.id] = u
+    return ProfileMatrix.from_users(candidates.items()), len(candidates), candidates.get
+
+
+def love_match_shortlist(uid, me_raw, matrix, match_type):
+    """Shortlist top-K: đã materialize thì dùng luôn, không cần chấm lại cả index"""
+    shortlist = love_materializer.get(uid, match_type) if use_profile_index() else None
+    if shortlist is None:
+        shortlist = matrix.top_k(me_raw, match_type, LOVE_MATCH_SHORTLIST, exclude=[uid])
+    return shortlist
+
+
+def love_match_doc(uid, match_type, users, shortlist_uids, source="gemini"):
+    return {
+        "type": match_type,
+        "uid": uid,
+        "createdAt": firestore.SERVER_TIMESTAMP,
+        "users": users,
+        "shortlist": shortlist_uids,
+        "source": source,
+    }
+
+
+def love_match_data(snapshot):
+    """Snapshot → dict (None nếu không tồn tại); doc cũ có thể thiếu source/shortlist"""
+    if snapshot is None or not snapshot.exists:
+        return None
+    return snapshot.to_dict() or {}
+
+
+def is_fresh_love_match(data, shortlist_uids):
+    """Dữ liệu đã lưu là kết quả Gemini cho đúng shortlist hiện tại"""
+    return (
+        data is not None
+        and data.get("source") == "gemini"
+        and data.get("shortlist") == shortlist_uids
+    )
+
+
+def parse_json_block(raw, opener="["):
+    """Bóc JSON (list hoặc object) khỏi text Gemini trả về"""
+    closer = "]" if opener == "[" else "}"
+    clean = re.sub(r"(```json|```)", "", raw).strip()
+    if not clean.startswith(opener):
+        clean = clean[clean.find(opener):clean.rfind(closer) + 1]
+    return json.loads(clean)
 
 
 # ------------------------------------------------------
@@ -1569,8 +3040,7 @@ def compatibility_analysis():
 @app.route("/love-matching/<match_type>", methods=["POST"])
 def love_matching_single(match_type):
     try:
-        valid_types = ["redflag", "greenflag", "karmic", "destiny", "twinflame"]
-        if match_type not in valid_types:
+        if match_type not in MATCH_TYPES:
             return jsonify({"error": "Loại kết nối không hợp lệ"}), 400
 
         data = request.get_json()
@@ -1580,62 +3050,42 @@ def love_matching_single(match_type):
             return jsonify({"error": "Thiếu uid"}), 400
 
         # --- LẤY USER A ---
-        me_doc = db.collection("users").document(uid).get()
-        if not me_doc.exists:
+        me_raw = get_user_profile(uid)
+        if me_raw is None:
             return jsonify({"error": "Không tìm thấy user"}), 404
 
-        me_raw = me_doc.to_dict()
+        me = love_match_profile(uid, me_raw)
 
-        def extract_planets(u):
-            keys = ["sun","moon","mercury","venus","mars"]
-            return {k: u.get(k, "") for k in keys}
+        # --- ỨNG VIÊN: lấy từ index trong bộ nhớ, fallback quét Firestore ---
+        matrix, candidate_count, lookup = load_love_match_candidates(uid)
 
-        def extract_houses(u):
-            return {f"house{i}": u.get(f"house{i}", "") for i in range(1,13)}
+        if candidate_count < 5:
+            return jsonify({"error": "Không đủ user để phân tích"}), 400
 
-        def extract_elements(u):
-            return {
-                "fire": u.get("fireRatio", 0),
-                "earth": u.get("earthRatio", 0),
-                "air": u.get("airRatio", 0),
-                "water": u.get("waterRatio", 0)
-            }
+        # --- CHẤM ĐIỂM CỤC BỘ → chỉ gửi shortlist top-K cho Gemini ---
+        shortlist = love_match_shortlist(uid, me_raw, matrix, match_type)
 
-        me = {
-            "uid": uid,
-            "name": me_raw.get("name", ""),
-            "zodiac": me_raw.get("sun", ""),
-            "age": me_raw.get("age"),
-            "element": me_raw.get("mainElement", ""),
-            "personality": me_raw.get("personality", ""),
-            "planets": extract_planets(me_raw),
-            "elements": extract_elements(me_raw),
-            "houses": extract_houses(me_raw)
-        }
+        others = [
+            love_match_profile(cand_uid, lookup(cand_uid) or {}, local_score=local_score)
+            for cand_uid, local_score in shortlist
+        ]
 
-        others = []
-        for doc in db.collection("users").stream():
-            if doc.id == uid:
-                continue
-            u = doc.to_dict()
-
-            candidate = {
-                "uid": doc.id,
-                "name": u.get("name", ""),
-                "zodiac": u.get("sun", ""),
-                "age": u.get("age"),
-                "element": u.get("mainElement", ""),
-                "personality": u.get("personality", ""),
-                "planets": extract_planets(u),
-                "houses": extract_houses(u),
-                "elements": extract_elements(u),
-            }
+        print(f"🧮 Shortlist {len(others)}/{candidate_count} ứng viên cho {match_type}")
 
-            if candidate["planets"]["sun"] and candidate["planets"]["moon"]:
-                others.append(candidate)
+        # Kết quả lưu DẠNG TREE: love_matching_results/{uid}/types/{match_type}
+        doc_ref = love_match_ref(uid, match_type)
+        shortlist_uids = [cand_uid for cand_uid, _ in shortlist]
 
-        if len(others) < 5:
-            return jsonify({"error": "Không đủ user để phân tích"}), 400
+        # Gemini đã phân tích đúng shortlist này → trả kết quả đã lưu, không gọi lại
+        stored = love_match_data(doc_ref.get())
+        if not data.get("force") and is_fresh_love_match(stored, shortlist_uids):
+            print(f"✅ Shortlist {match_type} của {uid} không đổi → dùng kết quả đã lưu")
+            return jsonify({
+                "success": True,
+                "type": match_type,
+                "users": stored.get("users") or [],
+                "cached": True
+            })
 
         # --- PROMPT ---
         prompt = f"""
@@ -1645,68 +3095,177 @@ Trả về JSON dạng LIST 5 người, không văn bản thừa.
 Người A:
 {json.dumps(me, ensure_ascii=False)}
 
-Danh sách người B:
+Danh sách người B (đã lọc sơ bộ, local_score là điểm tham khảo 0-100):
 {json.dumps(others, ensure_ascii=False)}
 Trả về JSON dạng LIST gồm đúng 5 người:
 [
-  {{
-    "uid": "...",
-    "name": "...",
-    "zodiac": "...",
-    "age": <number>,
-    "element": "...",
-    "personality": "<1 câu mô tả tính cách dài 1 từ>",
-    "compatibility_score": <0-100>,
-    "love": <0-100>,
-    "trust": <0-100>,
-    "communication": <0-100>,
-    "marriage": <0-100>
-  }}
+  {LOVE_MATCH_USER_SCHEMA}
 ]
 
 KHÔNG in bất kỳ văn bản nào ngoài JSON.
 """
 
-        model = genai.GenerativeModel(MODEL_NAME)
-        raw = model.generate_content(prompt).text.strip()
+        try:
+            raw = gemini.generate(prompt).strip()
+        except GeminiUnavailable as e:
+            # Gemini quá tải → trả kết quả lần trước nếu có
+            if stored is None:
+                return gemini_unavailable(e)
+            gemini.note_stale()
+            print(f"⚠️ Gemini gián đoạn → trả kết quả cũ {match_type} cho {uid}")
+            return jsonify({
+                "success": True,
+                "type": match_type,
+                "users": stored.get("users") or [],
+                "stale": True
+            })
 
         print("🟡 RAW AI:", raw)
 
-        clean = re.sub(r"(```json|```)", "", raw).strip()
-        if not clean.startswith("["):
-            start = clean.find("[")
-            end = clean.rfind("]") + 1
-            clean = clean[start:end]
-
-        result = json.loads(clean)
+        result = parse_json_block(raw, "[")
 
         # LƯU DẠNG TREE
-        doc_ref = (
-            db.collection("love_matching_results")
-            .document(uid)             # folder user
-            .collection("types")       # folder types
-            .document(match_type)      # type_name
-        )
+        doc_ref.set(love_match_doc(uid, match_type, result, shortlist_uids))
+
+        print("💾 FIRESTORE SAVE OK:", match_type)
 
-        doc_ref.set({
+        return jsonify({
+            "success": True,
             "type": match_type,
-            "uid": uid,
-            "createdAt": firestore.SERVER_TIMESTAMP,
             "users": result
         })
 
-        print("💾 FIRESTORE SAVE OK:", match_type)
+    except Exception as e:
+        print("🔥 ERROR:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ------------------------------------------------------
+#  Route: Cả 5 loại ghép cặp trong 1 lượt
+# ------------------------------------------------------
+@app.route("/love-matching/all", methods=["POST"])
+def love_matching_all():
+    """
+    Quét ứng viên 1 lần, gộp shortlist các loại vào 1 prompt (mỗi ứng viên chỉ
+    gửi 1 lần) và ghi các doc types/{match_type} bằng 1 batch.
+    Loại nào có kết quả Gemini cho đúng shortlist hiện tại thì dùng lại.
+    """
+    try:
+        data = request.get_json()
+        uid = data.get("uid")
+        types = data.get("types") or MATCH_TYPES
+
+        if not uid:
+            return jsonify({"error": "Thiếu uid"}), 400
+
+        if any(match_type not in MATCH_TYPES for match_type in types):
+            return jsonify({"error": "Loại kết nối không hợp lệ"}), 400
+
+        me_raw = get_user_profile(uid)
+        if me_raw is None:
+            return jsonify({"error": "Không tìm thấy user"}), 404
+
+        matrix, candidate_count, lookup = load_love_match_candidates(uid)
+        if candidate_count < 5:
+            return jsonify({"error": "Không đủ user để phân tích"}), 400
+
+        shortlists = {t: love_match_shortlist(uid, me_raw, matrix, t) for t in types}
+        shortlist_uids = {t: [cand_uid for cand_uid, _ in s] for t, s in shortlists.items()}
+
+        # Kết quả đã lưu của các loại: 1 lần get_all
+        refs = {t: love_match_ref(uid, t) for t in types}
+        stored = {doc.reference.id: love_match_data(doc) for doc in db.get_all(list(refs.values()))}
+
+        results, cached = {}, {}
+        for t in types:
+            if not data.get("force") and is_fresh_love_match(stored.get(t), shortlist_uids[t]):
+                results[t] = stored[t].get("users") or []
+                cached[t] = True
+
+        wanted = [t for t in types if t not in results]
+        if not wanted:
+            return jsonify({"success": True, "results": results, "cached": cached})
+
+        # Gộp ứng viên của các loại còn thiếu: mỗi người 1 lần, kèm điểm cục bộ theo loại
+        others = {}
+        for t in wanted:
+            for cand_uid, local_score in shortlists[t]:
+                if cand_uid not in others:
+                    others[cand_uid] = love_match_profile(cand_uid, lookup(cand_uid) or {}, local_scores={})
+                others[cand_uid]["local_scores"][t] = local_score
+
+        print(f"🧮 {len(wanted)} loại → {len(others)} ứng viên gộp "
+              f"(thay vì {sum(len(shortlists[t]) for t in wanted)}), 1 lời gọi Gemini")
+
+        prompt = f"""
+Phân tích ghép cặp cho các loại: {", ".join(wanted)}.
+Trả về JSON dạng OBJECT, không văn bản thừa.
+
+Người A:
+{json.dumps(love_match_profile(uid, me_raw), ensure_ascii=False)}
+
+Danh sách người B (đã lọc sơ bộ, local_scores là điểm tham khảo 0-100 theo từng loại):
+{json.dumps(list(others.values()), ensure_ascii=False)}
+
+Ứng viên được xét cho từng loại (mỗi loại chỉ chọn trong danh sách uid của loại đó):
+{json.dumps({t: shortlist_uids[t] for t in wanted}, ensure_ascii=False)}
+
+Trả về JSON dạng OBJECT với các khoá {json.dumps(wanted)}, mỗi khoá là LIST gồm đúng 5 người:
+{{
+  "<loại>": [
+    {LOVE_MATCH_USER_SCHEMA}
+  ]
+}}
+
+KHÔNG in bất kỳ văn bản nào ngoài JSON.
+"""
+
+        try:
+            raw = gemini.generate(prompt).strip()
+        except GeminiUnavailable as e:
+            # Gemini quá tải → trả kết quả lần trước nếu loại nào cũng đã có
+            if any(stored.get(t) is None for t in wanted):
+                return gemini_unavailable(e)
+            gemini.note_stale()
+            print(f"⚠️ Gemini gián đoạn → trả kết quả cũ cho {uid}")
+            for t in wanted:
+                results[t] = stored[t].get("users") or []
+                cached[t] = True
+            return jsonify({
+                "success": True,
+                "results": {t: results[t] for t in types},
+                "cached": cached,
+                "stale": True
+            })
+
+        print("🟡 RAW AI:", raw)
+
+        parsed = parse_json_block(raw, "{")
+
+        # Ghi các loại vào cùng 1 batch; bỏ người không thuộc shortlist của loại đó
+        batch = db.batch()
+        for t in wanted:
+            allowed = set(shortlist_uids[t])
+            users = [u for u in parsed.get(t) or [] if isinstance(u, dict) and u.get("uid") in allowed]
+            results[t] = users
+            cached[t] = False
+            batch.set(refs[t], love_match_doc(uid, t, users, shortlist_uids[t]))
+        batch.commit()
+
+        print("💾 FIRESTORE SAVE OK:", ", ".join(wanted))
 
         return jsonify({
             "success": True,
-            "type": match_type,
-            "users": result
+            "results": {t: results[t] for t in types},
+            "cached": cached
         })
 
+    except GeminiUnavailable as e:
+        return gemini_unavailable(e)
     except Exception as e:
         print("🔥 ERROR:", e)
         return jsonify({"error": str(e)}), 500
-    
+
 
 # ------------------------------------------------------
 #  Route: Lấy lịch sử phân tích ghép cặp theo tag
@@ -1714,16 +3273,18 @@ KHÔNG in bất kỳ văn bản nào ngoài JSON.
 @app.route("/love-matching/history/<uid>/<match_type>", methods=["GET"])
 def get_matching_history(uid, match_type):
     try:
-        doc_ref = (
-            db.collection("love_matching_results")
-            .document(uid)
-            .collection("types")
-            .document(match_type)
-        )
-
-        doc = doc_ref.get()
+        doc = love_match_ref(uid, match_type).get()
 
         if not doc.exists:
+            # Chưa có doc (chưa từng thay đổi từ khi materialize) → danh sách trong bộ nhớ
+            ranking = love_materializer.get(uid, match_type)
+            if ranking:
+                return jsonify({
+                    "success": True,
+                    "cached": True,
+                    "type": match_type,
+                    "users": local_love_match_users(uid, ranking)
+                })
             return jsonify({
                 "success": True,
                 "cached": False,
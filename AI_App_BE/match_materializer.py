@@ -0,0 +1,224 @@
+# -------------------------------------------------
+#  Materialize danh sách top-K ghép cặp, cập nhật tăng dần
+# -------------------------------------------------
+# Giữ trong bộ nhớ bảng xếp hạng top-K của mọi user cho từng loại kết nối.
+# Khi 1 hồ sơ X thay đổi, điểm của X với mọi người chỉ cần 1 lượt score()
+# (điểm đối xứng: A chấm B == B chấm A), rồi chỉ sửa danh sách của những user
+# mà X vào / rời / đổi hạng — không xếp hạng lại toàn bộ. Danh sách hiển thị
+# (display_k người đầu) thay đổi thì gọi persist(updates) để ghi Firestore.
+import queue
+import threading
+
+from matching_engine import MATCH_TYPES, PLANETS, ELEMENTS
+from profile_index import is_matchable
+
+# Field hiển thị của ứng viên trong kết quả (đổi thì các danh sách chứa họ cần ghi lại)
+DISPLAY_FIELDS = ("name", "age", "sun", "mainElement", "personality")
+CHART_FIELDS = (
+    *PLANETS,
+    *[f"house{i}" for i in range(1, 13)],
+    *[f"{e}Ratio" for e in ELEMENTS],
+)
+
+
+def _fields(record, keys):
+    return tuple((record or {}).get(k) for k in keys)
+
+
+class LoveMatchMaterializer:
+    """
+    index: UserProfileIndex (nguồn hồ sơ + sự kiện thay đổi)
+    persist(updates): updates là list (uid, match_type, ranking) với ranking
+    là list (uid ứng viên, điểm) giảm dần, tối đa k phần tử
+    """
+
+    def __init__(self, index, persist, k=20, display_k=5, match_types=MATCH_TYPES):
+        self.index = index
+        self.persist = persist
+        self.k = k
+        self.display_k = display_k
+        self.match_types = list(match_types)
+        self._rankings = {t: {} for t in self.match_types}
+        self._lock = threading.Lock()
+        self._events = queue.Queue()
+        self._thread = None
+        self._ready = threading.Event()
+        self.counts = {"events": 0, "full_ranks": 0, "patched": 0, "writes": 0, "errors": 0}
+
+    # ---------- Vòng đời ----------
+    def start(self):
+        """Đăng ký listener rồi bootstrap + xử lý sự kiện ở thread nền"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="love-match-materializer", daemon=True)
+        self.index.add_listener(self._on_change)
+        self._thread.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def _on_change(self, uid, old, new):
+        # Chạy trên thread của listener Firestore → chỉ xếp hàng, không tính toán
+        self._events.put((uid, old, new))
+
+    def _run(self):
+        # Listener của index do start_background_jobs khởi động; chờ đến khi nạp xong
+        self.index.wait_ready()
+
+        try:
+            self._bootstrap()
+            self._ready.set()
+        except Exception as e:
+            self.counts["errors"] += 1
+            print(f"⚠️ Materializer ghép cặp bootstrap lỗi: {str(e)}")
+
+        while True:
+            events = [self._events.get()]
+            # Gom các thay đổi tới dồn dập thành 1 lượt xử lý
+            while True:
+                try:
+                    events.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(events)
+            except Exception as e:
+                self.counts["errors"] += 1
+                print(f"⚠️ Materializer ghép cặp lỗi: {str(e)}")
+
+    # ---------- Tính toán ----------
+    def _rank(self, matrix, uid, match_type):
+        vector = matrix.vector(uid)
+        if vector is None:
+            return None
+        self.counts["full_ranks"] += 1
+        return matrix.top_k(vector, match_type, self.k, exclude=[uid])
+
+    def _bootstrap(self):
+        """Xếp hạng đầy đủ 1 lần khi khởi động (chỉ trong bộ nhớ, không ghi Firestore)"""
+        matrix = self.index.matrix()
+        for match_type in self.match_types:
+            rankings = {uid: self._rank(matrix, uid, match_type) for uid in matrix.uids}
+            with self._lock:
+                self._rankings[match_type] = rankings
+        print(f"✅ Materializer ghép cặp đã xếp hạng {len(matrix)} user × {len(self.match_types)} loại")
+
+    def _apply(self, events):
+        # Mỗi uid chỉ xét trạng thái đầu (trước lượt này) và cuối
+        changes = {}
+        for uid, old, new in events:
+            first_old = changes[uid][0] if uid in changes else old
+            changes[uid] = (first_old, new)
+        self.counts["events"] += len(events)
+
+        matrix = self.index.matrix()
+        updates = {}
+        for match_type in self.match_types:
+            with self._lock:
+                rankings = dict(self._rankings[match_type])
+            dirty = set()
+            for uid, (old, new) in changes.items():
+                dirty |= self._apply_change(matrix, rankings, match_type, uid, old, new)
+            with self._lock:
+                self._rankings[match_type] = rankings
+            for uid in dirty:
+                if rankings.get(uid) is not None:
+                    updates[(uid, match_type)] = rankings[uid]
+
+        if updates:
+            self.persist([(uid, match_type, ranking) for (uid, match_type), ranking in updates.items()])
+            self.counts["writes"] += len(updates)
+
+    def _apply_change(self, matrix, rankings, match_type, uid, old, new):
+        """Cập nhật rankings (tại chỗ) cho thay đổi của uid; trả về tập user cần ghi lại"""
+        dirty = set()
+        chart_changed = _fields(old, CHART_FIELDS) != _fields(new, CHART_FIELDS)
+        display_changed = _fields(old, DISPLAY_FIELDS) != _fields(new, DISPLAY_FIELDS)
+        matchable = new is not None and is_matchable(new) and matrix.row(uid) is not None
+
+        if not matchable:
+            # Bị xoá / không còn đủ dữ liệu → rời khỏi mọi danh sách
+            rankings.pop(uid, None)
+            for other, ranking in list(rankings.items()):
+                if ranking and any(c == uid for c, _ in ranking):
+                    rankings[other] = self._rank(matrix, other, match_type)
+                    if self._shown(rankings[other]) != self._shown(ranking):
+                        dirty.add(other)
+            return dirty
+
+        if not chart_changed and uid in rankings:
+            # Chỉ đổi thông tin hiển thị → ghi lại các danh sách đang hiện uid
+            if display_changed:
+                for other, ranking in rankings.items():
+                    if ranking and uid in self._shown(ranking):
+                        dirty.add(other)
+            return dirty
+
+        # Bản đồ đổi (hoặc user mới): danh sách của chính uid xếp lại từ đầu
+        rankings[uid] = self._rank(matrix, uid, match_type)
+        dirty.add(uid)
+
+        # Điểm của uid trong danh sách của mọi người khác: 1 lượt vector hoá
+        scores = matrix.score(matrix.vector(uid), match_type)
+        for other, ranking in list(rankings.items()):
+            if other == uid or ranking is None:
+                continue
+            row = matrix.row(other)
+            if row is None:
+                continue
+            score = round(float(scores[row]), 1)
+            patched = self._patch(matrix, other, ranking, uid, score, match_type)
+            if patched is None:
+                continue
+            shown = self._shown(patched)
+            if shown != self._shown(ranking) or (display_changed and uid in shown):
+                dirty.add(other)
+            rankings[other] = patched
+        return dirty
+
+    def _shown(self, ranking):
+        """uid các ứng viên đang hiển thị (thứ tự quan trọng, điểm lệch nhỏ thì bỏ qua)"""
+        return [c for c, _ in (ranking or [])[:self.display_k]]
+
+    def _patch(self, matrix, owner, ranking, uid, score, match_type):
+        """
+        Danh sách mới của owner sau khi điểm của uid đổi thành score;
+        None nếu không ảnh hưởng. uid tụt khỏi top-K thì xếp lại owner đầy đủ
+        (người đứng thứ K+1 chưa được lưu).
+        """
+        pos = next((i for i, (c, _) in enumerate(ranking) if c == uid), None)
+        full = len(ranking) >= self.k
+        cutoff = ranking[-1][1] if ranking else None
+
+        if pos is None:
+            if full and score <= cutoff:
+                return None
+            patched = ranking + [(uid, score)]
+        else:
+            rest = ranking[:pos] + ranking[pos + 1:]
+            if full and rest and score < rest[-1][1]:
+                return self._rank(matrix, owner, match_type)
+            patched = rest + [(uid, score)]
+
+        self.counts["patched"] += 1
+        patched.sort(key=lambda item: -item[1])
+        return patched[:self.k]
+
+    # ---------- Đọc ----------
+    def get(self, uid, match_type):
+        """Bảng xếp hạng đã materialize (list (uid, điểm)) hoặc None nếu chưa có"""
+        with self._lock:
+            ranking = self._rankings.get(match_type, {}).get(uid)
+        return list(ranking) if ranking is not None else None
+
+    def stats(self):
+        with self._lock:
+            ranked = len(next(iter(self._rankings.values()), {}))
+        return {
+            **self.counts,
+            "ready": self.ready,
+            "ranked_users": ranked,
+            "pending_events": self._events.qsize(),
+        }
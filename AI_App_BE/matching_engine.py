@@ -0,0 +1,248 @@
+# -------------------------------------------------
+#  Engine chấm điểm ghép cặp cục bộ (NumPy)
+# -------------------------------------------------
+# Mã hoá mỗi user thành mảng số nhỏ gọn rồi chấm điểm 1 user với toàn bộ
+# ứng viên trong một lượt NumPy, để chỉ gửi shortlist top-K cho Gemini.
+from collections import namedtuple
+
+import numpy as np
+
+SIGNS = [
+    "Bạch Dương", "Kim Ngưu", "Song Tử", "Cự Giải",
+    "Sư Tử", "Xử Nữ", "Thiên Bình", "Bọ Cạp",
+    "Nhân Mã", "Ma Kết", "Bảo Bình", "Song Ngư",
+]
+SIGN_INDEX = {name: i for i, name in enumerate(SIGNS)}
+SIGN_INDEX["Thiên Yết"] = SIGN_INDEX["Bọ Cạp"]
+
+PLANETS = ["sun", "moon", "mercury", "venus", "mars"]
+SUN, MOON, MERCURY, VENUS, MARS = range(len(PLANETS))
+ELEMENTS = ["fire", "earth", "air", "water"]
+MATCH_TYPES = ["redflag", "greenflag", "karmic", "destiny", "twinflame"]
+
+# Bảng giá trị theo khoảng cách cung (0..6):
+# hợp, bán lục hợp, lục hợp, vuông, tam hợp, lệch 150°, đối
+HARMONY = np.array([0.8, 0.1, 0.6, -0.7, 1.0, -0.3, -0.4], dtype=np.float32)
+TENSION = np.array([0.0, 0.2, 0.0, 1.0, 0.0, 0.5, 0.8], dtype=np.float32)
+INTENSITY = np.array([1.0, 0.0, 0.1, 0.8, 0.1, 0.3, 1.0], dtype=np.float32)
+MIRROR = np.array([1.0, 0.2, 0.3, 0.0, 0.5, 0.0, 0.4], dtype=np.float32)
+
+# Cấu hình từng loại kết nối:
+#   pairs:  (hành tinh của tôi, hành tinh đối phương, trọng số) - tự đối xứng hoá
+#   houses: (nhà của tôi, hành tinh đối phương, trọng số) - tính cả 2 chiều
+#   element: "similar" | "different"
+#   mix: tỷ trọng (hành tinh, nguyên tố, nhà)
+MATCH_PROFILES = {
+    "greenflag": {
+        "table": HARMONY,
+        "pairs": [(SUN, SUN, 1.0), (MOON, MOON, 1.5), (MERCURY, MERCURY, 1.0),
+                  (VENUS, VENUS, 1.0), (SUN, MOON, 1.0), (VENUS, MARS, 0.5)],
+        "houses": [(5, VENUS, 1.0), (7, SUN, 1.0), (11, MOON, 0.5)],
+        "element": "similar",
+        "mix": (0.6, 0.3, 0.1),
+    },
+    "redflag": {
+        "table": TENSION,
+        "pairs": [(MARS, MARS, 1.5), (VENUS, MARS, 1.5), (MOON, MARS, 1.0),
+                  (SUN, SUN, 1.0), (MERCURY, MERCURY, 1.0), (MOON, MOON, 1.0)],
+        "houses": [(8, MARS, 1.0), (12, MOON, 1.0), (6, MERCURY, 0.5)],
+        "element": "different",
+        "mix": (0.6, 0.3, 0.1),
+    },
+    "karmic": {
+        "table": INTENSITY,
+        "pairs": [(MOON, MOON, 1.0), (SUN, MOON, 1.5), (VENUS, VENUS, 1.0),
+                  (VENUS, MARS, 1.5), (SUN, SUN, 0.5)],
+        "houses": [(8, SUN, 1.0), (12, VENUS, 1.0), (4, MOON, 0.5)],
+        "element": "different",
+        "mix": (0.6, 0.1, 0.3),
+    },
+    "destiny": {
+        "table": HARMONY,
+        "pairs": [(SUN, MOON, 2.0), (VENUS, MARS, 1.5), (MOON, VENUS, 1.0),
+                  (SUN, SUN, 0.5)],
+        "houses": [(7, SUN, 1.5), (7, VENUS, 1.0), (5, MARS, 0.5), (10, SUN, 0.5)],
+        "element": "similar",
+        "mix": (0.5, 0.2, 0.3),
+    },
+    "twinflame": {
+        "table": MIRROR,
+        "pairs": [(SUN, SUN, 1.5), (MOON, MOON, 1.5), (MERCURY, MERCURY, 1.0),
+                  (VENUS, VENUS, 1.0), (MARS, MARS, 1.0)],
+        "houses": [(1, SUN, 1.0), (7, MOON, 0.5)],
+        "element": "similar",
+        "mix": (0.5, 0.3, 0.2),
+    },
+}
+
+ProfileVector = namedtuple("ProfileVector", ["planets", "elements", "houses"])
+
+
+def sign_index(value):
+    """Tên cung (tiếng Việt) → 0..11, không xác định → -1"""
+    if not value:
+        return -1
+    return SIGN_INDEX.get(str(value).strip(), -1)
+
+
+def sign_distance(a, b):
+    """Khoảng cách giữa 2 cung theo vòng hoàng đạo (0..6), chạy được trên mảng"""
+    d = np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)) % 12
+    return np.minimum(d, 12 - d)
+
+
+def encode_user(u):
+    """Mã hoá dữ liệu chiêm tinh của 1 user (document Firestore) thành ProfileVector"""
+    planets = np.array([sign_index(u.get(p)) for p in PLANETS], dtype=np.int8)
+    houses = np.array([sign_index(u.get(f"house{i}")) for i in range(1, 13)], dtype=np.int8)
+
+    elements = np.array(
+        [float(u.get(f"{e}Ratio") or 0) for e in ELEMENTS], dtype=np.float32
+    )
+    total = elements.sum()
+    if total > 0:
+        elements /= total
+
+    return ProfileVector(planets, elements, houses)
+
+
+def _compile(profile):
+    # Đối xứng hoá các cặp hành tinh (A.venus-B.mars cũng tính B.venus-A.mars)
+    pairs = []
+    for i, j, w in profile["pairs"]:
+        pairs.append((i, j, w))
+        if i != j:
+            pairs.append((j, i, w))
+    pair_arr = np.array(pairs, dtype=np.float32)
+
+    house_arr = np.array(profile["houses"], dtype=np.float32)
+
+    return {
+        "table": profile["table"],
+        "pi": pair_arr[:, 0].astype(np.intp),
+        "pj": pair_arr[:, 1].astype(np.intp),
+        "pw": pair_arr[:, 2],
+        "hh": house_arr[:, 0].astype(np.intp) - 1,
+        "hp": house_arr[:, 1].astype(np.intp),
+        "hw": house_arr[:, 2],
+        "element": profile["element"],
+        "mix": np.array(profile["mix"], dtype=np.float32),
+    }
+
+
+_COMPILED = {name: _compile(p) for name, p in MATCH_PROFILES.items()}
+
+
+class ProfileMatrix:
+    """
+    Ma trận ứng viên đã mã hoá: planets (N,5) int8, elements (N,4) float32,
+    houses (N,12) int8. Chấm điểm 1 user với cả N ứng viên trong một lượt.
+    """
+
+    def __init__(self, uids, planets, elements, houses):
+        self.uids = list(uids)
+        self.planets = planets
+        self.elements = elements
+        self.houses = houses
+        self._row = {uid: i for i, uid in enumerate(self.uids)}
+
+    @classmethod
+    def from_vectors(cls, items):
+        """items: iterable (uid, ProfileVector)"""
+        items = list(items)
+        if not items:
+            return cls(
+                [],
+                np.empty((0, len(PLANETS)), dtype=np.int8),
+                np.empty((0, len(ELEMENTS)), dtype=np.float32),
+                np.empty((0, 12), dtype=np.int8),
+            )
+        return cls(
+            [uid for uid, _ in items],
+            np.stack([v.planets for _, v in items]),
+            np.stack([v.elements for _, v in items]),
+            np.stack([v.houses for _, v in items]),
+        )
+
+    @classmethod
+    def from_users(cls, users):
+        """users: iterable (uid, dict dữ liệu user)"""
+        return cls.from_vectors((uid, encode_user(u)) for uid, u in users)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def row(self, uid):
+        return self._row.get(uid)
+
+    def vector(self, uid):
+        """ProfileVector của uid trong ma trận (None nếu không có)"""
+        i = self._row.get(uid)
+        if i is None:
+            return None
+        return ProfileVector(self.planets[i], self.elements[i], self.houses[i])
+
+    def score(self, me, match_type):
+        """
+        Điểm (0..100) của tất cả ứng viên so với `me` cho một loại kết nối.
+        `me` là ProfileVector hoặc dict dữ liệu user.
+        """
+        if match_type not in _COMPILED:
+            raise ValueError(f"Loại kết nối không hợp lệ: {match_type}")
+        if not isinstance(me, ProfileVector):
+            me = encode_user(me)
+        n = len(self.uids)
+        if n == 0:
+            return np.empty(0, dtype=np.float32)
+
+        c = _COMPILED[match_type]
+        table = c["table"]
+
+        # --- Hành tinh: (N, K) khoảng cách cung cho K cặp ---
+        mine = me.planets[c["pi"]]
+        theirs = self.planets[:, c["pj"]]
+        valid = (theirs >= 0) & (mine >= 0)[None, :]
+        dist = sign_distance(mine[None, :], theirs)
+        w = c["pw"][None, :] * valid
+        num = (table[dist] * w).sum(axis=1)
+        lo = w.sum(axis=1) * table.min()
+        hi = w.sum(axis=1) * table.max()
+        span = hi - lo
+        planet_score = np.where(span > 0, (num - lo) / np.where(span > 0, span, 1), 0.5)
+
+        # --- Nguyên tố: 1 - nửa khoảng cách L1 giữa 2 phân bố ---
+        similarity = 1.0 - 0.5 * np.abs(self.elements - me.elements[None, :]).sum(axis=1)
+        has_elements = (self.elements.sum(axis=1) > 0) & (me.elements.sum() > 0)
+        element_score = similarity if c["element"] == "similar" else 1.0 - similarity
+        element_score = np.where(has_elements, element_score, 0.5)
+
+        # --- Nhà: hành tinh đối phương rơi vào nhà của tôi (whole-sign) và ngược lại ---
+        hw = c["hw"]
+        my_cusps = me.houses[c["hh"]]
+        their_planets = self.planets[:, c["hp"]]
+        hit_forward = (their_planets == my_cusps[None, :]) & (my_cusps >= 0)[None, :]
+        their_cusps = self.houses[:, c["hh"]]
+        my_planets = me.planets[c["hp"]]
+        hit_backward = (their_cusps == my_planets[None, :]) & (their_cusps >= 0)
+        house_score = ((hit_forward * hw).sum(axis=1) + (hit_backward * hw).sum(axis=1)) / (2 * hw.sum())
+
+        a, b, h = c["mix"]
+        total = a * planet_score + b * element_score + h * house_score
+        return (total * 100).astype(np.float32)
+
+    def top_k(self, me, match_type, k, exclude=()):
+        """Trả về list (uid, điểm) của k ứng viên điểm cao nhất"""
+        scores = self.score(me, match_type)
+        if len(scores) == 0:
+            return []
+        for uid in exclude:
+            row = self._row.get(uid)
+            if row is not None:
+                scores[row] = -np.inf
+        k = min(k, len(scores))
+        idx = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        return [
+            (self.uids[i], round(float(scores[i]), 1))
+            for i in idx if np.isfinite(scores[i])
+        ]
@@ -0,0 +1,85 @@
+# -------------------------------------------------
+#  Migration 1 lần: notifications (global) → users/{uid}/notifications
+# -------------------------------------------------
+# Ví dụ:
+#   python migrate_notifications.py --dry-run
+#   python migrate_notifications.py --delete-source
+#
+# Giữ nguyên document ID (chạy lại nhiều lần vẫn an toàn), bỏ các trường trùng
+# lặp (id, userId, thông tin sender ở top-level) và thêm expireAt cho TTL.
+import argparse
+import sys
+from datetime import datetime, timedelta, timezone
+
+from main import db, NOTIFICATION_TTL_DAYS, FIRESTORE_BATCH_LIMIT, notification_ref
+
+# Trường đã có trong navigationData.params hoặc suy ra được từ đường dẫn doc
+DROPPED_FIELDS = {"id", "userId"}
+
+
+def compact_notification(data):
+    compact = {k: v for k, v in data.items() if k not in DROPPED_FIELDS}
+
+    params = (compact.get("navigationData") or {}).get("params") or {}
+    for key, value in params.items():
+        if key != "message" and compact.get(key) == value:
+            compact.pop(key)
+
+    compact.setdefault("read", False)
+    compact.setdefault("navigable", bool(compact.get("navigationData")))
+    created_at = compact.get("createdAt")
+    if not hasattr(created_at, "timestamp"):
+        created_at = datetime.now(timezone.utc)
+    compact["expireAt"] = created_at + timedelta(days=NOTIFICATION_TTL_DAYS)
+    return compact
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển thông báo sang subcollection của từng user")
+    parser.add_argument("--delete-source", action="store_true", help="Xoá doc gốc sau khi đã chép")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ đếm, không ghi")
+    args = parser.parse_args(argv)
+
+    stats = {"migrated": 0, "skipped": 0, "expired": 0}
+    now = datetime.now(timezone.utc)
+    batch, pending = db.batch(), 0
+
+    for doc in db.collection("notifications").stream():
+        data = doc.to_dict()
+        user_id = data.get("userId")
+        if not user_id:
+            stats["skipped"] += 1
+            print(f"⚠️ Bỏ qua {doc.id}: thiếu userId")
+            continue
+
+        compact = compact_notification(data)
+        expired = compact["expireAt"] < now
+        stats["expired" if expired else "migrated"] += 1
+        if args.dry_run:
+            continue
+
+        if not expired:
+            batch.set(notification_ref(user_id, doc.id), compact)
+            pending += 1
+        if args.delete_source:
+            batch.delete(doc.reference)
+            pending += 1
+        if pending >= FIRESTORE_BATCH_LIMIT - 1:
+            batch.commit()
+            batch, pending = db.batch(), 0
+            print(f"... {stats['migrated'] + stats['expired']} doc")
+
+    if pending:
+        batch.commit()
+
+    print("-------------------------------------------------")
+    print(f"✅ Đã chuyển: {stats['migrated']}")
+    print(f"⏳ Hết hạn (không chép): {stats['expired']}")
+    print(f"⚠️ Bỏ qua: {stats['skipped']}")
+    if args.dry_run:
+        print("📝 Dry-run: chưa ghi gì")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# -------------------------------------------------
+#  Pub/sub thông báo trong process (đẩy realtime qua SSE)
+# -------------------------------------------------
+# Mỗi client đang mở /notifications/stream giữ 1 hàng đợi riêng theo uid.
+# Chỉ phục vụ trong 1 process; chạy nhiều worker thì thay bằng broker
+# (Redis pub/sub, Firestore listener...) với cùng interface publish/subscribe.
+# subscribe() cho server thread (Flask), subscribe_async() cho event loop (Quart):
+# publish từ thread bất kỳ đều tới được cả 2 loại.
+import asyncio
+import queue
+import threading
+
+
+class AsyncSubscription:
+    """
+    Hàng đợi asyncio nhận sự kiện từ thread khác qua call_soon_threadsafe.
+    Số sự kiện chưa đọc đếm bằng bộ đếm có khoá (asyncio.Queue không an toàn
+    khi đọc từ thread khác), nên giới hạn maxsize được kiểm tra ngay lúc publish.
+    """
+
+    def __init__(self, loop, maxsize):
+        self._loop = loop
+        self._maxsize = maxsize
+        self._queue = asyncio.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def put_nowait(self, event):
+        with self._lock:
+            if self._pending >= self._maxsize:
+                raise queue.Full
+            self._pending += 1
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        except RuntimeError:
+            # Event loop đã đóng (server tắt) → coi như bỏ sự kiện
+            with self._lock:
+                self._pending -= 1
+            raise queue.Full
+
+    async def get(self, timeout=None):
+        """Sự kiện tiếp theo; hết timeout thì ném queue.Empty (giống queue.Queue.get)"""
+        try:
+            event = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise queue.Empty
+        with self._lock:
+            self._pending -= 1
+        return event
+
+
+class NotificationBus:
+    """uid → tập hàng đợi của các kết nối đang mở; publish không bao giờ block"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def subscribe(self, uid, max_connections=None):
+        """Hàng đợi cho 1 kết nối mới; None nếu đã đủ max_connections kết nối"""
+        return self._add(uid, queue.Queue(maxsize=self.max_queue), max_connections)
+
+    def subscribe_async(self, uid, max_connections=None):
+        """Gọi trong event loop đang chạy; trả về AsyncSubscription (None nếu đã đủ kết nối)"""
+        return self._add(uid, AsyncSubscription(asyncio.get_running_loop(), self.max_queue), max_connections)
+
+    def _add(self, uid, q, max_connections):
+        # Đếm và thêm trong cùng 1 lần giữ khoá → các kết nối mở đồng thời không vượt giới hạn
+        with self._lock:
+            if max_connections is not None and self._connections() >= max_connections:
+                self.rejected += 1
+                return None
+            self._subscribers.setdefault(uid, set()).add(q)
+        return q
+
+    def _connections(self):
+        return sum(len(s) for s in self._subscribers.values())
+
+    def unsubscribe(self, uid, q):
+        with self._lock:
+            subscribers = self._subscribers.get(uid)
+            if not subscribers:
+                return
+            subscribers.discard(q)
+            if not subscribers:
+                del self._subscribers[uid]
+
+    def publish(self, uid, event):
+        """Trả về số kết nối nhận được; hàng đợi đầy (client quá chậm) thì bỏ sự kiện"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(uid, ()))
+            self.published += 1
+
+        delivered = 0
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+
+        with self._lock:
+            self.delivered += delivered
+        return delivered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._subscribers),
+                "connections": self._connections(),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+            }
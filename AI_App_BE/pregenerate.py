@@ -0,0 +1,166 @@
+# -------------------------------------------------
+#  Job sinh trước dự đoán (chạy bằng cron mỗi đêm)
+# -------------------------------------------------
+# Ví dụ:
+#   GEMINI_RPM=240 python pregenerate.py --mode users --day tomorrow --workers 8
+#   python pregenerate.py --mode signs --day tomorrow --categories daily,love
+#
+# Dùng đúng prompt của /generate, ghi vào cache dự đoán để buổi sáng
+# toàn bộ request được phục vụ từ cache.
+# Tốc độ gọi Gemini do GeminiClient của main giới hạn (GEMINI_RPM / GEMINI_BURST),
+# job này không có limiter riêng: muốn chạy nhanh/chậm hơn thì đặt biến môi trường.
+# (worker chờ quota quá GEMINI_QUEUE_TIMEOUT sẽ báo lỗi → đừng để --workers quá lớn so với GEMINI_RPM).
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+from main import (
+    db,
+    gemini,
+    PREDICTION_CATEGORY_MAP,
+    resolve_prediction_day,
+    get_cached_prediction,
+    generate_and_save_prediction,
+    get_cached_template,
+    generate_and_save_template,
+)
+from matching_engine import SIGNS
+
+
+def iter_user_jobs(categories, day, active_days):
+    """Mỗi user có đủ name/sun/moon × mỗi category"""
+    query = db.collection("users").select(["name", "sun", "moon", "timezone", "updatedAt"])
+    since = datetime.now(timezone.utc) - timedelta(days=active_days) if active_days else None
+
+    for doc in query.stream():
+        u = doc.to_dict()
+        if not (u.get("name") and u.get("sun") and u.get("moon")):
+            continue
+        updated_at = u.get("updatedAt")
+        if since and (not updated_at or updated_at < since):
+            continue
+
+        target_date, expires_at = resolve_prediction_day(day, u.get("timezone"))
+        for category in categories:
+            yield {
+                "uid": doc.id,
+                "name": u["name"],
+                "sun": u["sun"],
+                "moon": u["moon"],
+                "category": category,
+                "target_date": target_date,
+                "expires_at": expires_at,
+            }
+
+
+def iter_sign_jobs(categories, day, tz_name):
+    """12 × 12 tổ hợp Mặt Trời/Mặt Trăng × mỗi category (nội dung dùng chung)"""
+    target_date, expires_at = resolve_prediction_day(day, tz_name)
+    for sun in SIGNS:
+        for moon in SIGNS:
+            for category in categories:
+                yield {
+                    "sun": sun,
+                    "moon": moon,
+                    "category": category,
+                    "target_date": target_date,
+                    "expires_at": expires_at,
+                }
+
+
+def run_job(job, dry_run):
+    """Trả về "cached" | "generated" | "dry_run"; lỗi được ném ra ngoài"""
+    day_key = job["target_date"].isoformat()
+
+    if "uid" in job:
+        if get_cached_prediction(job["uid"], job["name"], job["sun"], job["moon"], job["category"], day_key):
+            return "cached"
+        if dry_run:
+            return "dry_run"
+        generate_and_save_prediction(
+            job["uid"], job["name"], job["sun"], job["moon"],
+            job["category"], job["target_date"], job["expires_at"],
+        )
+        return "generated"
+
+    if get_cached_template(job["sun"], job["moon"], job["category"], day_key):
+        return "cached"
+    if dry_run:
+        return "dry_run"
+    generate_and_save_template(
+        job["sun"], job["moon"], job["category"], job["target_date"], job["expires_at"],
+    )
+    return "generated"
+
+
+def describe(job):
+    who = job.get("uid") or f"{job['sun']}/{job['moon']}"
+    return f"{who} - {job['category']} ({job['target_date'].isoformat()})"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sinh trước dự đoán vào cache")
+    parser.add_argument("--mode", choices=["users", "signs"], default="users",
+                        help="users: theo từng user; signs: theo tổ hợp cung (nội dung dùng chung)")
+    parser.add_argument("--day", default="tomorrow", help="today | tomorrow | yesterday | YYYY-MM-DD")
+    parser.add_argument("--categories", default=",".join(PREDICTION_CATEGORY_MAP),
+                        help="Danh sách category, phân tách bằng dấu phẩy")
+    parser.add_argument("--workers", type=int, default=8, help="Số worker chạy song song")
+    parser.add_argument("--timezone", default=None, help="Múi giờ cho chế độ signs")
+    parser.add_argument("--active-days", type=int, default=0,
+                        help="Chỉ lấy user cập nhật trong N ngày gần nhất (0 = tất cả)")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ đếm, không gọi Gemini")
+    args = parser.parse_args(argv)
+
+    categories = [c.strip() for c in args.categories.split(",") if c.strip()]
+    unknown = [c for c in categories if c not in PREDICTION_CATEGORY_MAP]
+    if unknown:
+        parser.error(f"Category không hợp lệ: {', '.join(unknown)}")
+    try:
+        resolve_prediction_day(args.day, args.timezone)
+    except ValueError as e:
+        parser.error(f"--day không hợp lệ: {e}")
+
+    if args.mode == "users":
+        jobs = list(iter_user_jobs(categories, args.day, args.active_days))
+    else:
+        jobs = list(iter_sign_jobs(categories, args.day, args.timezone))
+
+    print(f"🌙 Pre-generate {len(jobs)} job ({args.mode}, {args.day}) với {args.workers} worker, "
+          f"{gemini.bucket.rate:.2f} req/s (GEMINI_RPM)")
+
+    stats = {"generated": 0, "cached": 0, "dry_run": 0, "failed": 0}
+    failures = []
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_job, job, args.dry_run): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                stats[future.result()] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                failures.append((describe(job), str(e)))
+                print(f"❌ {describe(job)}: {str(e)}")
+            if done % 50 == 0:
+                print(f"... {done}/{len(jobs)}")
+
+    elapsed = time.monotonic() - started
+    throughput = stats["generated"] / elapsed if elapsed > 0 else 0.0
+
+    print("-------------------------------------------------")
+    print(f"✅ Sinh mới: {stats['generated']}")
+    print(f"♻️ Đã có cache: {stats['cached']}")
+    if args.dry_run:
+        print(f"📝 Cần sinh (dry-run): {stats['dry_run']}")
+    print(f"❌ Lỗi: {stats['failed']}")
+    print(f"⏱️ {elapsed:.1f}s — {throughput:.2f} dự đoán/giây")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+# -------------------------------------------------
+#  Index hồ sơ user trong bộ nhớ (đồng bộ bằng on_snapshot)
+# -------------------------------------------------
+# Bootstrap 1 lần từ snapshot đầu tiên của collection `users`, sau đó listener
+# Firestore giữ index luôn mới. Các route đọc user từ đây thay vì quét/đọc
+# Firestore cho mỗi request.
+import threading
+
+from firebase_admin import firestore
+
+from matching_engine import ProfileMatrix, encode_user
+
+# Chỉ giữ các field mà các route thực sự dùng
+PROFILE_FIELDS = (
+    "name", "age", "avatar", "job", "personality", "mainElement",
+    "relationshipStatus", "partnerId", "matchId",
+    "sun", "moon", "mercury", "venus", "mars", "jupiter", "saturn",
+    "uranus", "neptune", "pluto", "ascendant", "descendant", "mc", "ic",
+    *[f"house{i}" for i in range(1, 13)],
+    "conjunctionAspect", "oppositionAspect", "trineAspect", "squareAspect", "sextileAspect",
+    "fireRatio", "earthRatio", "airRatio", "waterRatio",
+)
+
+
+def compact_profile(raw):
+    """Rút gọn document user về các field trong PROFILE_FIELDS"""
+    return {k: raw[k] for k in PROFILE_FIELDS if k in raw and raw[k] not in (None, "")}
+
+
+def is_matchable(record):
+    return bool(record.get("sun") and record.get("moon"))
+
+
+class UserProfileIndex:
+    """
+    Index uid → hồ sơ rút gọn, dùng chung cho cả process.
+    Tự cập nhật qua listener on_snapshot của Firestore.
+    """
+
+    def __init__(self, db, collection="users", bootstrap_timeout=15):
+        self._db = db
+        self._collection = collection
+        self._bootstrap_timeout = bootstrap_timeout
+        self._lock = threading.RLock()
+        self._start_lock = threading.Lock()
+        self._records = {}
+        self._vectors = {}
+        self._version = 0
+        self._matrix = None
+        self._matrix_version = -1
+        self._watch = None
+        self._ready = threading.Event()
+        self._listeners = []
+
+    # ---------- Vòng đời ----------
+    def start(self):
+        """Đăng ký listener và chờ snapshot đầu tiên. Trả về True nếu index sẵn sàng."""
+        with self._start_lock:
+            if self._watch is None:
+                try:
+                    self._watch = self._db.collection(self._collection).on_snapshot(self._on_snapshot)
+                except Exception as e:
+                    print(f"⚠️ Không thể khởi động profile index: {str(e)}")
+                    self._watch = None
+                    return False
+        if not self._ready.wait(self._bootstrap_timeout):
+            print("⚠️ Profile index chưa nhận được snapshot đầu tiên")
+            return False
+        return True
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """Chờ snapshot đầu tiên (không tự khởi động listener)"""
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        with self._start_lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+            self._ready.clear()
+
+    def add_listener(self, callback):
+        """callback(uid, old_record, new_record) sau mỗi thay đổi (new_record=None khi bị xoá)"""
+        self._listeners.append(callback)
+
+    # ---------- Đồng bộ ----------
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        events = []
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                old = self._records.get(doc.id)
+                if change.type.name == "REMOVED":
+                    self._remove(doc.id)
+                    new = None
+                else:
+                    new = compact_profile(doc.to_dict() or {})
+                    if new == old:
+                        continue
+                    self._put(doc.id, new)
+                events.append((doc.id, old, new))
+            bootstrapping = not self._ready.is_set()
+
+        if bootstrapping:
+            print(f"✅ Profile index đã nạp {len(self._records)} user")
+            self._ready.set()
+            return
+
+        self._notify(events)
+
+    def _notify(self, events):
+        for uid, old, new in events:
+            for callback in self._listeners:
+                try:
+                    callback(uid, old, new)
+                except Exception as e:
+                    print(f"⚠️ Profile index listener lỗi ({uid}): {str(e)}")
+
+    def _put(self, uid, record):
+        self._records[uid] = record
+        if is_matchable(record):
+            self._vectors[uid] = encode_user(record)
+        else:
+            self._vectors.pop(uid, None)
+        self._version += 1
+
+    def _remove(self, uid):
+        if self._records.pop(uid, None) is not None:
+            self._vectors.pop(uid, None)
+            self._version += 1
+
+    def patch(self, uid, fields):
+        """
+        Ghi xuyên (write-through) sau khi chính server cập nhật Firestore,
+        để các request ngay sau đó không đọc dữ liệu cũ trước khi listener kịp chạy.
+        """
+        with self._lock:
+            old = self._records.get(uid)
+            if old is None:
+                return
+            record = dict(old)
+            for key, value in fields.items():
+                if value is firestore.DELETE_FIELD:
+                    record.pop(key, None)
+                elif value is firestore.SERVER_TIMESTAMP or key not in PROFILE_FIELDS:
+                    continue
+                else:
+                    record[key] = value
+            record = compact_profile(record)
+            if record == old:
+                return
+            self._put(uid, record)
+        self._notify([(uid, old, record)])
+
+    # ---------- Đọc ----------
+    def get(self, uid):
+        with self._lock:
+            record = self._records.get(uid)
+            return dict(record) if record is not None else None
+
+    def items(self):
+        with self._lock:
+            return list(self._records.items())
+
+    def matrix(self):
+        """ProfileMatrix của các user đủ dữ liệu ghép cặp (dựng lại khi index thay đổi)"""
+        with self._lock:
+            if self._matrix_version != self._version:
+                self._matrix = ProfileMatrix.from_vectors(self._vectors.items())
+                self._matrix_version = self._version
+            return self._matrix
+
+    def __len__(self):
+        return len(self._records)
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "users": len(self._records),
+            "matchable": len(self._vectors),
+            "version": self._version,
+        }
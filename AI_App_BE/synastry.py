@@ -0,0 +1,176 @@
+# -------------------------------------------------
+#  Engine chấm điểm tương hợp (synastry) cục bộ
+# -------------------------------------------------
+# Tính 5 chỉ số tương hợp của cặp đôi từ bản đồ sao của 2 người, không cần
+# Gemini: góc chiếu giữa các hành tinh của 2 bên (theo khoảng cách cung),
+# hành tinh của người này rơi vào nhà của người kia, tỷ lệ nguyên tố và độ
+# "êm" của các aspect trong bản đồ mỗi người. Kết quả tất định và đối xứng.
+from collections import namedtuple
+
+import numpy as np
+
+from matching_engine import HARMONY, sign_index, sign_distance
+
+POINTS = [
+    "sun", "moon", "mercury", "venus", "mars", "jupiter", "saturn",
+    "ascendant", "descendant", "mc", "ic",
+]
+POINT_INDEX = {name: i for i, name in enumerate(POINTS)}
+ELEMENTS = ["fire", "earth", "air", "water"]
+
+SCORE_KEYS = ("compatibility_score", "love_score", "trust_score", "communication_score", "marriage_score")
+
+# Mức hoà hợp giữa 2 nguyên tố: cùng nguyên tố > cặp bổ trợ (Hoả-Khí, Thổ-Thuỷ) > còn lại
+ELEMENT_AFFINITY = np.array([
+    # fire earth air  water
+    [1.0, 0.4, 0.8, 0.2],  # fire
+    [0.4, 1.0, 0.3, 0.8],  # earth
+    [0.8, 0.3, 1.0, 0.4],  # air
+    [0.2, 0.8, 0.4, 1.0],  # water
+], dtype=np.float32)
+
+# Cấu hình từng chỉ số:
+#   pairs:  (điểm của người này, điểm của người kia, trọng số) - tự đối xứng hoá
+#   houses: (nhà, hành tinh của người kia rơi vào, trọng số) - tính cả 2 chiều
+#   element / stability: tỷ trọng của nguyên tố và độ êm của aspect cá nhân
+SCORE_PROFILES = {
+    "love_score": {
+        "pairs": [("venus", "mars", 2.0), ("sun", "moon", 1.0), ("moon", "venus", 1.0),
+                  ("venus", "venus", 1.0), ("mars", "mars", 0.5),
+                  ("venus", "ascendant", 0.5), ("mars", "ascendant", 0.5)],
+        "houses": [(5, "venus", 1.0), (5, "mars", 1.0), (7, "venus", 1.0),
+                   (8, "mars", 1.0), (1, "venus", 0.5)],
+        "element": 0.15,
+        "stability": 0.0,
+    },
+    "trust_score": {
+        "pairs": [("moon", "moon", 2.0), ("sun", "moon", 1.0), ("moon", "saturn", 1.0),
+                  ("sun", "saturn", 0.5), ("moon", "ic", 1.0), ("venus", "saturn", 0.5)],
+        "houses": [(4, "moon", 1.0), (4, "sun", 0.5), (10, "saturn", 0.5)],
+        "element": 0.15,
+        "stability": 0.15,
+    },
+    "communication_score": {
+        "pairs": [("mercury", "mercury", 2.0), ("mercury", "moon", 1.0), ("mercury", "sun", 1.0),
+                  ("mercury", "venus", 0.5), ("mercury", "ascendant", 0.5), ("sun", "sun", 0.5)],
+        "houses": [(3, "mercury", 1.0), (9, "mercury", 1.0), (3, "sun", 0.5), (11, "mercury", 0.5)],
+        "element": 0.2,
+        "stability": 0.0,
+    },
+    "marriage_score": {
+        "pairs": [("sun", "moon", 1.5), ("venus", "saturn", 1.0), ("jupiter", "venus", 1.0),
+                  ("jupiter", "sun", 1.0), ("ascendant", "descendant", 1.5),
+                  ("sun", "descendant", 1.0), ("moon", "ic", 0.5), ("saturn", "saturn", 0.5),
+                  ("mc", "sun", 0.5)],
+        "houses": [(7, "sun", 1.0), (7, "venus", 1.0), (7, "moon", 0.5),
+                   (10, "saturn", 0.5), (4, "moon", 0.5)],
+        "element": 0.1,
+        "stability": 0.15,
+    },
+}
+
+# Trọng số các chỉ số con trong điểm tổng thể
+COMPATIBILITY_MIX = {"love_score": 0.3, "trust_score": 0.25, "communication_score": 0.2, "marriage_score": 0.25}
+COMPATIBILITY_ELEMENT = 0.15
+
+SOFT_ASPECTS = ("trineAspect", "sextileAspect")
+HARD_ASPECTS = ("squareAspect", "oppositionAspect")
+
+SynastryChart = namedtuple("SynastryChart", ["points", "houses", "elements", "stability"])
+
+
+def _count_aspects(value):
+    return len([a for a in str(value or "").split(",") if a.strip()])
+
+
+def encode_chart(u):
+    """Document user → SynastryChart (mảng số nhỏ gọn)"""
+    points = np.array([sign_index(u.get(p)) for p in POINTS], dtype=np.int8)
+    houses = np.array([sign_index(u.get(f"house{i}")) for i in range(1, 13)], dtype=np.int8)
+
+    elements = np.array([float(u.get(f"{e}Ratio") or 0) for e in ELEMENTS], dtype=np.float32)
+    total = elements.sum()
+    if total > 0:
+        elements /= total
+
+    soft = sum(_count_aspects(u.get(k)) for k in SOFT_ASPECTS)
+    hard = sum(_count_aspects(u.get(k)) for k in HARD_ASPECTS)
+    stability = (soft - hard) / (soft + hard) if soft + hard else 0.0
+
+    return SynastryChart(points, houses, elements, float(stability))
+
+
+def _compile(profile):
+    n = len(POINTS)
+    pairs = np.zeros((n, n), dtype=np.float32)
+    for a, b, w in profile["pairs"]:
+        i, j = POINT_INDEX[a], POINT_INDEX[b]
+        pairs[i, j] += w
+        if i != j:
+            pairs[j, i] += w
+
+    houses = np.zeros((12, n), dtype=np.float32)
+    for house, point, w in profile["houses"]:
+        houses[house - 1, POINT_INDEX[point]] += w
+
+    return {
+        "pairs": pairs,
+        "houses": houses,
+        "element": profile["element"],
+        "stability": profile["stability"],
+    }
+
+
+_COMPILED = {name: _compile(p) for name, p in SCORE_PROFILES.items()}
+
+
+def _overlay_hits(houses, points):
+    """hits[h, p] = hành tinh p của người kia nằm trong nhà h (cùng cung với đỉnh nhà)"""
+    valid = (houses[:, None] >= 0) & (points[None, :] >= 0)
+    return (houses[:, None] == points[None, :]) & valid
+
+
+def _to_score(x):
+    return int(np.clip(round(float(x)), 0, 100))
+
+
+def synastry_scores(me, partner):
+    """
+    5 chỉ số 0-100 cho cặp đôi (nhận document user hoặc SynastryChart).
+    Tất định, đối xứng: synastry_scores(a, b) == synastry_scores(b, a).
+    """
+    a = me if isinstance(me, SynastryChart) else encode_chart(me)
+    b = partner if isinstance(partner, SynastryChart) else encode_chart(partner)
+
+    # Góc chiếu giữa mọi cặp điểm (11×11) trong một lượt
+    valid = (a.points[:, None] >= 0) & (b.points[None, :] >= 0)
+    harmony = HARMONY[sign_distance(a.points[:, None], b.points[None, :])]
+
+    hits_ab = _overlay_hits(a.houses, b.points)
+    hits_ba = _overlay_hits(b.houses, a.points)
+
+    element_x = float(a.elements @ ELEMENT_AFFINITY @ b.elements)
+    element_x = (element_x - 0.5) * 2 if a.elements.any() and b.elements.any() else 0.0
+    stability_x = (a.stability + b.stability) / 2
+
+    has_houses = bool((a.houses >= 0).any() or (b.houses >= 0).any())
+
+    scores = {}
+    for key, cfg in _COMPILED.items():
+        weights = cfg["pairs"] * valid
+        pair_x = float((weights * harmony).sum() / weights.sum()) if weights.sum() else 0.0
+
+        total = cfg["houses"].sum() * 2
+        overlay = float((cfg["houses"] * hits_ab).sum() + (cfg["houses"] * hits_ba).sum()) / total
+        overlay_bonus = 20 * min(1.0, overlay * 3) - 5 if has_houses else 0.0
+
+        pair_weight = 1 - cfg["element"] - cfg["stability"]
+        x = pair_weight * pair_x + cfg["element"] * element_x + cfg["stability"] * stability_x
+        scores[key] = _to_score(50 + 50 * x + overlay_bonus)
+
+    mixed = sum(scores[k] * w for k, w in COMPATIBILITY_MIX.items())
+    element_score = 50 + 50 * element_x
+    scores["compatibility_score"] = _to_score(
+        (1 - COMPATIBILITY_ELEMENT) * mixed + COMPATIBILITY_ELEMENT * element_score
+    )
+    return {k: scores[k] for k in SCORE_KEYS}
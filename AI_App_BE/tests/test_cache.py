@@ -0,0 +1,184 @@
+# -------------------------------------------------
+#  TTLCache (LRU + hết hạn) và SingleFlight
+# -------------------------------------------------
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import AsyncSingleFlight, SingleFlight, TTLCache, make_cache_key  # noqa: E402
+
+
+# ---------- TTLCache ----------
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a mới dùng → b bị đẩy ra trước
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert cache.evictions == 1
+
+
+def test_cache_entries_expire():
+    cache = TTLCache(maxsize=10, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a", "missing") == "missing"
+    assert cache.get("b") == 2
+    assert cache.expirations == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_non_positive_ttl_is_not_stored():
+    cache = TTLCache(ttl=0)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=-1)
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_cache_set_refreshes_value_and_expiry():
+    cache = TTLCache(maxsize=2, ttl=0.05)
+    cache.set("a", 1)
+    time.sleep(0.03)
+    cache.set("a", 2)
+    time.sleep(0.03)
+    assert cache.get("a") == 2
+
+
+def test_cache_delete_and_clear():
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.delete("a")
+    cache.delete("missing")
+    assert cache.get("a") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_cache_key_is_deterministic():
+    assert make_cache_key("u1", "daily", 1) == make_cache_key("u1", "daily", 1)
+    assert make_cache_key("u1", "daily", 1) != make_cache_key("u1", "daily", "1")
+    assert len(make_cache_key("x")) == 64
+
+
+# ---------- SingleFlight ----------
+def run_concurrently(n, target):
+    barrier = threading.Barrier(n)
+    results, errors = [], []
+
+    def worker():
+        barrier.wait()
+        try:
+            results.append(target())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return "kết quả"
+
+    results, errors = run_concurrently(8, lambda: flight.do("k", slow))
+    assert errors == []
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * 7
+    assert {value for value, _ in results} == {"kết quả"}
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": 7}
+
+
+def test_single_flight_shares_errors_then_retries():
+    flight = SingleFlight()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        time.sleep(0.1)
+        raise RuntimeError("hỏng")
+
+    results, errors = run_concurrently(5, lambda: flight.do("k", failing))
+    assert results == []
+    assert len(errors) == 5 and all(isinstance(e, RuntimeError) for e in errors)
+    assert len(calls) == 1
+
+    # Lỗi không bị giữ lại: lần gọi sau chạy lại fn
+    assert flight.do("k", lambda: "ok") == ("ok", False)
+
+
+def test_single_flight_distinct_keys_run_separately():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)
+    assert flight.stats()["leaders"] == 2
+
+
+def test_async_single_flight_coalesces_and_propagates_errors():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        results = await asyncio.gather(*[flight.do("k", slow) for _ in range(6)])
+
+        async def failing():
+            await asyncio.sleep(0.05)
+            raise RuntimeError("hỏng")
+
+        errors = await asyncio.gather(*[flight.do("e", failing) for _ in range(3)], return_exceptions=True)
+        return flight, calls, results, errors
+
+    flight, calls, results, errors = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(results) == [("ok", False)] + [("ok", True)] * 5
+    assert len(errors) == 3 and all(isinstance(e, RuntimeError) for e in errors)
+    assert flight.stats() == {"in_flight": 0, "leaders": 2, "shared": 7}
+
+
+def test_async_single_flight_waiter_cancel_does_not_cancel_leader():
+    async def scenario():
+        flight = AsyncSingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        leader = asyncio.create_task(flight.do("k", slow))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do("k", slow))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(scenario()) == ("ok", False)
@@ -0,0 +1,169 @@
+# -------------------------------------------------
+#  Token bucket, circuit breaker và retry của GeminiClient
+# -------------------------------------------------
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_client import CircuitBreaker, GeminiClient, GeminiUnavailable, TokenBucket  # noqa: E402
+
+
+class FakeModel:
+    """Model giả: lần lượt ném lỗi / trả text theo outcomes"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_client(model, **kwargs):
+    options = dict(requests_per_minute=0, max_retries=3, backoff_base=0, breaker_threshold=1, breaker_reset=0.05)
+    options.update(kwargs)
+    client = GeminiClient("fake", **options)
+    client._model = lambda: model
+    return client
+
+
+# ---------- TokenBucket ----------
+def test_bucket_burst_then_wait():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve(1) == 0.0
+    assert bucket.reserve(1) == 0.0
+    wait = bucket.reserve(1)
+    assert 0 < wait <= 0.1
+
+
+def test_bucket_refuses_beyond_max_wait_without_reserving():
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.reserve(0) == 0.0
+    assert bucket.reserve(0.5) is None
+    # Lần từ chối không giữ chỗ → vẫn chỉ phải chờ ~1 token
+    assert bucket.reserve(5) <= 1.0
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=100, capacity=3)
+    for _ in range(3):
+        bucket.reserve(1)
+    time.sleep(0.1)
+    assert bucket.available() == pytest.approx(3, abs=0.01)
+
+
+def test_bucket_zero_rate_is_unlimited():
+    bucket = TokenBucket(rate=0, capacity=1)
+    assert all(bucket.reserve(0) == 0.0 for _ in range(100))
+
+
+# ---------- CircuitBreaker ----------
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() > 9
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_breaker_half_open_allows_single_probe():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.opens == 2
+    assert breaker.retry_after() > 0.04
+
+
+# ---------- GeminiClient ----------
+def test_client_retries_transient_errors():
+    model = FakeModel([ConnectionError("boom"), "ok"])
+    client = make_client(model, breaker_threshold=5)
+    assert client.generate("p") == "ok"
+    assert model.calls == 2
+    assert client.counts["retries"] == 1
+
+
+def test_client_opens_breaker_and_short_circuits():
+    model = FakeModel([ConnectionError("boom")])
+    client = make_client(model, max_retries=0, breaker_reset=10)
+    with pytest.raises(GeminiUnavailable):
+        client.generate("p")
+    with pytest.raises(GeminiUnavailable):
+        client.generate("p")
+    assert model.calls == 1
+    assert client.counts["short_circuited"] == 1
+
+
+def test_failed_probe_reopens_instead_of_retrying():
+    model = FakeModel([ConnectionError("boom")])
+    client = make_client(model)
+    with pytest.raises(GeminiUnavailable):
+        client.generate("p")
+    assert client.breaker.state == "open"
+    retries = client.counts["retries"]
+
+    time.sleep(0.06)
+    with pytest.raises(GeminiUnavailable):
+        client.generate("p")
+
+    breaker = client.breaker
+    assert breaker.state == "open"
+    assert not breaker._probing
+    assert breaker.failures == 2
+    assert client.counts["retries"] == retries
+    assert breaker.retry_after() > 0.04
+
+
+def test_probe_success_closes_breaker():
+    model = FakeModel([ConnectionError("boom")])
+    client = make_client(model, max_retries=0)
+    with pytest.raises(GeminiUnavailable):
+        client.generate("p")
+
+    model.outcomes = ["ok"]
+    time.sleep(0.06)
+    assert client.generate("p") == "ok"
+    assert client.breaker.state == "closed"
+
+
+def test_request_errors_are_not_retried_and_keep_breaker_closed():
+    model = FakeModel([ValueError("bad prompt")])
+    client = make_client(model)
+    with pytest.raises(ValueError):
+        client.generate("p")
+    assert model.calls == 1
+    assert client.breaker.state == "closed"
@@ -0,0 +1,39 @@
+# -------------------------------------------------
+#  Doc love_matching_results định dạng cũ (thiếu source / shortlist)
+# -------------------------------------------------
+import os
+import sys
+
+from google.cloud.firestore_v1.document import DocumentSnapshot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+import main  # noqa: E402
+
+
+def snapshot(data, exists=True):
+    return DocumentSnapshot(None, data, exists, None, None, None)
+
+
+LEGACY = {"type": "greenflag", "uid": "u1", "users": [{"uid": "u2"}]}
+
+
+def test_legacy_doc_is_not_fresh():
+    data = main.love_match_data(snapshot(LEGACY))
+    assert data == LEGACY
+    assert not main.is_fresh_love_match(data, ["u2"])
+    assert data.get("users") == [{"uid": "u2"}]
+
+
+def test_missing_doc():
+    assert main.love_match_data(snapshot(None, exists=False)) is None
+    assert main.love_match_data(None) is None
+    assert not main.is_fresh_love_match(None, [])
+
+
+def test_fresh_gemini_doc():
+    data = main.love_match_data(snapshot({**LEGACY, "source": "gemini", "shortlist": ["u2", "u3"]}))
+    assert main.is_fresh_love_match(data, ["u2", "u3"])
+    assert not main.is_fresh_love_match(data, ["u3", "u2"])
@@ -0,0 +1,119 @@
+# -------------------------------------------------
+#  Materializer ghép cặp: cập nhật tăng dần == xếp hạng lại toàn bộ
+# -------------------------------------------------
+import os
+import random
+import sys
+from itertools import groupby
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from match_materializer import LoveMatchMaterializer  # noqa: E402
+from matching_engine import ELEMENTS, MATCH_TYPES, PLANETS, SIGNS, ProfileMatrix  # noqa: E402
+from profile_index import is_matchable  # noqa: E402
+
+
+class FakeIndex:
+    """Thay UserProfileIndex: hồ sơ trong dict, ma trận dựng lại mỗi lần gọi"""
+
+    def __init__(self, records):
+        self.records = dict(records)
+
+    def matrix(self):
+        return ProfileMatrix.from_users((uid, r) for uid, r in self.records.items() if is_matchable(r))
+
+    def change(self, uid, new):
+        old = self.records.get(uid)
+        if new is None:
+            self.records.pop(uid, None)
+        else:
+            self.records[uid] = new
+        return uid, old, new
+
+
+def random_profile(rng, name):
+    record = {p: rng.choice(SIGNS) for p in PLANETS}
+    record.update({f"house{i}": rng.choice(SIGNS) for i in range(1, 13)})
+    record.update({f"{e}Ratio": rng.randint(0, 50) for e in ELEMENTS})
+    record.update({"name": name, "age": rng.randint(18, 40)})
+    return record
+
+
+def mutate(rng, index, uid):
+    """Một thay đổi ngẫu nhiên: đổi bản đồ, đổi tên, mất dữ liệu, xoá, hoặc tạo mới"""
+    old = index.records.get(uid)
+    kind = rng.choice(["chart", "chart", "display", "unmatchable", "delete"]) if old else "new"
+    if kind == "delete":
+        return index.change(uid, None)
+    if kind == "new":
+        return index.change(uid, random_profile(rng, uid))
+    new = dict(old)
+    if kind == "chart":
+        new[rng.choice(PLANETS)] = rng.choice(SIGNS)
+        new[f"house{rng.randint(1, 12)}"] = rng.choice(SIGNS)
+    elif kind == "display":
+        new["name"] = f"{uid}-{rng.randint(0, 999)}"
+    else:
+        new.pop("moon", None)
+    return index.change(uid, new)
+
+
+def groups(ranking):
+    """[(điểm, tập uid)] — thứ tự trong cùng mức điểm không quan trọng"""
+    return [(score, {uid for uid, _ in items}) for score, items in groupby(ranking, key=lambda item: item[1])]
+
+
+def assert_matches_full_rank(materializer, index):
+    matrix = index.matrix()
+    for match_type in MATCH_TYPES:
+        for uid in matrix.uids:
+            got = materializer.get(uid, match_type)
+            want = matrix.top_k(matrix.vector(uid), match_type, materializer.k, exclude=[uid])
+            assert [s for _, s in got] == [s for _, s in want], (uid, match_type)
+            # Mức điểm cuối có thể bị cắt ở K → chỉ so tập uid các mức trên
+            assert groups(got)[:-1] == groups(want)[:-1], (uid, match_type)
+        assert materializer.get("missing", match_type) is None
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_updates_equal_full_rerank(seed):
+    rng = random.Random(seed)
+    index = FakeIndex((f"u{i}", random_profile(rng, f"u{i}")) for i in range(30))
+    persisted = []
+    materializer = LoveMatchMaterializer(index, persisted.extend, k=6, display_k=3)
+    materializer._bootstrap()
+    assert_matches_full_rank(materializer, index)
+
+    pool = [f"u{i}" for i in range(36)]
+    for _ in range(40):
+        # Đôi khi nhiều thay đổi dồn lại (kể cả cùng uid) trong 1 lượt
+        batch = [mutate(rng, index, rng.choice(pool)) for _ in range(rng.choice([1, 1, 3]))]
+        materializer._apply(batch)
+        assert_matches_full_rank(materializer, index)
+
+    assert materializer.counts["patched"] > 0
+    assert persisted
+
+
+def test_persist_only_when_shown_list_changes():
+    rng = random.Random(7)
+    index = FakeIndex((f"u{i}", random_profile(rng, f"u{i}")) for i in range(20))
+    persisted = []
+    materializer = LoveMatchMaterializer(index, persisted.extend, k=6, display_k=3)
+    materializer._bootstrap()
+
+    # Đổi field không liên quan → không ghi gì
+    uid, old, new = index.change("u0", {**index.records["u0"], "bio": "mới"})
+    materializer._apply([(uid, old, new)])
+    assert persisted == []
+
+    # Đổi tên → ghi lại đúng các danh sách đang hiện u0
+    showing = {
+        (owner, t) for t in MATCH_TYPES for owner in index.records
+        if "u0" in [c for c, _ in (materializer.get(owner, t) or [])[:3]]
+    }
+    uid, old, new = index.change("u0", {**index.records["u0"], "name": "An"})
+    materializer._apply([(uid, old, new)])
+    assert {(owner, t) for owner, t, _ in persisted} == showing
@@ -0,0 +1,93 @@
+# -------------------------------------------------
+#  NotificationBus: giới hạn kết nối và hàng đợi async nhận từ thread khác
+# -------------------------------------------------
+import asyncio
+import os
+import queue
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notification_bus import NotificationBus  # noqa: E402
+
+
+def test_concurrent_subscribes_never_exceed_cap():
+    bus = NotificationBus()
+    barrier = threading.Barrier(32)
+    results = []
+
+    def connect(i):
+        barrier.wait()
+        results.append(bus.subscribe(f"u{i % 4}", max_connections=10))
+
+    threads = [threading.Thread(target=connect, args=(i,)) for i in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    accepted = [q for q in results if q is not None]
+    assert len(accepted) == 10
+    stats = bus.stats()
+    assert stats["connections"] == 10
+    assert stats["rejected"] == 22
+
+
+def test_unsubscribe_frees_a_slot():
+    bus = NotificationBus()
+    q = bus.subscribe("u1", max_connections=1)
+    assert bus.subscribe("u2", max_connections=1) is None
+    bus.unsubscribe("u1", q)
+    assert bus.subscribe("u2", max_connections=1) is not None
+
+
+def test_sync_subscriber_drops_when_full():
+    bus = NotificationBus(max_queue=2)
+    q = bus.subscribe("u1")
+    assert [bus.publish("u1", i) for i in range(3)] == [1, 1, 0]
+    assert [q.get_nowait(), q.get_nowait()] == [0, 1]
+    assert bus.stats()["dropped"] == 1
+
+
+def test_async_subscriber_counts_drops_from_other_threads():
+    async def scenario():
+        bus = NotificationBus(max_queue=5)
+        sub = bus.subscribe_async("u1")
+
+        # Publish từ thread khác, client chưa đọc → chỉ 5 sự kiện đầu được nhận
+        publisher = threading.Thread(target=lambda: [bus.publish("u1", i) for i in range(8)])
+        publisher.start()
+        await asyncio.get_running_loop().run_in_executor(None, publisher.join)
+
+        received = [await sub.get(timeout=1) for _ in range(5)]
+        with pytest.raises(queue.Empty):
+            await sub.get(timeout=0.05)
+
+        # Đọc xong thì có chỗ cho sự kiện mới
+        bus.publish("u1", "again")
+        received.append(await sub.get(timeout=1))
+        return bus.stats(), received
+
+    stats, received = asyncio.run(scenario())
+    assert received == [0, 1, 2, 3, 4, "again"]
+    assert stats["delivered"] == 6
+    assert stats["dropped"] == 3
+    assert stats["published"] == 9
+
+
+def test_async_subscription_closed_loop_counts_as_dropped():
+    bus = NotificationBus()
+
+    async def subscribe():
+        return bus.subscribe_async("u1")
+
+    loop = asyncio.new_event_loop()
+    sub = loop.run_until_complete(subscribe())
+    loop.close()
+
+    assert bus.publish("u1", "late") == 0
+    assert bus.stats()["dropped"] == 1
+    assert sub._pending == 0
@@ -0,0 +1,70 @@
+# -------------------------------------------------
+#  /generate-batch: trả lời Gemini hỏng / sai cấu trúc, body không hợp lệ
+# -------------------------------------------------
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+import main  # noqa: E402
+
+USER = {"uid": "u1", "name": "An", "sun": "Bạch Dương", "moon": "Song Ngư"}
+
+
+@pytest.fixture
+def model_reply(monkeypatch):
+    """Gemini trả về reply["text"]; cache luôn trống, ghi cache trả lại dữ liệu đã ghi"""
+    reply = {"text": "{}"}
+    monkeypatch.setattr(main.gemini, "generate", lambda prompt, **kwargs: reply["text"])
+    monkeypatch.setattr(main, "get_cached_prediction", lambda *args: None)
+    monkeypatch.setattr(
+        main, "save_prediction",
+        lambda uid, name, sun, moon, category, day, data, expires_at=None:
+            data if isinstance(data, dict) else {"prediction": data},
+    )
+    return reply
+
+
+def post(body):
+    return main.app.test_client().post("/generate-batch", json={"userData": USER, **body})
+
+
+@pytest.mark.parametrize("text", ['{"2030-01-01": {"daily": "tr', "not json", "[1, 2]", '"text"'])
+def test_bad_reply_reports_each_part_missing(model_reply, text):
+    model_reply["text"] = text
+    response = post({"categories": ["daily", "love"], "days": ["today"]})
+
+    assert response.status_code == 200
+    results = response.get_json()["results"]["today"]
+    assert results["daily"]["error"] == "Gemini không trả về phần này"
+    assert results["love"]["error"] == "Gemini không trả về phần này"
+
+
+def test_wrong_day_shape_only_affects_that_day(model_reply):
+    dates = {
+        day: main.resolve_prediction_day(day)[0].isoformat()
+        for day in ("today", "tomorrow")
+    }
+    model_reply["text"] = (
+        f'{{"{dates["today"]}": ["không phải object"], '
+        f'"{dates["tomorrow"]}": {{"daily": "Ngày mai tốt"}}}}'
+    )
+    response = post({"categories": ["daily"], "days": ["today", "tomorrow"]})
+
+    results = response.get_json()["results"]
+    assert "error" in results["today"]["daily"]
+    assert results["tomorrow"]["daily"] == {"prediction": "Ngày mai tốt", "cached": False}
+
+
+@pytest.mark.parametrize("body", [
+    {"days": "today"},
+    {"days": [{"day": "today"}]},
+    {"categories": "daily"},
+    {"categories": [["daily"]]},
+])
+def test_malformed_lists_are_rejected(model_reply, body):
+    assert post(body).status_code == 400
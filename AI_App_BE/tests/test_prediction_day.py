@@ -0,0 +1,56 @@
+# -------------------------------------------------
+#  resolve_prediction_day: múi giờ lỗi và khoảng ngày cho phép
+# -------------------------------------------------
+import os
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+import main  # noqa: E402
+
+TZ = "Asia/Ho_Chi_Minh"
+
+
+def today():
+    return datetime.now(ZoneInfo(TZ)).date()
+
+
+@pytest.mark.parametrize("tz_name", [123, ["Asia/Tokyo"], "Not/AZone", "", None])
+def test_bad_timezone_falls_back_to_default(tz_name):
+    target, expires_at = main.resolve_prediction_day("today", tz_name)
+    assert target == datetime.now(ZoneInfo(main.DEFAULT_TIMEZONE)).date()
+    assert expires_at.tzinfo == ZoneInfo(main.DEFAULT_TIMEZONE)
+
+
+@pytest.mark.parametrize("offset", [-1, 0, 1, main.PREDICTION_MAX_DAYS_AHEAD])
+def test_explicit_dates_inside_window(offset):
+    day = today() + timedelta(days=offset)
+    target, expires_at = main.resolve_prediction_day(day.isoformat(), TZ)
+    assert target == day
+    assert main.seconds_until(expires_at) > 0
+
+
+@pytest.mark.parametrize("offset", [-2, -365, main.PREDICTION_MAX_DAYS_AHEAD + 1, 3650])
+def test_explicit_dates_outside_window_are_rejected(offset):
+    with pytest.raises(ValueError):
+        main.resolve_prediction_day((today() + timedelta(days=offset)).isoformat(), TZ)
+
+
+@pytest.mark.parametrize("day", ["not-a-date", 20300101, ["today"]])
+def test_malformed_day(day):
+    with pytest.raises(ValueError):
+        main.resolve_prediction_day(day, TZ)
+
+
+def test_generate_returns_400_for_bad_day_and_timezone():
+    client = main.app.test_client()
+    user = {"uid": "u1", "name": "An", "sun": "Bạch Dương", "moon": "Song Ngư", "timezone": 123}
+    response = client.post("/generate", json={"userData": user, "day": "2001-01-01"})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Giá trị day không hợp lệ"
@@ -0,0 +1,82 @@
+# -------------------------------------------------
+#  /generate khi Gemini gián đoạn: Flask và ASGI trả cùng 1 kết quả
+# -------------------------------------------------
+import asyncio
+import os
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+import main  # noqa: E402
+import asgi_app  # noqa: E402
+from gemini_client import GeminiUnavailable  # noqa: E402
+
+DAY = "2030-01-02"
+USER = {"uid": "u1", "name": "An", "sun": "Bạch Dương", "moon": "Song Ngư"}
+
+
+def previous_key(shared):
+    previous = (date.fromisoformat(DAY) - timedelta(days=1)).isoformat()
+    if shared:
+        return main.prediction_template_key(USER["sun"], USER["moon"], "daily", previous)
+    return main.prediction_cache_key(USER["uid"], USER["name"], USER["sun"], USER["moon"], "daily", previous)
+
+
+@pytest.fixture
+def gemini_down(monkeypatch):
+    """Gemini luôn lỗi; cache chỉ có những key trong dict trả về"""
+    store = {}
+
+    def unavailable(*args, **kwargs):
+        raise GeminiUnavailable("down", 5)
+
+    async def unavailable_async(*args, **kwargs):
+        unavailable()
+
+    monkeypatch.setattr(main, "resolve_prediction_day",
+                        lambda day, tz=None: (date.fromisoformat(DAY), None))
+    monkeypatch.setattr(main.gemini, "generate", unavailable)
+    monkeypatch.setattr(main.gemini, "generate_async", unavailable_async)
+    monkeypatch.setattr(main, "read_cached_doc", lambda collection, key: store.get(key))
+
+    async def read_async(collection, key):
+        return store.get(key)
+
+    monkeypatch.setattr(asgi_app, "read_cached_doc", read_async)
+    return store
+
+
+def call_both(body):
+    flask = main.app.test_client().post("/generate", json=body)
+
+    async def call_asgi():
+        response = await asgi_app.quart_app.test_client().post("/generate", json=body)
+        return response.status_code, await response.get_json()
+
+    asgi_status, asgi_json = asyncio.run(call_asgi())
+    return (flask.status_code, flask.get_json()), (asgi_status, asgi_json)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_stale_prediction_served_by_both_apps(gemini_down, shared):
+    gemini_down[previous_key(shared)] = {"prediction": f"Hôm qua của {main.NAME_PLACEHOLDER}"}
+    flask, asgi = call_both({"userData": USER, "category": "daily", "day": DAY, "shared": shared})
+
+    assert flask == asgi
+    status, payload = flask
+    assert status == 200
+    assert payload["stale"] is True
+    assert payload["prediction"] == ("Hôm qua của An" if shared else f"Hôm qua của {main.NAME_PLACEHOLDER}")
+
+
+def test_no_stale_prediction_returns_503_on_both_apps(gemini_down):
+    flask, asgi = call_both({"userData": USER, "category": "daily", "day": DAY})
+
+    assert flask == asgi
+    assert flask[0] == 503
+    assert flask[1]["retryAfter"] == 6
@@ -0,0 +1,60 @@
+# -------------------------------------------------
+#  StreamScrubber: lọc đoạn stream dùng chung cho Flask và ASGI
+# -------------------------------------------------
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+from main import NAME_PLACEHOLDER, StreamScrubber  # noqa: E402
+
+TEXTS = [
+    "Chào {NAME}, hôm nay {NAME} vui.\nSCORES:\nlove_score: 80",
+    "Không có marker, đuôi cắt dở {NA",
+    "{NAME}{NAME}SCORES:{NAME}",
+    "abc SCORE",
+    "",
+]
+
+
+def random_pieces(text, rng):
+    if len(text) < 2:
+        return [text] if text else []
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(0, min(8, len(text) - 1))))
+    return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+def expected(text, stop_marker, name):
+    if stop_marker and stop_marker in text:
+        text = text[:text.index(stop_marker)]
+    return text.replace(NAME_PLACEHOLDER, name) if name is not None else text
+
+
+@pytest.mark.parametrize("stop_marker", [None, "SCORES:"])
+@pytest.mark.parametrize("name", [None, "An"])
+@pytest.mark.parametrize("text", TEXTS)
+def test_any_split_gives_same_output(text, stop_marker, name):
+    rng = random.Random(text)
+    for _ in range(50):
+        scrubber = StreamScrubber(stop_marker, name)
+        sent = [scrubber.feed(piece) for piece in random_pieces(text, rng)]
+        sent.append(scrubber.flush())
+
+        assert "".join(sent) == expected(text, stop_marker, name)
+        assert scrubber.text == text
+        if name is not None:
+            # Không bao giờ gửi placeholder (kể cả bị cắt đôi giữa 2 đoạn)
+            assert all(NAME_PLACEHOLDER not in chunk for chunk in sent)
+
+
+def test_marker_split_across_pieces_is_never_sent():
+    scrubber = StreamScrubber("SCORES:")
+    sent = [scrubber.feed(p) for p in ["Bài viết SCO", "RES:\nlove_score: 90"]]
+    sent.append(scrubber.flush())
+    assert "".join(sent) == "Bài viết "
+    assert all("SCO" not in chunk for chunk in sent)
@@ -0,0 +1,95 @@
+# -------------------------------------------------
+#  Synastry và ProfileMatrix.score: đối xứng, tất định
+# -------------------------------------------------
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching_engine import ELEMENTS, MATCH_TYPES, PLANETS, SIGNS, ProfileMatrix, encode_user  # noqa: E402
+from synastry import POINTS, SCORE_KEYS, encode_chart, synastry_scores  # noqa: E402
+
+ASPECTS = ("trineAspect", "sextileAspect", "squareAspect", "oppositionAspect")
+
+
+def random_user(rng, sparse=False):
+    """Document user ngẫu nhiên; sparse=True thì bỏ trống bớt field"""
+    def maybe(value):
+        return None if sparse and rng.random() < 0.3 else value
+
+    u = {p: maybe(rng.choice(SIGNS)) for p in POINTS}
+    u.update({f"house{i}": maybe(rng.choice(SIGNS)) for i in range(1, 13)})
+    u.update({f"{e}Ratio": maybe(rng.randint(0, 60)) for e in ELEMENTS})
+    u.update({k: maybe(", ".join(rng.sample(PLANETS, rng.randint(0, 3)))) for k in ASPECTS})
+    return u
+
+
+@pytest.fixture
+def users():
+    rng = random.Random(21)
+    return [random_user(rng, sparse=i % 3 == 0) for i in range(60)]
+
+
+def test_synastry_symmetric(users):
+    for a, b in zip(users, reversed(users)):
+        assert synastry_scores(a, b) == synastry_scores(b, a)
+
+
+def test_synastry_deterministic_and_bounded(users):
+    for a, b in zip(users, users[1:]):
+        scores = synastry_scores(a, b)
+        assert tuple(scores) == SCORE_KEYS
+        assert all(isinstance(v, int) and 0 <= v <= 100 for v in scores.values())
+        assert synastry_scores(dict(a), dict(b)) == scores
+        # Dict và chart đã mã hoá cho cùng kết quả
+        assert synastry_scores(encode_chart(a), encode_chart(b)) == scores
+
+
+def test_synastry_empty_charts():
+    scores = synastry_scores({}, {})
+    assert scores == synastry_scores({}, {})
+    assert all(0 <= v <= 100 for v in scores.values())
+
+
+@pytest.mark.parametrize("match_type", MATCH_TYPES)
+def test_profile_matrix_score_symmetric(users, match_type):
+    matrix = ProfileMatrix.from_users((str(i), u) for i, u in enumerate(users))
+    table = np.stack([matrix.score(matrix.vector(uid), match_type) for uid in matrix.uids])
+    assert table.shape == (len(users), len(users))
+    np.testing.assert_allclose(table, table.T, atol=1e-3)
+    assert ((table >= 0) & (table <= 100)).all()
+
+
+@pytest.mark.parametrize("match_type", MATCH_TYPES)
+def test_profile_matrix_score_deterministic(users, match_type):
+    uids = [str(i) for i in range(len(users))]
+    matrix = ProfileMatrix.from_users(zip(uids, users))
+    rebuilt = ProfileMatrix.from_users(zip(uids, [dict(u) for u in users]))
+    for u in users[:10]:
+        # dict và ProfileVector cho cùng điểm, dựng lại ma trận cũng vậy
+        scores = matrix.score(u, match_type)
+        np.testing.assert_array_equal(scores, matrix.score(encode_user(u), match_type))
+        np.testing.assert_array_equal(scores, rebuilt.score(u, match_type))
+
+
+def test_profile_matrix_rejects_unknown_type(users):
+    matrix = ProfileMatrix.from_users([("a", users[0])])
+    with pytest.raises(ValueError):
+        matrix.score(users[1], "soulmate")
+
+
+def test_top_k_sorted_and_excludes(users):
+    matrix = ProfileMatrix.from_users((str(i), u) for i, u in enumerate(users))
+    ranking = matrix.top_k(matrix.vector("0"), "greenflag", 10, exclude=["0"])
+    assert len(ranking) == 10
+    assert "0" not in [uid for uid, _ in ranking]
+    scores = [s for _, s in ranking]
+    assert scores == sorted(scores, reverse=True)
+    assert min(scores) >= max(
+        round(float(s), 1) for uid, s in zip(matrix.uids, matrix.score(matrix.vector("0"), "greenflag"))
+        if uid not in {"0", *[u for u, _ in ranking]}
+    )
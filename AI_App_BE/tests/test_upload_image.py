@@ -0,0 +1,40 @@
+# -------------------------------------------------
+#  /upload-image JSON base64: job chạy quá UPLOAD_SYNC_TIMEOUT
+# -------------------------------------------------
+import base64
+import os
+import sys
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PREDICTION_COMPACTION_INTERVAL", "0")
+os.environ.setdefault("LOVE_MATCH_MATERIALIZE", "0")
+
+import main  # noqa: E402
+
+BODY = {"uid": "u1", "imageType": "avatar", "imageData": base64.b64encode(b"img").decode()}
+
+
+def test_slow_job_returns_202_with_job_id(monkeypatch):
+    pending = Future()
+    monkeypatch.setattr(main, "UPLOAD_SYNC_TIMEOUT", 0.01)
+    monkeypatch.setattr(main.image_pipeline, "submit", lambda uid, image_type, raw: ("job-1", pending))
+    monkeypatch.setattr(main.image_pipeline, "status", lambda job_id: {"status": "processing"})
+
+    response = main.app.test_client().post("/upload-image", json=BODY)
+
+    assert response.status_code == 202
+    assert response.get_json() == {
+        "success": True, "jobId": "job-1", "status": "processing", "imageType": "avatar"
+    }
+
+
+def test_finished_job_returns_image_url(monkeypatch):
+    done = Future()
+    done.set_result({"status": "done", "urls": {"medium": "https://img/m.webp", "thumb": "https://img/t.webp"}})
+    monkeypatch.setattr(main.image_pipeline, "submit", lambda uid, image_type, raw: ("job-2", done))
+
+    response = main.app.test_client().post("/upload-image", json=BODY)
+
+    assert response.status_code == 200
+    assert response.get_json()["imageUrl"] == "https://img/m.webp"
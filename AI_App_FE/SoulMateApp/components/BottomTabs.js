@@ -13,6 +13,7 @@ import { CommonActions, useNavigation, getFocusedRouteNameFromRoute } from '@rea
 
 import { Ionicons } from '@expo/vector-icons';
 import { LinearGradient } from 'expo-linear-gradient';
+import { useUnreadNotifications } from '../hook/useUnreadNotifications';
 
 // Screens
 import HomeScreen from '../screens/home/MainHome';
@@ -156,6 +157,8 @@ function ChatNavigator() {
 }
 
 export default function BottomTabs() {
+  const { unreadCount, refreshUnread } = useUnreadNotifications();
+
   return (
     <Tab.Navigator
       screenOptions={{
@@ -204,7 +207,9 @@ export default function BottomTabs() {
               color={focused ? '#ffb6d9' : '#ccc'}
             />
           ),
+          tabBarBadge: unreadCount > 0 ? unreadCount : undefined,
         }}
+        listeners={{ blur: refreshUnread }}
       />
 
       {/* CENTER HEART - Match */}
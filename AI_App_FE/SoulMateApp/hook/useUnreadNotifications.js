@@ -0,0 +1,50 @@
+import { useState, useEffect, useCallback } from 'react';
+import { auth } from '../config/firebaseConfig';
+import { getUnreadCount, onUnreadChanged, subscribeNotifications } from '../services/notificationService';
+
+/**
+ * Custom hook đếm thông báo chưa đọc cho badge
+ * (lấy số từ server, cộng thêm thông báo mới nhận realtime qua SSE;
+ * tự lấy lại số sau khi đánh dấu đã đọc / xoá thành công)
+ * @returns {Object} - { unreadCount, refreshUnread }
+ *
+ * @example
+ * const { unreadCount, refreshUnread } = useUnreadNotifications();
+ *
+ * <Tab.Screen
+ *   options={{ tabBarBadge: unreadCount > 0 ? unreadCount : undefined }}
+ *   listeners={{ blur: refreshUnread }}
+ * />
+ */
+export const useUnreadNotifications = () => {
+  const [unreadCount, setUnreadCount] = useState(0);
+  const userId = auth.currentUser?.uid;
+
+  const refreshUnread = useCallback(async () => {
+    if (!userId) return;
+    try {
+      const response = await getUnreadCount(userId);
+      if (response.success) {
+        setUnreadCount(response.unread);
+      }
+    } catch (error) {
+      console.error('Error refreshing unread count:', error);
+    }
+  }, [userId]);
+
+  useEffect(() => {
+    if (!userId) return;
+
+    refreshUnread();
+    const unsubscribeChanges = onUnreadChanged(refreshUnread);
+    const unsubscribeStream = subscribeNotifications(userId, () => {
+      setUnreadCount(count => count + 1);
+    });
+    return () => {
+      unsubscribeChanges();
+      unsubscribeStream();
+    };
+  }, [userId, refreshUnread]);
+
+  return { unreadCount, refreshUnread };
+};
@@ -45,7 +45,6 @@ export default function UpdateAvatar({ route, navigation }) {
       allowsEditing: true,
       aspect: imageType === 'avatar' ? [1, 1] : [16, 9],
       quality: 0.8,
-      base64: true,
     });
 
     if (!result.canceled) {
@@ -66,7 +65,6 @@ export default function UpdateAvatar({ route, navigation }) {
       allowsEditing: true,
       aspect: imageType === 'avatar' ? [1, 1] : [16, 9],
       quality: 0.8,
-      base64: true,
     });
 
     if (!result.canceled) {
@@ -84,8 +82,8 @@ export default function UpdateAvatar({ route, navigation }) {
     setUploading(true);
 
     try {
-      // Gửi base64 lên Flask server
-      const response = await fetch(`${BASE_URL}/upload-image`, {
+      // 1. Xin chữ ký upload từ server
+      const signRes = await fetch(`${BASE_URL}/upload-signature`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -93,7 +91,45 @@ export default function UpdateAvatar({ route, navigation }) {
         body: JSON.stringify({
           uid: profile.uid,
           imageType: imageType,
-          imageData: selectedImage.base64,
+        }),
+      });
+      const signData = await signRes.json();
+      if (!signData.success) {
+        throw new Error(signData.error || 'Không lấy được chữ ký upload');
+      }
+
+      // 2. Upload file thẳng lên Cloudinary (không qua server)
+      const form = new FormData();
+      Object.entries(signData.params).forEach(([key, value]) => {
+        form.append(key, String(value));
+      });
+      form.append('file', {
+        uri: selectedImage.uri,
+        type: selectedImage.mimeType || 'image/jpeg',
+        name: selectedImage.fileName || `${imageType}.jpg`,
+      });
+
+      const uploadRes = await fetch(signData.uploadUrl, {
+        method: 'POST',
+        body: form,
+      });
+      const uploaded = await uploadRes.json();
+      if (!uploaded.public_id) {
+        throw new Error(uploaded.error?.message || 'Upload thất bại');
+      }
+
+      // 3. Báo server xác thực và cập nhật Firestore
+      const response = await fetch(`${BASE_URL}/upload-complete`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          uid: profile.uid,
+          imageType: imageType,
+          publicId: uploaded.public_id,
+          version: uploaded.version,
+          signature: uploaded.signature,
         }),
       });
 
@@ -39,6 +39,7 @@ export default function LoveMatchSelectScreen() {
 
   const [selectedType, setSelectedType] = useState("greenflag");   // AUTO CHỌN GREEN FLAG
   const [singleMatchData, setSingleMatchData] = useState(null);
+  const [allMatchData, setAllMatchData] = useState({});
   const [loading, setLoading] = useState(false);
 
   // GỌI API
@@ -61,17 +62,21 @@ export default function LoveMatchSelectScreen() {
         return;
       }
   
-      // KHÔNG CÓ CACHE → GỌI AI
-      console.log("🤖 CALL AI:", type);
-      const res = await axios.post(`${BASE_URL}/love-matching/${type}`, {
+      // ĐÃ TẢI CẢ 5 LOẠI Ở LẦN GỌI AI TRƯỚC
+      if (allMatchData[type]) {
+        setSingleMatchData(allMatchData[type]);
+        return;
+      }
+
+      // KHÔNG CÓ CACHE → GỌI AI 1 LẦN CHO CẢ 5 LOẠI
+      console.log("🤖 CALL AI (all types):", type);
+      const res = await axios.post(`${BASE_URL}/love-matching/all`, {
         uid: user.uid,
       });
-  
-      if (res.data?.users) {
-        setSingleMatchData(res.data.users);
-      } else {
-        setSingleMatchData([]);
-      }
+
+      const results = res.data?.results || {};
+      setAllMatchData(results);
+      setSingleMatchData(results[type] || []);
   
     } catch (err) {
       console.log("LOAD MATCH ERROR:", err);
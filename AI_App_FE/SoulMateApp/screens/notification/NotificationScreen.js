@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { 
   View, 
   Text, 
@@ -15,7 +15,9 @@ import SwipeableNotification from './components/SwipeableNotification';
 import { 
   getNotifications, 
   markNotificationRead, 
+  markAllNotificationsRead,
   deleteNotification,
+  subscribeNotifications,
 } from '../../services/notificationService';
 import { auth } from '../../config/firebaseConfig';
 
@@ -24,6 +26,9 @@ const NotificationsScreen = ({ navigation }) => {
   const [loading, setLoading] = useState(true);
   const [userId, setUserId] = useState(null);
   const [error, setError] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const loadingMoreRef = useRef(false);
 
   // Load notifications khi component mount
   useEffect(() => {
@@ -40,7 +45,35 @@ const NotificationsScreen = ({ navigation }) => {
     }
   }, []);
 
-  // Hàm load thông báo từ API
+  // Nhận thông báo mới realtime qua SSE, chèn lên đầu danh sách
+  useEffect(() => {
+    if (!userId) return;
+
+    const unsubscribe = subscribeNotifications(userId, (notif) => {
+      setNotifications(prev => {
+        if (prev.some(n => n.id === notif.id)) return prev;
+        return [
+          {
+            ...notif,
+            navigable: notif.type === 'match_request' || notif.type === 'match_accepted',
+            navigationData: getNavigationData(notif)
+          },
+          ...prev
+        ];
+      });
+    });
+
+    return unsubscribe;
+  }, [userId]);
+
+  // Thêm thông tin navigable và navigationData cho mỗi thông báo
+  const processNotifications = (list) => list.map(notif => ({
+    ...notif,
+    navigable: notif.type === 'match_request' || notif.type === 'match_accepted',
+    navigationData: getNavigationData(notif)
+  }));
+
+  // Hàm load trang đầu thông báo từ API
   const loadNotifications = async (userIdParam) => {
     try {
       setLoading(true);
@@ -56,14 +89,8 @@ const NotificationsScreen = ({ navigation }) => {
       const response = await getNotifications(currentUserId);
       
       if (response.success) {
-        // Thêm thông tin navigable và navigationData cho mỗi thông báo
-        const processedNotifications = response.notifications.map(notif => ({
-          ...notif,
-          navigable: notif.type === 'match_request' || notif.type === 'match_accepted',
-          navigationData: getNavigationData(notif)
-        }));
-        
-        setNotifications(processedNotifications);
+        setNotifications(processNotifications(response.notifications));
+        setNextCursor(response.nextCursor || null);
       } else {
         setError(response.message || 'Không thể tải thông báo.');
       }
@@ -75,6 +102,38 @@ const NotificationsScreen = ({ navigation }) => {
     }
   };
 
+  // Tải trang tiếp theo (startAfter = nextCursor của trang trước) khi cuộn gần cuối
+  const loadMoreNotifications = async () => {
+    if (!userId || !nextCursor || loadingMoreRef.current) return;
+
+    loadingMoreRef.current = true;
+    setLoadingMore(true);
+    try {
+      const response = await getNotifications(userId, { startAfter: nextCursor });
+
+      if (response.success) {
+        const more = processNotifications(response.notifications);
+        setNotifications(prev => [
+          ...prev,
+          ...more.filter(notif => !prev.some(n => n.id === notif.id))
+        ]);
+        setNextCursor(response.nextCursor || null);
+      }
+    } catch (error) {
+      console.error('Error loading more notifications:', error);
+    } finally {
+      loadingMoreRef.current = false;
+      setLoadingMore(false);
+    }
+  };
+
+  const handleScroll = ({ nativeEvent }) => {
+    const { layoutMeasurement, contentOffset, contentSize } = nativeEvent;
+    if (layoutMeasurement.height + contentOffset.y >= contentSize.height - 200) {
+      loadMoreNotifications();
+    }
+  };
+
   // Callback khi accept/reject match request
   const handleMatchRequestResponse = async (action, requestId) => {
     console.log(`Match request ${action}:`, requestId);
@@ -151,7 +210,7 @@ const NotificationsScreen = ({ navigation }) => {
       );
 
       // Gọi API để cập nhật backend
-      await markNotificationRead([id]);
+      await markNotificationRead(userId, [id]);
     } catch (error) {
       console.error('Error marking notification as read:', error);
       // Revert lại UI nếu API call thất bại
@@ -166,19 +225,15 @@ const NotificationsScreen = ({ navigation }) => {
   // Đánh dấu tất cả đã đọc
   const markAllAsRead = async () => {
     try {
-      const unreadIds = notifications
-        .filter(n => !n.read)
-        .map(n => n.id);
-
-      if (unreadIds.length === 0) return;
+      if (!notifications.some(n => !n.read)) return;
 
       // Cập nhật UI ngay lập tức
       setNotifications(prev =>
         prev.map(notif => ({ ...notif, read: true }))
       );
 
-      // Gọi API
-      await markNotificationRead(unreadIds);
+      // Gọi API: server tự tìm mọi thông báo chưa đọc (kể cả ngoài trang đang tải)
+      await markAllNotificationsRead(userId);
     } catch (error) {
       console.error('Error marking all as read:', error);
       Alert.alert('Lỗi', 'Không thể đánh dấu đã đọc. Vui lòng thử lại.');
@@ -196,7 +251,7 @@ const NotificationsScreen = ({ navigation }) => {
       );
 
       // Gọi API để xóa từ backend
-      await deleteNotification(id);
+      await deleteNotification(userId, id);
     } catch (error) {
       console.error('Error deleting notification:', error);
       Alert.alert('Lỗi', 'Không thể xóa thông báo. Vui lòng thử lại.');
@@ -301,6 +356,8 @@ const NotificationsScreen = ({ navigation }) => {
       <ScrollView
         style={styles.scrollView}
         showsVerticalScrollIndicator={false}
+        onScroll={handleScroll}
+        scrollEventThrottle={200}
         refreshControl={
           <RefreshControl 
             refreshing={refreshing} 
@@ -326,6 +383,9 @@ const NotificationsScreen = ({ navigation }) => {
             />
           ))
         )}
+        {loadingMore && (
+          <ActivityIndicator style={styles.loadingMore} color="#b36dff" />
+        )}
       </ScrollView>
     </View>
   );
@@ -341,6 +401,9 @@ const styles = StyleSheet.create({
     justifyContent: 'center',
     alignItems: 'center',
   },
+  loadingMore: {
+    marginVertical: 16,
+  },
   loadingText: {
     color: '#fff',
     fontSize: 16,
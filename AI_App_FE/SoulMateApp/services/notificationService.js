@@ -1,13 +1,26 @@
 import axios from 'axios';
+import EventSource from 'react-native-sse';
 import { BASE_URL } from '../config/api';
 
 const API_BASE_URL = BASE_URL;
 
+// Báo cho badge đếm chưa đọc lấy lại số từ server sau khi đọc / xoá thành công
+const unreadListeners = new Set();
 
-export const getNotifications = async (userId) => {
+export const onUnreadChanged = (listener) => {
+  unreadListeners.add(listener);
+  return () => unreadListeners.delete(listener);
+};
+
+const notifyUnreadChanged = () => {
+  unreadListeners.forEach(listener => listener());
+};
+
+
+export const getNotifications = async (userId, { limit, startAfter } = {}) => {
   try {
     const response = await axios.get(`${API_BASE_URL}/get-notifications`, {
-      params: { userId }
+      params: { userId, limit, startAfter }
     });
     return response.data;
   } catch (error) {
@@ -17,11 +30,26 @@ export const getNotifications = async (userId) => {
 };
 
 
-export const markNotificationRead = async (notificationIds) => {
+export const getUnreadCount = async (userId) => {
+  try {
+    const response = await axios.get(`${API_BASE_URL}/unread-notifications-count`, {
+      params: { userId }
+    });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching unread count:', error);
+    throw error;
+  }
+};
+
+
+export const markNotificationRead = async (userId, notificationIds) => {
   try {
     const response = await axios.post(`${API_BASE_URL}/mark-notification-read`, {
+      userId,
       notificationIds: Array.isArray(notificationIds) ? notificationIds : [notificationIds]
     });
+    notifyUnreadChanged();
     return response.data;
   } catch (error) {
     console.error('Error marking notification as read:', error);
@@ -30,14 +58,67 @@ export const markNotificationRead = async (notificationIds) => {
 };
 
 
-export const deleteNotification = async (notificationId) => {
+export const markAllNotificationsRead = async (userId) => {
+  try {
+    const response = await axios.post(`${API_BASE_URL}/mark-all-notifications-read`, {
+      userId
+    });
+    notifyUnreadChanged();
+    return response.data;
+  } catch (error) {
+    console.error('Error marking all notifications as read:', error);
+    throw error;
+  }
+};
+
+
+export const deleteNotification = async (userId, notificationId) => {
   try {
     const response = await axios.post(`${API_BASE_URL}/delete-notification`, {
+      userId,
       notificationId
     });
+    notifyUnreadChanged();
     return response.data;
   } catch (error) {
     console.error('Error deleting notification:', error);
     throw error;
   }
-};
\ No newline at end of file
+};
+
+
+// Stream realtime: mỗi user chỉ giữ 1 kết nối SSE, dùng chung cho mọi màn hình đang nghe
+const streams = {};
+
+export const subscribeNotifications = (userId, onNotification) => {
+  if (!userId) return () => {};
+
+  let stream = streams[userId];
+  if (!stream) {
+    const source = new EventSource(`${API_BASE_URL}/notifications/stream?userId=${encodeURIComponent(userId)}`);
+    stream = { source, listeners: new Set() };
+    source.addEventListener('notification', (event) => {
+      try {
+        const notification = JSON.parse(event.data);
+        stream.listeners.forEach(listener => listener(notification));
+      } catch (error) {
+        console.error('Error parsing notification event:', error);
+      }
+    });
+    source.addEventListener('error', (event) => {
+      console.error('Notification stream error:', event.message || event.type);
+    });
+    streams[userId] = stream;
+  }
+
+  stream.listeners.add(onNotification);
+
+  return () => {
+    stream.listeners.delete(onNotification);
+    if (stream.listeners.size === 0) {
+      stream.source.removeAllEventListeners();
+      stream.source.close();
+      delete streams[userId];
+    }
+  };
+};